@@ -0,0 +1,216 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from policing_data_expl import outcome_as_float, draw_search_rates_comparison, draw_search_rates_comparison_all_states
+from run_report import log
+
+# Materialized aggregates (count, sum, sum of squares) keyed by state x subset x driver_race x outcome,
+# plus the top value counts per column, so the subset and race comparison plots and tables
+# don't have to concatenate and rescan the full state dataframes
+
+# pipeline outputs for each state and subset (the same files as get_state_data)
+CUBE_SOURCES = {
+    'AZ': {
+        'all_drivers': 'csv/az_raw_with_driver_id_Style_Year.csv',
+        'multiply_stopped': 'csv/az_grouped_Style_Year.csv',
+        'racially_ambig': 'csv/az_hispanic_white_drivers_Style_Year.csv'
+    },
+    'CO': {
+        'all_drivers': 'csv/co_raw_with_driver_id_mod_officer_id.csv',
+        'multiply_stopped': 'csv/co_grouped_mod_officer_id.csv',
+        'racially_ambig': 'csv/co_hispanic_white_drivers_only_mod.csv'
+    },
+    'TX': {
+        'all_drivers': 'csv/tx_raw_with_driver_id_driver_race.csv',
+        'multiply_stopped': 'csv/tx_processed_grouped_driver_race_raw.csv',
+        'racially_ambig': 'csv/tx_processed_hispanic_white_drivers_driver_race.csv'
+    }
+}
+
+SUBSETS = ['all_drivers', 'multiply_stopped', 'racially_ambig']
+OUTCOMES = ['search_conducted', 'is_arrested', 'contraband_found']
+VALUE_COUNT_COLS = ['violation', 'county_name']
+TOP_K = 10
+
+CUBE_CSV = 'csv/aggregate_cube.csv'
+TOP_VALUES_CSV = 'csv/aggregate_cube_top_values.csv'
+SOURCES_JSON = 'csv/aggregate_cube_sources.json'
+
+def aggregate_slice(d, state, subset, driver_race_col='driver_race'):
+    """
+    Return the count, sum and sum of squares of each outcome per driver race for one state's subset,
+    only counting rows with a non-null outcome and driver race
+    """
+    slices = []
+    for outcome in OUTCOMES:
+        if outcome not in d.columns:
+            continue # texas doesn't have is_arrested
+        y = outcome_as_float(d[outcome])
+        valid = (y.notnull() & d[driver_race_col].notnull()).to_numpy()
+        per_race = pd.DataFrame({'driver_race': d[driver_race_col].to_numpy()[valid], 'y': y.to_numpy()[valid]})
+        per_race['y_sq'] = per_race['y'] ** 2
+        agg = per_race.groupby('driver_race').agg(count=('y', 'size'), sum=('y', 'sum'), sum_sq=('y_sq', 'sum')).reset_index()
+        agg.insert(0, 'outcome', outcome)
+        slices.append(agg)
+    cube_slice = pd.concat(slices, ignore_index=True)
+    cube_slice.insert(0, 'subset', subset)
+    cube_slice.insert(0, 'state', state)
+    return cube_slice
+
+def top_values_slice(d, state, subset, value_count_cols=VALUE_COUNT_COLS, top_k=TOP_K, driver_race_col='driver_race'):
+    """
+    Return the top_k most common values (and their counts) of each of the value_count_cols among white and Hispanic drivers
+    """
+    white_hispanic = d.loc[(d[driver_race_col] == 'White') | (d[driver_race_col] == 'Hispanic')]
+    slices = []
+    for col in value_count_cols:
+        if col not in d.columns:
+            log(f'{state} {subset} has no {col} column, so it has no top values of {col}')
+            continue
+        counts = white_hispanic[col].value_counts().head(top_k)
+        slices.append(pd.DataFrame({'col': col, 'rank': np.arange(len(counts)), 'value': counts.index, 'count': counts.to_numpy()}))
+    if len(slices) > 0:
+        top_values = pd.concat(slices, ignore_index=True)
+    else:
+        top_values = pd.DataFrame(columns=['col', 'rank', 'value', 'count'])
+    top_values.insert(0, 'subset', subset)
+    top_values.insert(0, 'state', state)
+    return top_values
+
+def file_fingerprint(filepath, value_count_cols=VALUE_COUNT_COLS):
+    """
+    Size and modification time of the file and the columns whose top values are kept, used to detect which
+    sources changed (or need the top values of other columns) since the cube was built
+    """
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns, sorted(value_count_cols)]
+
+def refresh_cube(sources=CUBE_SOURCES, cube_csv=CUBE_CSV, top_values_csv=TOP_VALUES_CSV, sources_json=SOURCES_JSON,
+                 value_count_cols=VALUE_COUNT_COLS):
+    """
+    Build the cube from the pipeline outputs in sources, or if it was already built,
+    only recompute the (state, subset) slices whose source file changed since then
+    (every slice is recomputed if value_count_cols, the columns to keep the top values of, changed).
+    Return the cube and the top values dataframes
+    """
+    if os.path.isfile(cube_csv) and os.path.isfile(top_values_csv) and os.path.isfile(sources_json):
+        cube = pd.read_csv(cube_csv)
+        top_values = pd.read_csv(top_values_csv)
+        with open(sources_json) as f:
+            fingerprints = json.load(f)
+    else:
+        cube = pd.DataFrame(columns=['state', 'subset', 'outcome', 'driver_race', 'count', 'sum', 'sum_sq'])
+        top_values = pd.DataFrame(columns=['state', 'subset', 'col', 'rank', 'value', 'count'])
+        fingerprints = {}
+
+    new_cube_slices = []
+    new_top_values_slices = []
+    for state, subset_files in sources.items():
+        for subset, filepath in subset_files.items():
+            if not os.path.isfile(filepath):
+                log(f'Skipping {state} {subset} - {filepath} does not exist')
+                continue
+            key = f'{state}/{subset}'
+            fingerprint = file_fingerprint(filepath, value_count_cols)
+            if fingerprints.get(key) == fingerprint:
+                continue
+            log(f'Refreshing {state} {subset} from {filepath}')
+            d = pd.read_csv(filepath)
+            if 'driver_race' not in d.columns and 'driver_race_raw' in d.columns:
+                d['driver_race'] = d['driver_race_raw'].str.capitalize()
+            # drop the stale slice of this state and subset
+            cube = cube.loc[~((cube['state'] == state) & (cube['subset'] == subset))]
+            top_values = top_values.loc[~((top_values['state'] == state) & (top_values['subset'] == subset))]
+            new_cube_slices.append(aggregate_slice(d, state, subset))
+            new_top_values_slices.append(top_values_slice(d, state, subset, value_count_cols))
+            fingerprints[key] = fingerprint
+
+    if len(new_cube_slices) > 0:
+        cube = pd.concat([cube] + new_cube_slices, ignore_index=True)
+        top_values = pd.concat([top_values] + new_top_values_slices, ignore_index=True)
+        cube.to_csv(cube_csv, index=False)
+        top_values.to_csv(top_values_csv, index=False)
+        with open(sources_json, 'w') as f:
+            json.dump(fingerprints, f, indent=2)
+    return cube, top_values
+
+def cube_mean_sem(cube, outcome, states, subset, races):
+    """
+    Return the mean and standard error of the mean of outcome pooled over the states and races for the subset,
+    computed from the counts, sums and sums of squares (the same as .mean() and .sem() on the pooled rows)
+    """
+    cells = cube.loc[(cube['outcome'] == outcome) & cube['state'].isin(states) & (cube['subset'] == subset) & cube['driver_race'].isin(races)]
+    n = cells['count'].sum()
+    total = cells['sum'].sum()
+    total_sq = cells['sum_sq'].sum()
+    if n == 0:
+        return np.nan, np.nan
+    mean = total / n
+    if n == 1:
+        return mean, np.nan
+    var = max(total_sq - total ** 2 / n, 0) / (n - 1)
+    return mean, np.sqrt(var / n)
+
+def search_rates_comparison_stats(cube, state, col):
+    """
+    The rates (%), 95% CI widths and labels of plot_search_rates_comparison for the state, from the cube
+    """
+    stat_list = []
+    ci_width_list = []
+    index_list = []
+    for label, subset in zip(['All Drivers', 'Multiply Stopped Drivers', 'Racially Ambiguous Drivers'], SUBSETS):
+        for races in [['White', 'Hispanic'], ['White'], ['Hispanic']]:
+            mean, sem = cube_mean_sem(cube, col, [state], subset, races)
+            # multiplying both by 100 to display as percents
+            stat_list.append(100 * mean)
+            ci_width_list.append(196 * sem)
+        index_list.extend([f'{label} - white and Hispanic', f'{label} - white only', f'{label} - Hispanic only'])
+    return stat_list, ci_width_list, index_list
+
+def plot_search_rates_comparison_from_cube(cube, state, col, fig_path=None, show=True):
+    """
+    Cube version of plot_search_rates_comparison: plot mean column rates for white and Hispanic drivers of the state
+    """
+    stat_list, ci_width_list, index_list = search_rates_comparison_stats(cube, state, col)
+    draw_search_rates_comparison(state, col, stat_list, ci_width_list, index_list, fig_path, show)
+
+def search_rates_comparison_all_states_stats(cube, col, states=('AZ', 'CO', 'TX')):
+    """
+    The rates (%) and 95% CI widths of plot_search_rates_comparison_all_states, pooled across the states, from the cube
+    (states without the column, like texas for is_arrested, have no rows for it and so drop out of the pool)
+    """
+    stat_lists = []
+    ci_width_lists = []
+    for subset in SUBSETS:
+        stats = [cube_mean_sem(cube, col, list(states), subset, [race]) for race in ['White', 'Hispanic']]
+        stat_lists.append([100 * mean for mean, _ in stats])
+        ci_width_lists.append([196 * sem for _, sem in stats])
+    return stat_lists, ci_width_lists
+
+def plot_search_rates_comparison_all_states_from_cube(cube, col, states=('AZ', 'CO', 'TX'), fig_path=None, show=True):
+    """
+    Cube version of plot_search_rates_comparison_all_states
+    """
+    stat_lists, ci_width_lists = search_rates_comparison_all_states_stats(cube, col, states)
+    draw_search_rates_comparison_all_states(col, stat_lists, ci_width_lists, fig_path, show)
+
+def top_col_values_from_cube(top_values, col_name, k=5, states=('AZ', 'CO', 'TX')):
+    """
+    Cube version of plot_top_5_col_values_all_states: return a dictionary of state to a dataframe
+    of the top k values of col_name among white and Hispanic drivers per subset.
+    Raise a ValueError if the cube has no top values of col_name (see refresh_cube's value_count_cols)
+    """
+    if col_name not in set(top_values['col']):
+        raise ValueError(f"The cube has no top values of {col_name}, only of {sorted(set(top_values['col']))}; "
+                         f"pass it in value_count_cols to refresh_cube")
+    tables = {}
+    for state in states:
+        top_k_vals = []
+        index_list = []
+        for data_label, subset in zip(['All Drivers', 'Multiply Stopped Drivers', 'Racially Ambiguous'], SUBSETS):
+            vals = top_values.loc[(top_values['state'] == state) & (top_values['subset'] == subset) & (top_values['col'] == col_name)]
+            top_k_vals.append(pd.Index(vals.sort_values('rank')['value'].head(k)))
+            index_list.append(f'{data_label} - white and Hispanic')
+        tables[state] = pd.DataFrame({col_name: top_k_vals}, index=index_list)
+    return tables
@@ -0,0 +1,163 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy import stats
+from policing_data_expl import outcome_as_float, hour_of_day_from_time, race_pair_races
+from pooled_panel import within_regression
+from fit_cache import FitSummary
+from run_report import log
+
+# Design-matrix store: the numeric design of a state's race pair panel (the Hispanic indicator, the outcomes,
+# the controls and the fixed effects as int32 codes) materialized once and saved as .npy files. Loading the store
+# memory-maps the arrays read-only, so the fits of design_within_regression read them in place, and the worker
+# processes of fit_design_specs each map the same files (shared through the page cache) instead of receiving their
+# own copy of the panel, rebuilding the dummies and parsing a formula like regress does for every fit.
+#
+# Example (arizona):
+#     store = build_design_matrix_store(azgrouped_with_race_str)
+#     store.save('csv/design_matrix/az_Style_Year')
+#     fits = fit_design_specs('csv/design_matrix/az_Style_Year', [
+#         {'dep_var': 'search_conducted', 'model_name': 'No controls'},
+#         {'dep_var': 'search_conducted', 'controls': ['hour_of_day'], 'model_name': 'Hour of day'}])
+#     make_sensitivity_dot_plot(fits, 'Hispanic', 'AZ')
+
+DESIGN_DIR = 'csv/design_matrix/'
+OUTCOME_COLS = ['search_conducted', 'is_arrested', 'contraband_found']
+CONTROL_COLS = ['hour_of_day']
+FIXED_EFFECT_COLS = ['driver_id', 'officer_id', 'county_name', 'stop_year', 'stop_month', 'weekday']
+
+class DesignMatrixStore:
+    """
+    Numeric design of a race pair's panel, one entry per stop: race is the indicator of the pair's first race
+    (ex. Hispanic), outcomes and controls are float64 (nan if null), and fixed effects are int32 codes (-1 if null)
+    """
+    def __init__(self, race, outcomes, controls, fixed_effects, meta):
+        self.race = race
+        self.outcomes = outcomes # outcome column -> array
+        self.controls = controls # control column -> array
+        self.fixed_effects = fixed_effects # fixed effect column -> array of codes
+        self.meta = meta # race_pair, race, the column names and the number of stops
+
+    @property
+    def nobs(self):
+        return len(self.race)
+
+    def save(self, store_dir):
+        """
+        Write each array to a .npy file in store_dir, and the column names and other metadata to meta.json
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        arrays = {'race': self.race}
+        arrays.update({'outcome_' + col: values for col, values in self.outcomes.items()})
+        arrays.update({'control_' + col: values for col, values in self.controls.items()})
+        arrays.update({'fe_' + col: codes for col, codes in self.fixed_effects.items()})
+        for name, values in arrays.items():
+            np.save(os.path.join(store_dir, name + '.npy'), values)
+        with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+        log(f'Saved the design matrix of {self.nobs} stops to {store_dir}')
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode='r'):
+        """
+        Load a saved store; with mmap_mode='r' the arrays are memory-mapped read-only instead of read into memory
+        """
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        def load_array(name):
+            return np.load(os.path.join(store_dir, name + '.npy'), mmap_mode=mmap_mode)
+        return cls(load_array('race'),
+                   {col: load_array('outcome_' + col) for col in meta['outcome_cols']},
+                   {col: load_array('control_' + col) for col in meta['control_cols']},
+                   {col: load_array('fe_' + col) for col in meta['fixed_effect_cols']},
+                   meta)
+
+def build_design_matrix_store(stategrouped_with_race_str, outcome_cols=OUTCOME_COLS, control_cols=CONTROL_COLS,
+                              fixed_effect_cols=FIXED_EFFECT_COLS, race_pair='Hispanic_White', driver_race_col='driver_race',
+                              stop_time_col='stop_time'):
+    """
+    Build the DesignMatrixStore of the stops of race_pair's drivers (data without a race_str column, like the
+    processed Hispanic-white files, are taken to already be only those drivers). Outcome, control and fixed effect
+    columns the data doesn't have are skipped, except driver_id. hour_of_day is computed from stop_time_col like
+    regress if add_time_features didn't add it
+    """
+    d = stategrouped_with_race_str
+    if 'race_str' in d.columns:
+        d = d.loc[d['race_str'] == race_pair]
+    race = race_pair_races(race_pair)[0]
+    race_values = np.where(d[driver_race_col].notna(), (d[driver_race_col] == race).to_numpy(dtype=float), np.nan)
+
+    outcome_cols = [col for col in outcome_cols if col in d.columns]
+    outcomes = {col: outcome_as_float(d[col]).to_numpy(dtype=float) for col in outcome_cols}
+    controls = {}
+    for col in control_cols:
+        if col == 'hour_of_day' and 'hour_of_day' not in d.columns and stop_time_col in d.columns:
+            controls[col] = hour_of_day_from_time(d[stop_time_col]).to_numpy(dtype=float)
+        elif col in d.columns:
+            controls[col] = d[col].to_numpy(dtype=float)
+    fixed_effect_cols = [col for col in fixed_effect_cols if col in d.columns]
+    if 'driver_id' not in fixed_effect_cols:
+        raise ValueError('The design matrix store needs the driver_id column')
+    fixed_effects = {col: pd.factorize(d[col])[0].astype(np.int32) for col in fixed_effect_cols}
+
+    meta = {'race_pair': race_pair, 'race': race, 'outcome_cols': outcome_cols, 'control_cols': list(controls),
+            'fixed_effect_cols': fixed_effect_cols, 'nobs': len(d)}
+    log(f'Built the design matrix of {len(d)} stops of {race_pair} drivers: outcomes {outcome_cols}, controls {list(controls)}, fixed effects {fixed_effect_cols}')
+    log('Null fixed effect codes:', {col: int((codes < 0).sum()) for col, codes in fixed_effects.items()})
+    return DesignMatrixStore(race_values, outcomes, controls, fixed_effects, meta)
+
+def design_within_regression(store, dep_var='search_conducted', controls=(), fixed_effects=('driver_id',), cluster=None,
+                             max_iter=1000, tol=1e-10):
+    """
+    Fit dep_var ~ race indicator + controls + fixed effects straight from the store's arrays (see within_regression).
+    cluster is one of the store's fixed effect columns (ex. 'officer_id'); stops where it's null (code -1) are dropped
+    rather than pooled into one cluster. With driver_id as the only fixed effect, the estimates and unadjusted
+    standard errors are those of regress
+    """
+    x = np.column_stack([store.race] + [store.controls[col] for col in controls])
+    fe_codes = [store.fixed_effects[col] for col in fixed_effects]
+    cluster_codes = store.fixed_effects[cluster] if cluster is not None else None
+    return within_regression(store.outcomes[dep_var], x, fe_codes, [store.meta['race']] + list(controls), fixed_effects,
+                             cluster_codes, max_iter, tol)
+
+def design_fit_summary(results, model_name):
+    """
+    Return the FitSummary of design_within_regression's results (t(df_resid) confidence intervals, like regress's),
+    so they can be passed to make_sensitivity_dot_plot
+    """
+    q = stats.t.ppf(0.975, results.attrs['df_resid'])
+    conf_int_table = pd.DataFrame({'lower': results['coef'] - q * results['std_err'], 'upper': results['coef'] + q * results['std_err']})
+    return FitSummary(results['coef'], results.attrs['cov'], conf_int_table, results.attrs['nobs'], model_name, results.to_string())
+
+def fit_design_spec(store_dir, spec):
+    """
+    Fit one spec (a dictionary of design_within_regression arguments and a model_name) on the store saved in
+    store_dir, memory-mapping its arrays (runs in a worker process)
+    """
+    spec = dict(spec)
+    model_name = spec.pop('model_name', spec.get('dep_var'))
+    return design_fit_summary(design_within_regression(DesignMatrixStore.load(store_dir), **spec), model_name)
+
+def fit_design_specs(store_dir, specs, max_workers=None):
+    """
+    Fit each spec in specs in parallel worker processes that each memory-map the store saved in store_dir,
+    and return the list of FitSummary objects in the order of specs
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        fits = list(executor.map(fit_design_spec, [store_dir] * len(specs), specs))
+    log(f'Fit {len(fits)} specs on the design matrix in {store_dir}')
+    return fits
+
+if __name__ == '__main__':
+    from processed_data import read_processed_data
+    specs = [{'dep_var': 'search_conducted', 'model_name': 'No controls'},
+             {'dep_var': 'search_conducted', 'controls': ['hour_of_day'], 'model_name': 'Hour of day'},
+             {'dep_var': 'search_conducted', 'fixed_effects': ['driver_id', 'officer_id'], 'model_name': 'Officer fixed effects'},
+             {'dep_var': 'search_conducted', 'cluster': 'driver_id', 'model_name': 'Clustered by driver'}]
+    for state in ['AZ', 'CO', 'TX']:
+        store_dir = f'{DESIGN_DIR}{state.lower()}_hispanic_white'
+        build_design_matrix_store(read_processed_data(state, 'hispanic-white')).save(store_dir)
+        for fit in fit_design_specs(store_dir, specs):
+            log(f"{state} {fit.model_name}: {fit.params['Hispanic']:.5f} ({fit.std_errors['Hispanic']:.5f})")
@@ -0,0 +1,283 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from collections import Counter
+from scipy.stats import ttest_rel
+from policing_data_expl import outcome_as_float, write_to_csv
+from run_report import log
+
+# Compact driver-stop store: the stops sorted by driver (in the same order as iterating over group_df_by's groupby)
+# as contiguous typed arrays with an offsets array marking where each driver's stops start. Per-driver statistics
+# are segment reductions (np.*.reduceat) over these arrays instead of a pandas sub-dataframe per driver, and the
+# arrays can be saved as .npy files and memory-mapped back. The *_from_store functions are the store versions of
+# generate_person_race_dict, calc_racial_ambig, enumerate_racial_ambig, ttest_paired and check_cond.
+#
+# Example (arizona):
+#     store = build_driver_store(azgrouped_csv, config['grouping_keys'])
+#     store.save('csv/az_driver_store' + config['descript'])
+#     store = DriverStopStore.load('csv/az_driver_store' + config['descript'])
+#     ttest_paired_from_store(store)
+
+STOP_ARRAYS = ['race_codes', 'officer_codes', 'county_codes', 'dates', 'row_order']
+OUTCOME_COLS = ['search_conducted', 'is_arrested', 'contraband_found']
+
+class DriverStopStore:
+    """
+    Stops of every driver as typed arrays: the stops of driver i are at positions offsets[i]:offsets[i + 1].
+    Categorical columns (race, officer, county and the grouping keys) are int32 codes (-1 if null) into their
+    categories (races in alphabetical order), outcomes are float32 (nan if null), dates are datetime64[D], and
+    row_order is each stop's row position in the dataframe the store was built from
+    """
+    def __init__(self, offsets, arrays, outcomes, key_codes, driver_ids, meta):
+        self.offsets = offsets
+        self.race_codes = arrays['race_codes']
+        self.officer_codes = arrays['officer_codes']
+        self.county_codes = arrays['county_codes']
+        self.dates = arrays['dates']
+        self.row_order = arrays['row_order']
+        self.outcomes = outcomes # outcome column -> array
+        self.key_codes = key_codes # grouping key -> array of codes per driver
+        self.driver_ids = driver_ids # driver_id of each driver (or None)
+        self.meta = meta # grouping_keys, categories and number of rows of the source dataframe
+
+    @property
+    def num_drivers(self):
+        return len(self.offsets) - 1
+
+    @property
+    def races(self):
+        return self.meta['categories']['race']
+
+    def num_stops(self):
+        """
+        Number of stops per driver
+        """
+        return np.diff(self.offsets)
+
+    def segment_sum(self, values):
+        """
+        Per-driver sum of a per-stop array
+        """
+        if self.num_drivers == 0:
+            return np.zeros(0, dtype=values.dtype)
+        return np.add.reduceat(values, self.offsets[:-1])
+
+    def race_mask(self):
+        """
+        Per-driver bitmask of the races recorded at their stops (bit i = self.races[i])
+        """
+        if self.num_drivers == 0:
+            return np.zeros(0, dtype=np.int64)
+        bits = np.where(self.race_codes >= 0, np.left_shift(1, np.maximum(self.race_codes, 0).astype(np.int64)), 0)
+        return np.bitwise_or.reduceat(bits, self.offsets[:-1])
+
+    def race_count(self, race):
+        """
+        Per-driver number of stops recorded as race
+        """
+        return self.segment_sum((self.race_codes == self.races.index(race)).astype(np.int64))
+
+    def race_mean(self, outcome_col, race):
+        """
+        Per-driver mean of the outcome over their non-null stops recorded as race (nan if there are none)
+        """
+        values = self.outcomes[outcome_col]
+        at_race = (self.race_codes == self.races.index(race)) & ~np.isnan(values)
+        num = self.segment_sum(at_race.astype(np.int64))
+        total = self.segment_sum(np.where(at_race, values, 0).astype(np.float64))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / num
+
+    def race_mask_str(self, mask):
+        """
+        Race string of a bitmask: its races in alphabetical order joined with '_' (ex. 'Hispanic_White')
+        """
+        return '_'.join(race for i, race in enumerate(self.races) if (mask >> i) & 1)
+
+    def race_strs(self):
+        """
+        Per-driver race string of all the races recorded at their stops
+        """
+        masks = self.race_mask()
+        unique_masks, inverse = np.unique(masks, return_inverse=True)
+        return np.array([self.race_mask_str(mask) for mask in unique_masks], dtype=object)[inverse.ravel()]
+
+    def hispanic_white_drivers(self):
+        """
+        Per-driver boolean of whether their recorded races are exactly Hispanic and white
+        """
+        if 'Hispanic' not in self.races or 'White' not in self.races:
+            return np.zeros(self.num_drivers, dtype=bool)
+        return self.race_mask() == ((1 << self.races.index('Hispanic')) | (1 << self.races.index('White')))
+
+    def driver_names(self):
+        """
+        Per-driver tuple of grouping key values, like the group names of group_df_by's groupby
+        """
+        columns = [np.asarray(self.meta['categories']['keys'][key], dtype=object)[self.key_codes[key]] for key in self.meta['grouping_keys']]
+        return list(zip(*columns))
+
+    def stop_driver_codes(self):
+        """
+        Per-stop driver code (0 to num_drivers - 1)
+        """
+        return np.repeat(np.arange(self.num_drivers), self.num_stops())
+
+    def save(self, store_dir):
+        """
+        Write each array to a .npy file in store_dir, and the categories and other metadata to meta.json
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        arrays = {'offsets': self.offsets}
+        arrays.update({name: getattr(self, name) for name in STOP_ARRAYS})
+        arrays.update({'outcome_' + col: values for col, values in self.outcomes.items()})
+        arrays.update({'key_' + key: codes for key, codes in self.key_codes.items()})
+        if self.driver_ids is not None:
+            arrays['driver_ids'] = self.driver_ids
+        for name, values in arrays.items():
+            np.save(os.path.join(store_dir, name + '.npy'), values)
+        with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+        log(f'Saved the store of {self.num_drivers} drivers and {len(self.race_codes)} stops to {store_dir}')
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode='r'):
+        """
+        Load a saved store; with mmap_mode='r' the arrays are memory-mapped instead of read into memory
+        """
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        def load_array(name):
+            return np.load(os.path.join(store_dir, name + '.npy'), mmap_mode=mmap_mode)
+        driver_ids_path = os.path.join(store_dir, 'driver_ids.npy')
+        return cls(load_array('offsets'),
+                   {name: load_array(name) for name in STOP_ARRAYS},
+                   {col: load_array('outcome_' + col) for col in meta['outcome_cols']},
+                   {key: load_array('key_' + key) for key in meta['grouping_keys']},
+                   load_array('driver_ids') if os.path.isfile(driver_ids_path) else None,
+                   meta)
+
+def category_codes(values, sort=False):
+    """
+    Return int32 codes (-1 if null) and the list of categories (as strings) of the values
+    """
+    codes, categories = pd.factorize(values, sort=sort)
+    return codes.astype(np.int32), [str(category) for category in categories]
+
+def build_driver_store(d, grouping_keys, driver_race_col='driver_race', outcome_cols=OUTCOME_COLS,
+                       date_col='stop_date', officer_col='officer_id', county_col='county_name'):
+    """
+    Build the DriverStopStore of the dataframe d, with drivers identified by grouping_keys in the order of
+    iterating over d.groupby(grouping_keys) and stops in their order in d. Like the groupby, stops with a null
+    grouping key are left out. The outcome, date, officer and county columns are optional (skipped if missing)
+    """
+    driver_codes = d.groupby(grouping_keys, sort=True).ngroup().to_numpy()
+    grouped_rows = np.flatnonzero(driver_codes >= 0)
+    row_order = grouped_rows[np.argsort(driver_codes[grouped_rows], kind='stable')]
+    stops = d.iloc[row_order]
+    stops_per_driver = np.bincount(driver_codes[row_order])
+    offsets = np.concatenate([[0], np.cumsum(stops_per_driver)]).astype(np.int64)
+    first_stops = stops.iloc[offsets[:-1]]
+
+    race_codes, races = category_codes(stops[driver_race_col], sort=True)
+    categories = {'race': races, 'keys': {}}
+    arrays = {'race_codes': race_codes, 'row_order': row_order.astype(np.int64)}
+    for name, col in [('officer', officer_col), ('county', county_col)]:
+        if col in d.columns:
+            arrays[name + '_codes'], categories[name] = category_codes(stops[col])
+        else:
+            arrays[name + '_codes'], categories[name] = np.full(len(stops), -1, dtype=np.int32), []
+    if date_col in d.columns:
+        arrays['dates'] = pd.to_datetime(stops[date_col], errors='coerce').to_numpy().astype('datetime64[D]')
+    else:
+        arrays['dates'] = np.full(len(stops), np.datetime64('NaT'), dtype='datetime64[D]')
+
+    outcome_cols = [col for col in outcome_cols if col in d.columns]
+    outcomes = {col: outcome_as_float(stops[col]).to_numpy(dtype=np.float32) for col in outcome_cols}
+    key_codes = {}
+    for key in grouping_keys:
+        key_codes[key], categories['keys'][key] = category_codes(first_stops[key])
+    # group_df_by's driver ids are integers (the processed data's are hashes, which aren't kept)
+    driver_ids = first_stops['driver_id'].to_numpy(dtype=np.int64) if 'driver_id' in d.columns and pd.api.types.is_integer_dtype(d['driver_id']) else None
+
+    meta = {'grouping_keys': list(grouping_keys), 'outcome_cols': outcome_cols, 'categories': categories, 'source_rows': len(d)}
+    log(f'Built the store of {len(stops_per_driver)} drivers and {len(stops)} stops')
+    return DriverStopStore(offsets, arrays, outcomes, key_codes, driver_ids, meta)
+
+def generate_person_race_dict_from_store(store):
+    """
+    Store version of generate_person_race_dict: return a dictionary of each driver's grouping key values -> race string
+    """
+    person_race_dict = dict(zip(store.driver_names(), store.race_strs()))
+    log("#Individuals -", len(person_race_dict))
+    return person_race_dict
+
+def race_str_column_from_store(store):
+    """
+    Return the race_str column of the dataframe the store was built from, aligned with its rows
+    (None for rows that weren't grouped), without going through the dictionary of driver names
+    """
+    race_str_col = np.full(store.meta['source_rows'], None, dtype=object)
+    race_str_col[store.row_order] = store.race_strs()[store.stop_driver_codes()]
+    return race_str_col
+
+def calc_racial_ambig_from_store(store):
+    """
+    Store version of calc_racial_ambig: the number of stops and drivers with more than one race recorded,
+    and the number of stops of Hispanic-white drivers
+    """
+    masks = store.race_mask()
+    num_stops = store.num_stops()
+    ambig = (masks & (masks - 1)) != 0 # more than one bit set
+    num_racial_ambig_entries = int(num_stops[ambig].sum())
+    num_racial_ambig_ind = int(ambig.sum())
+    num_hispanic_white_entries = int(num_stops[store.hispanic_white_drivers()].sum())
+
+    log("# Racially Ambiguous - Entries:", num_racial_ambig_entries)
+    log("# Racially Ambiguous - Individuals:", num_racial_ambig_ind)
+    log("# Hispanic-white - Entries:", num_hispanic_white_entries)
+    return num_racial_ambig_entries, num_racial_ambig_ind, num_hispanic_white_entries
+
+def enumerate_racial_ambig_from_store(store):
+    """
+    Store version of enumerate_racial_ambig: a Counter of each kind of racial ambiguity
+    """
+    masks = store.race_mask()
+    ambig_masks, counts = np.unique(masks[(masks & (masks - 1)) != 0], return_counts=True)
+    log("#Individuals -", int(counts.sum()))
+    return Counter({store.race_mask_str(mask): int(count) for mask, count in zip(ambig_masks, counts)})
+
+def ttest_paired_from_store(store):
+    """
+    Store version of ttest_paired: paired t-test of each Hispanic-white driver's outcome rate
+    at the stops they were recorded as white versus Hispanic
+    """
+    stat_dict = {}
+    stat_lst = [col for col in ['is_arrested', 'search_conducted'] if col in store.outcomes]
+    log(stat_lst)
+    hispanic_white = store.hispanic_white_drivers()
+    for stat_name in stat_lst:
+        white_search_rate = store.race_mean(stat_name, 'White')[hispanic_white]
+        hispanic_search_rate = store.race_mean(stat_name, 'Hispanic')[hispanic_white]
+        log(len(white_search_rate), len(hispanic_search_rate))
+        stat_dict[stat_name] = ttest_rel(white_search_rate, hispanic_search_rate, nan_policy='omit')
+    return stat_dict
+
+def check_cond_from_store(store, d, csv_filename, min_stops=2, max_stops=10, name_cond=None):
+    """
+    Store version of check_cond for the state conditions: write the stops of d (the dataframe the store was built from)
+    of the drivers with min_stops to max_stops stops, and for whom name_cond(name) is true if it's given
+    (ex. colorado's checks on the names), in the same order check_cond writes them
+    """
+    if os.path.isfile(csv_filename):
+        log(f"{csv_filename} already exists, NO CHANGE")
+        return
+    num_stops = store.num_stops()
+    eligible = (num_stops >= min_stops) & (num_stops <= max_stops)
+    if name_cond is not None:
+        names = store.driver_names()
+        for i in np.flatnonzero(eligible):
+            eligible[i] = name_cond(names[i])
+    write_to_csv(d.iloc[store.row_order[eligible[store.stop_driver_codes()]]], csv_filename)
+    log(f"Number of groups written to csv: {int(eligible.sum())}")
@@ -0,0 +1,140 @@
+import os
+import csv
+import heapq
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from pandas._libs.parsers import STR_NA_VALUES # pandas' default na_values
+from run_report import log
+
+# External merge sort of the stops by driver (grouping_keys) and a generator that streams
+# one driver's stops at a time from the sorted csv, so per-driver conditions (az_cond, co_cond, tx_cond)
+# and per-driver statistics over a csv only need the largest driver's stops in memory instead of the whole state.
+# The state scripts already hold the whole state in memory (for standardize_cols and group_df_by) when they
+# sort the raw_with_driver_id csv, so their external_sort option doesn't lower their peak memory; the streaming
+# is for going over the written csvs later without loading them.
+
+def spill_sorted_runs(input_csv, grouping_keys, run_dir, run_rows=1000000):
+    """
+    Read input_csv run_rows rows at a time, sort each run by grouping_keys and write it to run_dir.
+    Every column is read as a string (and empty strings are kept as is) so the rows are written back unchanged.
+    Return the list of run files
+    """
+    run_files = []
+    for i, run in enumerate(pd.read_csv(input_csv, dtype=str, keep_default_na=False, chunksize=run_rows)):
+        # np.lexsort (used for multiple columns) is stable, so stops of a driver keep their original order
+        run = run.sort_values(grouping_keys)
+        run_file = os.path.join(run_dir, f'run_{i}.csv')
+        run.to_csv(run_file, index=False)
+        run_files.append(run_file)
+    log(f'Spilled {len(run_files)} sorted runs of up to {run_rows} rows')
+    return run_files
+
+def read_run_rows(run_file):
+    """
+    Yield the rows of a run file (without its header) as lists of strings
+    """
+    with open(run_file, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            yield row
+
+def external_sort_csv(input_csv, grouping_keys, output_csv, run_rows=1000000, tmp_dir=None):
+    """
+    Sort the csv at input_csv by grouping_keys into output_csv without holding it all in memory:
+    sorted runs of run_rows rows are spilled to temporary csvs and then k-way merged.
+    Stops with the same grouping_keys stay in their original order
+    """
+    header = pd.read_csv(input_csv, nrows=0).columns.to_list()
+    key_idx = [header.index(key) for key in grouping_keys]
+    run_dir = tempfile.mkdtemp(prefix='external_sort_', dir=tmp_dir)
+    try:
+        run_files = spill_sorted_runs(input_csv, grouping_keys, run_dir, run_rows)
+        # heapq.merge breaks ties in the order of the runs, which keeps the merge stable
+        merged = heapq.merge(*[read_run_rows(run_file) for run_file in run_files], key=lambda row: [row[i] for i in key_idx])
+        with open(output_csv, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(merged)
+    finally:
+        shutil.rmtree(run_dir)
+    log(f'Wrote {input_csv} sorted by {grouping_keys} to {output_csv}')
+
+def iter_driver_groups(sorted_csv, grouping_keys, chunksize=100000, dtype=None):
+    """
+    Given a csv sorted by grouping_keys, yield (name, entries) one driver at a time, where name is the
+    tuple of the driver's grouping_keys values and entries is the dataframe of their stops, like
+    iterating over a pandas groupby on grouping_keys. The grouping_keys are read as strings exactly as
+    spill_sorted_runs wrote them (names like "NA", "NULL" or "" aren't turned into nan, which would split
+    or merge drivers), and the other columns with pandas' default parsing
+    """
+    dtype = dict(dtype) if dtype is not None else {}
+    dtype.update({key: str for key in grouping_keys})
+    columns = pd.read_csv(sorted_csv, nrows=0).columns
+    na_values = {col: list(STR_NA_VALUES) for col in columns if col not in grouping_keys}
+    carry = None # stops of the last driver of the previous chunk, who may continue in the next chunk
+    for chunk in pd.read_csv(sorted_csv, chunksize=chunksize, dtype=dtype, keep_default_na=False, na_values=na_values):
+        if len(chunk) == 0:
+            continue
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        keys = chunk[grouping_keys]
+        new_driver = (keys != keys.shift()).any(axis=1).to_numpy()
+        starts = np.flatnonzero(new_driver)
+        for start, end in zip(starts[:-1], starts[1:]):
+            entries = chunk.iloc[start:end]
+            yield tuple(entries[grouping_keys].iloc[0]), entries
+        carry = chunk.iloc[starts[-1]:]
+    if carry is not None and len(carry) > 0:
+        yield tuple(carry[grouping_keys].iloc[0]), carry
+
+class SortedDriverGroups:
+    """
+    Disk-backed stand-in for the DataFrameGroupBy returned by group_df_by: iterating over it
+    streams (name, entries) one driver at a time from a csv sorted by grouping_keys, so it can be
+    passed to check_cond, generate_person_race_dict, calc_racial_ambig, enumerate_racial_ambig and ttest_paired.
+    obj only holds the columns (no rows), for the functions that look up which columns exist
+    """
+    def __init__(self, sorted_csv, grouping_keys, chunksize=100000, dtype=None):
+        self.sorted_csv = sorted_csv
+        self.grouping_keys = grouping_keys
+        self.chunksize = chunksize
+        self.dtype = dtype
+        self.obj = pd.read_csv(sorted_csv, nrows=0)
+
+    def __iter__(self):
+        return iter_driver_groups(self.sorted_csv, self.grouping_keys, self.chunksize, self.dtype)
+
+def check_sorted_groups(input_csv, sorted_groups, dtype=None):
+    """
+    Round-trip check of the streamed groups against the in-memory groupby of input_csv (read with its
+    grouping_keys as strings, the same way): assert they have the same drivers, in the same order, with the same
+    stops in the same order. Loads input_csv, so it's meant for checking the external sort on a sample
+    """
+    grouping_keys = sorted_groups.grouping_keys
+    dtype = dict(dtype) if dtype is not None else {}
+    dtype.update({key: str for key in grouping_keys})
+    columns = pd.read_csv(input_csv, nrows=0).columns
+    na_values = {col: list(STR_NA_VALUES) for col in columns if col not in grouping_keys}
+    d = pd.read_csv(input_csv, dtype=dtype, keep_default_na=False, na_values=na_values)
+    in_memory = d.groupby(grouping_keys, sort=True)
+    num_drivers = 0
+    for (name, entries), (expected_name, expected_entries) in zip(sorted_groups, in_memory):
+        assert name == expected_name, f'{name} != {expected_name}'
+        pd.testing.assert_frame_equal(entries.reset_index(drop=True), expected_entries.reset_index(drop=True))
+        num_drivers += 1
+    assert num_drivers == in_memory.ngroups, f'{num_drivers} streamed drivers != {in_memory.ngroups} drivers'
+    log(f'The {num_drivers} streamed drivers of {sorted_groups.sorted_csv} match the groupby of {input_csv}')
+
+def sort_and_group_csv(input_csv, grouping_keys, sorted_csv, run_rows=1000000, chunksize=100000):
+    """
+    External sort input_csv by grouping_keys into sorted_csv (unless it already exists)
+    and return the SortedDriverGroups over it
+    """
+    if os.path.isfile(sorted_csv):
+        log(f"{sorted_csv} already exists, NO CHANGE")
+    else:
+        external_sort_csv(input_csv, grouping_keys, sorted_csv, run_rows)
+    return SortedDriverGroups(sorted_csv, grouping_keys, chunksize)
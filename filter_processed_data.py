@@ -2,6 +2,7 @@ import pandas as pd
 import os
 import hashlib
 from pathlib import Path
+from run_report import log
 
 
 def safe_hash_convert(x):
@@ -19,26 +20,26 @@ def anonymize_ids(df):
     """
     for col in ['officer_id', 'driver_id']:
         if col in df:
-            print(f'MD5 hashing {col}')
-            print('Original column info:')
-            print(f'Data type: {df[col].dtype}')
-            print(f'Sample values: {df[col].head(10).tolist()}')
-            print(f'Unique values: {df[col].nunique()}')
+            log(f'MD5 hashing {col}')
+            log('Original column info:')
+            log(f'Data type: {df[col].dtype}')
+            log(f'Sample values: {df[col].head(10).tolist()}')
+            log(f'Unique values: {df[col].nunique()}')
 
             # Create hashed version without changing original
             hashed_col = f'{col}_hash'
             df[hashed_col] = df[col].apply(lambda x: hashlib.md5(safe_hash_convert(x).encode()).hexdigest() if safe_hash_convert(x) is not None else None)
-            print(f'\nCreated {hashed_col} column')
-            print(f'Unique hashed values: {df[hashed_col].nunique()}')
-            print(f'Original unique values: {df[col].nunique()}')
-            print(f'Difference: {df[hashed_col].nunique() - df[col].nunique()}')
+            log(f'\nCreated {hashed_col} column')
+            log(f'Unique hashed values: {df[hashed_col].nunique()}')
+            log(f'Original unique values: {df[col].nunique()}')
+            log(f'Difference: {df[hashed_col].nunique() - df[col].nunique()}')
             
-            print('Replacing original column with hashed column')
+            log('Replacing original column with hashed column')
             # Replace the original column with the hashed column
             df[col] = df[hashed_col]
         else:
-            print(f'Skipping col {col} - does not exist in this df')
-    print(df.head(10))
+            log(f'Skipping col {col} - does not exist in this df')
+    log(df.head(10))
     return df
 
 def int_or_none(x):
@@ -71,7 +72,7 @@ def filter_processed_csv_columns():
     column_sets = {}
     file_info = {}
 
-    print("Reading CSV files and extracting column information...")
+    log("Reading CSV files and extracting column information...")
 
     # Read in each CSV file and get its columns
     for file_path in csv_files:
@@ -85,20 +86,21 @@ def filter_processed_csv_columns():
                     'column_count': len(columns),
                     'file_size_mb': os.path.getsize(file_path) / (1024 * 1024)
                 }
-                print(f'Columns in file: {columns}:')
-                print(f"✓ {file_path}: {len(columns)} columns, {file_info[file_path]['file_size_mb']:.1f} MB")
+                log(f'Columns in file: {columns}:')
+                log(f"✓ {file_path}: {len(columns)} columns, {file_info[file_path]['file_size_mb']:.1f} MB")
             except Exception as e:
-                print(f"✗ Error reading {file_path}: {e}")
+                log(f"✗ Error reading {file_path}: {e}")
         else:
-            print(f"✗ File not found: {file_path}")
+            log(f"✗ File not found: {file_path}")
 
     # Columns to keep in the processed csvs if they exist
     cols_to_keep = {'violation', 'search_conducted', 'county_name', 'stop_duration', 'officer_id',
                     'state', 'driver_race', 'stop_time','is_arrested', 'driver_id', 
-                    'county_fips', 'stop_date', 'contraband_found', 'date', 'time'}
+                    'county_fips', 'stop_date', 'contraband_found', 'date', 'time',
+                    'hour_of_day', 'stop_year', 'stop_month', 'stop_quarter', 'weekday', 'stop_hour_categorical', 'stop_seq'}
 
 
-    print(f"\n=== CREATING FILTERED CSV FILES ===")
+    log(f"\n=== CREATING FILTERED CSV FILES ===")
     output_dir = "csv/processed/"
     os.makedirs(output_dir, exist_ok=True)
 
@@ -109,13 +111,13 @@ def filter_processed_csv_columns():
                 # Read the file with only intersecting columns
                 df = pd.read_csv(file_path, usecols=list(intersect_columns))
                 if (file_path.startswith('csv/tx')):
-                    print('Standardizing texas driver and officer ids')
+                    log('Standardizing texas driver and officer ids')
                     for col in ['driver_id', 'officer_id']:
                         df[col] = df[col].map(lambda x: int_or_none(x)).astype('Int64')
 
                 anonymized_df = anonymize_ids(df)
-                print('Anonymized df')
-                print(anonymized_df.head(10))
+                log('Anonymized df')
+                log(anonymized_df.head(10))
 
                 # Create output filename
                 filename = os.path.basename(file_path)
@@ -123,10 +125,10 @@ def filter_processed_csv_columns():
 
                 # Save filtered CSV
                 anonymized_df.to_csv(output_path, index=False, quotechar='"')
-                print(f"✓ Created: {output_path} ({len(df)} rows) and the following columns:{intersect_columns}")
+                log(f"✓ Created: {output_path} ({len(df)} rows) and the following columns:{intersect_columns}")
 
             except Exception as e:
-                print(f"✗ Error processing {file_path}: {e}")
+                log(f"✗ Error processing {file_path}: {e}")
 
 if __name__ == "__main__":
     filter_processed_csv_columns()
\ No newline at end of file
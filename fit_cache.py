@@ -0,0 +1,128 @@
+import os
+import json
+import pickle
+import hashlib
+import pandas as pd
+from policing_data_expl import regress, regress_model_str, race_pair_races
+from run_report import log
+
+# Disk-backed cache of regress fits, keyed by a content hash of the panel columns the fit uses,
+# the formula, the fixed effects and the estimator options, so refitting an unchanged
+# regression (ex. to replot make_sensitivity_dot_plot after a cosmetic change) is instant
+
+FIT_CACHE_DIR = 'csv/fit_cache/'
+FIT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+class FitSummary:
+    """
+    Compact summary of a fitted regress model: everything make_sensitivity_dot_plot and the
+    regression tables read from the linearmodels results (params, cov, conf_int(), nobs, model_name)
+    """
+    def __init__(self, params, cov, conf_int_table, nobs, model_name, summary_text):
+        self.params = params
+        self.cov = cov
+        self.conf_int_table = conf_int_table
+        self.nobs = nobs
+        self.model_name = model_name
+        self.summary_text = summary_text
+
+    def conf_int(self):
+        return self.conf_int_table
+
+    @property
+    def std_errors(self):
+        return pd.Series(self.cov.to_numpy().diagonal() ** 0.5, index=self.params.index)
+
+def summarize_fit(res, model_name):
+    """
+    Return the FitSummary of a linearmodels results object
+    """
+    return FitSummary(res.params, res.cov, res.conf_int(), res.nobs, model_name, str(res.summary))
+
+def regress_used_cols(dep_var, cols, stop_date_col='stop_date', driver_race_col='driver_race', stop_time_col='stop_time', panel_cols=()):
+    """
+    The columns of the panel (with columns panel_cols) that regress reads for these arguments
+    """
+    # regress's time index is stop_seq if the panel has it (see panel_time_col), otherwise stop_date_col
+    used_cols = ['race_str', 'driver_id', driver_race_col, dep_var, 'stop_seq' if 'stop_seq' in panel_cols else stop_date_col]
+    for col in cols:
+        # hour_of_day is read from the panel if add_time_features added it, otherwise it's computed from stop_time
+        used_cols.append(stop_time_col if col == 'hour_of_day' and 'hour_of_day' not in panel_cols else col)
+    return list(dict.fromkeys(used_cols)) # remove duplicates, keep the order
+
+def fit_cache_key(stategrouped_with_race_str, dep_var, cols, controls, useFixedEffects=True, stop_date_col='stop_date',
+                  driver_race_col='driver_race', stop_time_col='stop_time', drop_absorbed=False, race_pair='Hispanic_White'):
+    """
+    Return the cache key of a regress call: a sha256 of the content of the columns it uses,
+    the formula, the fixed effects and the estimator options (model_name is only a label, so it isn't part of the key)
+    """
+    used_cols = regress_used_cols(dep_var, cols, stop_date_col, driver_race_col, stop_time_col, stategrouped_with_race_str.columns)
+    h = hashlib.sha256()
+    h.update(pd.util.hash_pandas_object(stategrouped_with_race_str[used_cols], index=False).to_numpy().tobytes())
+    spec = {
+        'used_cols': used_cols,
+        'cols': list(cols),
+        'formula': regress_model_str(dep_var, controls, useFixedEffects, race_pair_races(race_pair)[0]),
+        'race_pair': race_pair,
+        'fixed_effects': ['driver_id'] if useFixedEffects else [],
+        'estimator': 'PanelOLS',
+        'drop_absorbed': drop_absorbed
+    }
+    h.update(json.dumps(spec, sort_keys=True).encode())
+    return h.hexdigest()
+
+def evict_fit_cache(cache_dir=FIT_CACHE_DIR, max_bytes=FIT_CACHE_MAX_BYTES):
+    """
+    Delete the least recently used entries until the cache takes up at most max_bytes
+    """
+    entries = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.pkl')]
+    entries.sort(key=os.path.getmtime) # cache hits touch their entry, so the oldest mtime is the least recently used
+    total_bytes = sum(os.path.getsize(e) for e in entries)
+    for entry in entries:
+        if total_bytes <= max_bytes:
+            break
+        total_bytes -= os.path.getsize(entry)
+        os.remove(entry)
+        log(f'Evicted {entry} from the fit cache')
+
+def cached_regress(stategrouped_with_race_str, dep_var, cols, controls, model_name, cache_dir=FIT_CACHE_DIR, max_bytes=FIT_CACHE_MAX_BYTES, **regress_kwargs):
+    """
+    Cached version of regress (same arguments, plus the cache_dir and its max size in bytes):
+    return the FitSummary of the fit, only running regress if this data and spec haven't been fit before
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = fit_cache_key(stategrouped_with_race_str, dep_var, cols, controls, **regress_kwargs)
+    entry = os.path.join(cache_dir, key + '.pkl')
+    if os.path.isfile(entry):
+        log(f'Fit cache hit for {model_name} ({key[:12]})')
+        with open(entry, 'rb') as f:
+            summary = pickle.load(f)
+        os.utime(entry) # mark as recently used
+        summary.model_name = model_name
+        return summary
+
+    res = regress(stategrouped_with_race_str, dep_var, cols, controls, model_name, **regress_kwargs)
+    summary = summarize_fit(res, model_name)
+    # write to a temporary file first so a crash never leaves a partial entry
+    # (one per process, since render_figures' workers fit in parallel)
+    tmp_entry = f'{entry}.{os.getpid()}.tmp'
+    with open(tmp_entry, 'wb') as f:
+        pickle.dump(summary, f)
+    os.replace(tmp_entry, entry)
+    evict_fit_cache(cache_dir, max_bytes)
+    return summary
+
+def cached_sensitivity_fits(stategrouped_with_race_str, specs, cache_dir=FIT_CACHE_DIR, max_bytes=FIT_CACHE_MAX_BYTES):
+    """
+    Fit (or load from the cache) each spec in specs, a list of dictionaries of regress arguments
+    (dep_var, cols, controls, model_name and optionally the keyword arguments), and return the list
+    of FitSummary objects to pass to make_sensitivity_dot_plot
+    """
+    return [cached_regress(stategrouped_with_race_str, cache_dir=cache_dir, max_bytes=max_bytes, **spec) for spec in specs]
+
+def sensitivity_fit_keys(stategrouped_with_race_str, specs):
+    """
+    Return the cache keys of the fits of cached_sensitivity_fits (without fitting anything), which identify
+    the fits' data and specs so a plot of them can be hashed before they are fit
+    """
+    return [fit_cache_key(stategrouped_with_race_str, **{arg: value for arg, value in spec.items() if arg != 'model_name'}) for spec in specs]
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+from policing_data_expl import standardize_cols, read_csv_in_year_window, outcome_as_float, within_driver_difference
+from run_report import log
+
+# Evaluate many candidate driver-identity definitions (grouping_keys) in one pass over the raw data:
+# the raw file is read and standardized once, and driver ids, 2-10 stop eligibility and Hispanic-white
+# counts are computed for every variant, reusing the driver ids of a coarser variant when one key set refines another.
+#
+# Example (arizona):
+#     state_data = read_standardized_state('AZ', 'path-to-raw-csv', all_keys)
+#     compare_grouping_key_variants(state_data, {
+#         '_Name': ['SubjectFirstName', 'SubjectLastName'],
+#         '_Style': ['SubjectFirstName', 'SubjectLastName', 'VehicleStyle'],
+#         '_Style_Year': ['SubjectFirstName', 'SubjectLastName', 'VehicleStyle', 'VehicleYear']
+#     })
+
+def read_standardized_state(state, raw_csv, key_union, year_window=None, chunksize=1000000):
+    """
+    Read the raw state csv once (the grouping keys of every variant as strings)
+    and standardize it with standardize_cols; for texas, year_window filters the rows while reading
+    """
+    dtypes_dict = {k: str for k in key_union}
+    if year_window is not None:
+        dtypes_dict['date'] = str
+        state_data = read_csv_in_year_window(raw_csv, 'date', year_window, chunksize=chunksize, dtype=dtypes_dict)
+    else:
+        state_data = pd.read_csv(raw_csv, dtype=dtypes_dict)
+    return standardize_cols(state, state_data)
+
+def combine_codes(codes, key_codes):
+    """
+    Given the driver codes of a coarser key set and the codes of one more key (both -1 where null),
+    return the codes of the finer key set (0 to #groups - 1, -1 where either is null)
+    """
+    valid = (codes >= 0) & (key_codes >= 0)
+    combined = np.full(len(codes), -1, dtype=np.int64)
+    # codes and key_codes are both below the number of rows, so this can't overflow int64
+    combined[valid] = pd.factorize(codes[valid] * (key_codes.max() + 1) + key_codes[valid])[0]
+    return combined
+
+def variant_stats(driver_codes, race_codes, race_categories, outcome, min_stops=2, max_stops=10):
+    """
+    Return the driver counts, inconsistency rate and Hispanic-white search rates
+    for one variant's driver codes (-1 for stops that aren't grouped)
+    """
+    grouped = driver_codes >= 0
+    codes = driver_codes[grouped]
+    races = race_codes[grouped]
+    y = outcome[grouped]
+    stops_per_driver = np.bincount(codes)
+    eligible_driver = (stops_per_driver >= min_stops) & (stops_per_driver <= max_stops)
+
+    # each race is a bit (in alphabetical order), so a driver's race mask is the set of races of their stops
+    race_mask = np.zeros(len(stops_per_driver), dtype=np.int64)
+    np.bitwise_or.at(race_mask, codes, np.left_shift(1, races))
+    num_races = np.zeros(len(race_mask), dtype=np.int64)
+    for bit in range(len(race_categories)):
+        num_races += (race_mask >> bit) & 1
+    hispanic_white_mask = (1 << race_categories.index('Hispanic')) | (1 << race_categories.index('White'))
+    inconsistent_driver = eligible_driver & (num_races > 1)
+    hispanic_white_driver = eligible_driver & (race_mask == hispanic_white_mask)
+
+    hispanic_white_stop = hispanic_white_driver[codes]
+    hispanic_stop = hispanic_white_stop & (races == race_categories.index('Hispanic'))
+    white_stop = hispanic_white_stop & (races == race_categories.index('White'))
+    hispanic_search_rate = np.nanmean(y[hispanic_stop]) if hispanic_stop.any() else np.nan
+    white_search_rate = np.nanmean(y[white_stop]) if white_stop.any() else np.nan
+    hw_rows = hispanic_white_stop & ~np.isnan(y)
+    coef, std_err = within_driver_difference(pd.factorize(codes[hw_rows])[0], hispanic_stop[hw_rows], y[hw_rows]) if hw_rows.any() else (np.nan, np.nan)
+
+    num_multiply_stopped = int(eligible_driver.sum())
+    return {
+        'stops': int(grouped.sum()),
+        'drivers': len(stops_per_driver),
+        'multiply_stopped_drivers': num_multiply_stopped,
+        'multiply_stopped_stops': int(eligible_driver[codes].sum()),
+        'inconsistent_drivers': int(inconsistent_driver.sum()),
+        'inconsistency_rate': inconsistent_driver.sum() / num_multiply_stopped if num_multiply_stopped > 0 else np.nan,
+        'hispanic_white_drivers': int(hispanic_white_driver.sum()),
+        'hispanic_white_stops': int(hispanic_white_stop.sum()),
+        'hispanic_search_rate': hispanic_search_rate,
+        'white_search_rate': white_search_rate,
+        'search_rate_difference': hispanic_search_rate - white_search_rate,
+        'within_driver_difference': coef,
+        'within_driver_std_err': std_err
+    }
+
+def compare_grouping_key_variants(state_data, variants, outcome_col='search_conducted', driver_race_col='driver_race', min_stops=2, max_stops=10):
+    """
+    Given the standardized state data and a dictionary of variant name (ex. '_Style_Year') -> grouping_keys,
+    return a comparison table with a row per variant of the driver counts, inconsistency rate and the
+    Hispanic - white search rate difference (of the stop rates and the driver fixed effects estimate).
+    Like group_df_by, only the stops with non-null grouping keys, driver race and outcome are grouped
+    """
+    base_valid = (state_data[driver_race_col].notnull() & state_data[outcome_col].notnull()).to_numpy()
+    race_codes, race_categories = pd.factorize(state_data[driver_race_col], sort=True)
+    race_categories = race_categories.to_list()
+    outcome = outcome_as_float(state_data[outcome_col]).to_numpy()
+
+    key_codes = {} # each key column is factorized once and shared across variants
+    driver_codes = {} # tuple of sorted keys -> driver codes
+    rows = []
+    # coarser key sets first, so finer ones can start from their driver codes
+    for name, grouping_keys in sorted(variants.items(), key=lambda item: len(item[1])):
+        keys = frozenset(grouping_keys)
+        parents = [parent for parent in driver_codes if parent < keys]
+        if len(parents) > 0:
+            parent = max(parents, key=len)
+            codes = driver_codes[parent]
+            log(f'{name}: refining {sorted(parent)} with {sorted(keys - parent)}')
+        else:
+            parent = frozenset()
+            codes = np.where(base_valid, 0, -1).astype(np.int64)
+        for key in sorted(keys - parent):
+            if key not in key_codes:
+                key_codes[key] = pd.factorize(state_data[key])[0].astype(np.int64)
+            codes = combine_codes(codes, key_codes[key])
+        driver_codes[keys] = codes
+
+        stats = variant_stats(codes, race_codes, race_categories, outcome, min_stops, max_stops)
+        stats['variant'] = name
+        stats['grouping_keys'] = ', '.join(grouping_keys)
+        log(f"{name}: {stats['multiply_stopped_drivers']} multiply-stopped drivers, {stats['hispanic_white_drivers']} Hispanic-white drivers")
+        rows.append(stats)
+    # keep the order of the variants that were passed in
+    return pd.DataFrame(rows).set_index('variant').loc[list(variants.keys())]
@@ -0,0 +1,143 @@
+import pandas as pd
+from policing_data_expl import *
+from run_report import new_run_report, stage, write_run_report
+
+# Single-scan Python version of make_descriptive_stats_table.R: each table is streamed once
+# in chunks, accumulating the counts and outcome sums, and the same LaTeX table is rendered from them
+
+state_data = {
+    'az': {
+        'Raw': 'path-to-AZ-data.csv',
+        'Filtered': 'csv/az_grouped_Style_Year.csv',
+        'Hispanic_White': 'csv/az_hispanic_white_drivers_Style_Year.csv'
+    },
+    'co': {
+        'Raw': 'path-to-CO-data.csv',
+        'Filtered': 'csv/co_grouped_mod_officer_id.csv',
+        'Hispanic_White': 'csv/co_hispanic_white_drivers_only_mod.csv'
+    },
+    'tx': {
+        'Raw': 'path-to-TX-data.csv',
+        'Filtered': 'csv/tx_processed_grouped_driver_race_raw.csv',
+        'Hispanic_White': 'csv/tx_processed_hispanic_white_drivers_driver_race.csv'
+    }
+}
+
+# driver-identifying columns for each state (driver_race is checked for completeness separately)
+state_cols = {
+    'az': ['SubjectFirstName', 'SubjectLastName', 'VehicleStyle', 'VehicleYear'],
+    'co': ['driver_first_name', 'driver_last_name', 'DOB'],
+    'tx': ['HA_N_FIRST_DRVR', 'HA_N_LAST_DRVR', 'HA_A_ADDRESS_DRVR', 'HA_A_CITY_DRVR', 'HA_A_STATE_DRVR', 'HA_A_ZIP_DRVR']
+}
+
+abbrev = {'az': 'Arizona', 'co': 'Colorado', 'tx': 'Texas', 'overall': 'Overall'}
+chunksize = 1000000
+tx_year_window = (2016, np.inf) # like make_descriptive_stats_table.R, only keep the texas stops from 2016 on
+output_tex = 'plots/descriptive_stats_table_mod_co_two_fix_functions.tex'
+
+def read_chunks(filepath, usecols, dtype=None, state=None):
+    """
+    Yield the csv at filepath chunksize rows at a time, only reading the columns in usecols
+    If state is not None, standardize each chunk with standardize_cols (for the raw data)
+    """
+    for chunk in pd.read_csv(filepath, usecols=usecols, dtype=dtype, chunksize=chunksize,
+                             na_values=NULL_STRINGS, keep_default_na=False):
+        if state is not None:
+            chunk = standardize_cols(state.upper(), chunk, year_window=tx_year_window)
+        yield chunk
+
+def raw_usecols(state):
+    """
+    Columns of the raw data needed to standardize it and check for complete rows
+    """
+    if state == 'tx':
+        return state_cols[state] + ['driver_race_raw', 'search_conducted', 'date']
+    return state_cols[state] + ['driver_race', 'search_conducted']
+
+def calculate_state_counts(state, run_report):
+    """
+    Stream the Raw, Filtered and Hispanic_White tables of the state once each and return their counts
+    """
+    counts = {}
+    paths = state_data[state]
+    with stage(run_report, f'{state}_raw') as s:
+        dtype = {k: str for k in raw_usecols(state)}
+        counts['Raw'] = stream_complete_counts(read_chunks(paths['Raw'], raw_usecols(state), dtype, state), state_cols[state])
+        s['rows_out'] = counts['Raw']['stops']
+    with stage(run_report, f'{state}_filtered') as s:
+        counts['Filtered'] = stream_multiply_stopped_counts(read_chunks(paths['Filtered'], ['driver_id', 'driver_race']))
+        s['rows_out'] = counts['Filtered']['stops']
+    with stage(run_report, f'{state}_hispanic_white') as s:
+        counts['Hispanic_White'] = stream_hispanic_white_counts(read_chunks(paths['Hispanic_White'], ['driver_id', 'driver_race', 'search_conducted']))
+        s['rows_out'] = counts['Hispanic_White']['stops']
+    log(state, counts)
+    return counts
+
+def sum_counts(counts_lst):
+    """
+    Add up the counts of each state for the overall column (driver ids are unique to each state, so counts add up)
+    """
+    overall = {}
+    for data_type in ['Raw', 'Filtered', 'Hispanic_White']:
+        overall[data_type] = {k: sum(counts[data_type][k] for counts in counts_lst) for k in counts_lst[0][data_type]}
+    return overall
+
+def comma(x):
+    return f'{int(x):,}'
+
+def percent(x):
+    return f'{100 * x:.1f}\\%'
+
+def make_latex_table(counts_per_state):
+    """
+    Render the descriptive stats table from the counts of each state (and overall),
+    with the same rows and layout as make_descriptive_stats_table.R
+    """
+    states = list(counts_per_state.keys())
+    def row(description, values):
+        return description + ' & ' + ' & '.join(values) + ' \\\\ \n'
+    def count_row(description, data_type, key):
+        return row(description, [comma(counts_per_state[s][data_type][key]) for s in states])
+    def percent_row(description, frac_type, frac_key, whole_type, whole_key):
+        return '\\midrule\n' + row(description, [percent(counts_per_state[s][frac_type][frac_key] / counts_per_state[s][whole_type][whole_key]) for s in states])
+    def search_rate_row(description, race):
+        return row(description, [percent(counts_per_state[s]['Hispanic_White'][f'{race}_sum'] / counts_per_state[s]['Hispanic_White'][f'{race}_n']) for s in states])
+    def section(title):
+        return '\\toprule\n\\multicolumn{5}{l}{\\textbf{' + title + '}}\\\\\n\\toprule\n'
+
+    r = '\\begin{table*}[ht]\n\\centering\n'
+    r += '\\caption{Descriptive Statistics for Drivers in Arizona, Colorado, and Texas} \n\\label{tab:descriptive_stats}\n'
+    r += '\\begin{tabular*}{1.02\\textwidth}{@{}p{6.3cm}llll@{}}\n  \\toprule\n'
+    r += row('', ['\\textbf{' + abbrev[s] + '}' for s in states]) + '  \\midrule\n'
+    r += section('Full dataset')
+    r += count_row('Drivers', 'Raw', 'drivers')
+    r += '\\midrule\n' + count_row('Stops', 'Raw', 'stops') + '  \\midrule\n'
+    r += section('Multiply-stopped drivers')
+    r += count_row(' Drivers', 'Filtered', 'drivers')
+    r += percent_row('\\% of all drivers', 'Filtered', 'drivers', 'Raw', 'drivers')
+    r += ' \\midrule\n' + count_row(' Stops', 'Filtered', 'stops')
+    r += percent_row('\\% of all stops', 'Filtered', 'stops', 'Raw', 'stops')
+    r += '\\midrule' + section('Multiply-stopped drivers with inconsistently perceived race')
+    r += count_row(' Drivers', 'Filtered', 'racially_discordant_drivers')
+    r += percent_row('\\% of all multiply-stopped drivers', 'Filtered', 'racially_discordant_drivers', 'Filtered', 'drivers')
+    r += ' \\midrule\n' + count_row(' Stops', 'Filtered', 'racially_discordant_stops')
+    r += percent_row('\\% of all multiply-stopped driver stops', 'Filtered', 'racially_discordant_stops', 'Filtered', 'stops')
+    r += '\\midrule' + section('Drivers perceived as both white and Hispanic')
+    r += count_row(' Drivers', 'Hispanic_White', 'drivers')
+    r += percent_row('\\% of inconsistently-perceived drivers', 'Hispanic_White', 'drivers', 'Filtered', 'racially_discordant_drivers')
+    r += ' \\midrule\n' + count_row(' Stops', 'Hispanic_White', 'stops')
+    r += percent_row('\\% of inconsistently-perceived driver stops', 'Hispanic_White', 'stops', 'Filtered', 'racially_discordant_stops')
+    r += ' \\midrule\n' + search_rate_row(' Search rate when perceived as Hispanic', 'Hispanic')
+    r += ' \\midrule\n' + search_rate_row(' Search rate when perceived as white', 'White')
+    r += ' \\bottomrule\n\\end{tabular*}\n\\end{table*}\n'
+    return r
+
+if __name__ == "__main__":
+    run_report = new_run_report('descriptive_stats')
+    counts_per_state = {state: calculate_state_counts(state, run_report) for state in ['az', 'co', 'tx']}
+    counts_per_state['overall'] = sum_counts(list(counts_per_state.values()))
+    latex_table = make_latex_table(counts_per_state)
+    log(latex_table)
+    with open(output_tex, 'w') as f:
+        f.write(latex_table)
+    write_run_report(run_report, 'csv/descriptive_stats_run_report')
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+from policing_data_expl import outcome_as_float
+from run_report import log
+
+# Officer-level within-driver disparities on the Hispanic-white panel: for every officer at once,
+# the Hispanic - white difference in the outcome among the stops they made, after removing each
+# driver's mean (the driver fixed effects of regress), with empirical-Bayes shrinkage across officers.
+# Everything is computed from per (officer, driver) sums, so new stops can be added incrementally, and each
+# officer's sums are reduced over their segment of a CSR-style officer index of the cells.
+
+CELL_SUMS = ['n', 's_h', 's_y', 's_hy', 's_yy']
+
+def build_officer_index(d, officer_col='officer_id'):
+    """
+    Return a CSR-style index from officer to the positions of their stops (or cells) in d:
+    officers[i]'s stops are the rows d.iloc[rows[indptr[i]:indptr[i + 1]]]. Stops with no officer aren't indexed
+    """
+    officer_codes, officers = pd.factorize(d[officer_col])
+    has_officer = np.flatnonzero(officer_codes >= 0)
+    rows = has_officer[np.argsort(officer_codes[has_officer], kind='stable')]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(officer_codes[has_officer], minlength=len(officers)))])
+    return {'officers': officers, 'indptr': indptr, 'rows': rows}
+
+def officer_stops(d, officer_index, officer):
+    """
+    Return the stops of the officer using the officer index of d
+    """
+    i = officer_index['officers'].get_loc(officer)
+    return d.iloc[officer_index['rows'][officer_index['indptr'][i]:officer_index['indptr'][i + 1]]]
+
+def officer_cell_stats(d, dep_var='search_conducted', officer_col='officer_id', driver_col='driver_id', driver_race_col='driver_race'):
+    """
+    Return the sums needed for the officer estimates, per (officer, driver) cell: the number of stops n,
+    and the sums of the Hispanic indicator h, the outcome y, h * y and y^2. Stops with no officer are kept
+    (under a null officer) since they still count towards their driver's means. Stops with a null outcome are dropped
+    """
+    y = outcome_as_float(d[dep_var])
+    keep = y.notnull().to_numpy()
+    h = (d[driver_race_col] == 'Hispanic').to_numpy(dtype=float)[keep]
+    y = y.to_numpy()[keep]
+    stops = pd.DataFrame({
+        'officer_id': d[officer_col].to_numpy()[keep],
+        'driver_id': d[driver_col].to_numpy()[keep],
+        'n': 1,
+        's_h': h,
+        's_y': y,
+        's_hy': h * y,
+        's_yy': y * y
+    })
+    return stops.groupby(['officer_id', 'driver_id'], dropna=False, sort=False)[CELL_SUMS].sum()
+
+def update_officer_cell_stats(cells, new_stops, dep_var='search_conducted', **col_kwargs):
+    """
+    Add the new stops to the cell sums (the sums of existing cells are updated, new cells are appended)
+    """
+    new_cells = officer_cell_stats(new_stops, dep_var, **col_kwargs)
+    return pd.concat([cells, new_cells]).groupby(level=['officer_id', 'driver_id'], dropna=False, sort=False).sum()
+
+def empirical_bayes_shrink(estimates, std_errs):
+    """
+    Shrink the estimates towards their precision-weighted mean under a normal prior whose variance is
+    estimated with the DerSimonian-Laird method of moments. Return the shrunk estimates, their posterior
+    standard deviations, and the prior mean, its standard error and the prior variance.
+    The posterior standard deviations include the uncertainty of the estimated prior mean, so when the prior
+    variance is 0 (every estimate shrunk all the way to the prior mean) they are the prior mean's standard error
+    """
+    w = 1 / std_errs ** 2
+    fixed_mean = np.sum(w * estimates) / np.sum(w)
+    q = np.sum(w * (estimates - fixed_mean) ** 2)
+    prior_var = max(0., (q - (len(estimates) - 1)) / (np.sum(w) - np.sum(w ** 2) / np.sum(w)))
+    w_random = 1 / (std_errs ** 2 + prior_var)
+    prior_mean = np.sum(w_random * estimates) / np.sum(w_random)
+    prior_mean_var = 1 / np.sum(w_random)
+    shrinkage = prior_var / (prior_var + std_errs ** 2) # 0 = all the way to the prior mean, 1 = no shrinkage
+    shrunk = prior_mean + shrinkage * (estimates - prior_mean)
+    posterior_var = shrinkage * std_errs ** 2 + (1 - shrinkage) ** 2 * prior_mean_var
+    return shrunk, np.sqrt(posterior_var), prior_mean, np.sqrt(prior_mean_var), prior_var
+
+def officer_within_driver_disparity(cells, min_stops=1):
+    """
+    From the cell sums, return a dataframe with a row per officer (with at least min_stops stops) of
+    their number of stops and drivers, the within-driver Hispanic - white difference among their stops
+    (the slope of the driver-demeaned outcome on the driver-demeaned Hispanic indicator), its standard error,
+    and the empirical-Bayes shrunk estimate and standard error. Officers whose stops have no within-driver
+    variation in perceived race have no estimate. The residual variance is pooled across officers
+    """
+    cells = cells.reset_index()
+    # driver means over all of the driver's stops
+    driver_codes, _ = pd.factorize(cells['driver_id'])
+    driver_n = np.bincount(driver_codes, weights=cells['n'])
+    h_bar = (np.bincount(driver_codes, weights=cells['s_h']) / driver_n)[driver_codes]
+    y_bar = (np.bincount(driver_codes, weights=cells['s_y']) / driver_n)[driver_codes]
+
+    # sums of the driver-demeaned h and y over each cell (h is binary, so the sum of h^2 is s_h)
+    n = cells['n'].to_numpy()
+    s_h = cells['s_h'].to_numpy()
+    s_y = cells['s_y'].to_numpy()
+    sxy = cells['s_hy'].to_numpy() - h_bar * s_y - y_bar * s_h + n * h_bar * y_bar
+    sxx = s_h - 2 * h_bar * s_h + n * h_bar ** 2
+    syy = cells['s_yy'].to_numpy() - 2 * y_bar * s_y + n * y_bar ** 2
+
+    # each officer's cells are a contiguous segment of the officer index (cells with no officer aren't indexed)
+    officer_index = build_officer_index(cells)
+    officers, rows, indptr = officer_index['officers'], officer_index['rows'], officer_index['indptr']
+    def officer_sum(x):
+        return np.add.reduceat(x[rows], indptr[:-1]) if len(officers) > 0 else np.zeros(0)
+    officer_n = officer_sum(n)
+    officer_sxy = officer_sum(sxy)
+    officer_sxx = officer_sum(sxx)
+    officer_syy = officer_sum(syy)
+    has_variation = officer_sxx > 1e-12
+    estimate = np.full(len(officers), np.nan)
+    estimate[has_variation] = officer_sxy[has_variation] / officer_sxx[has_variation]
+
+    # residual variance pooled over all stops (keeps small officers from having 0 standard errors),
+    # with a degree of freedom per driver mean and per officer slope
+    ssr = np.sum(syy) - np.sum(officer_sxy[has_variation] * estimate[has_variation])
+    dof = n.sum() - len(driver_n) - has_variation.sum()
+    residual_var = ssr / dof if dof > 0 else np.nan
+    std_err = np.full(len(officers), np.nan)
+    std_err[has_variation] = np.sqrt(residual_var / officer_sxx[has_variation])
+
+    table = pd.DataFrame({
+        'stops': officer_n.astype(int),
+        'drivers': np.diff(indptr),
+        'hispanic_stops': officer_sum(s_h).astype(int),
+        'estimate': estimate,
+        'std_err': std_err
+    }, index=pd.Index(officers, name='officer_id'))
+    table = table.loc[table['stops'] >= min_stops]
+
+    table['shrunk_estimate'] = np.nan
+    table['shrunk_std_err'] = np.nan
+    estimated = table['estimate'].notnull() & (table['std_err'] > 0)
+    if estimated.sum() > 1:
+        shrunk, shrunk_std_err, prior_mean, prior_mean_std_err, prior_var = empirical_bayes_shrink(table.loc[estimated, 'estimate'].to_numpy(), table.loc[estimated, 'std_err'].to_numpy())
+        table.loc[estimated, 'shrunk_estimate'] = shrunk
+        table.loc[estimated, 'shrunk_std_err'] = shrunk_std_err
+        table.attrs['prior_mean'] = prior_mean
+        table.attrs['prior_mean_std_err'] = prior_mean_std_err
+        table.attrs['prior_var'] = prior_var
+        log(f'{estimated.sum()} officers with an estimate; prior mean {prior_mean:.4f} ({prior_mean_std_err:.4f}), prior sd {np.sqrt(prior_var):.4f}')
+    return table
+
+def refresh_officer_disparity(cells, new_stops, dep_var='search_conducted', min_stops=1, **col_kwargs):
+    """
+    Add new stops to the cell sums and recompute every officer's estimates; return the new cells and officer table
+    """
+    cells = update_officer_cell_stats(cells, new_stops, dep_var, **col_kwargs)
+    return cells, officer_within_driver_disparity(cells, min_stops)
@@ -10,6 +10,7 @@ from IPython.display import display
 import statsmodels.api as sm
 import statsmodels.formula.api as smf
 from linearmodels.panel import PanelOLS
+from run_report import log
 
 # Functions used during the data exploration phase of the Policing Project
 
@@ -30,36 +31,127 @@ def calc_complete_cols(state_data, grouping_key_list, driver_race_col='driver_ra
     data_non_null = state_data[grouping_keys].notnull()
     data_complete_cols = data_non_null.all(axis=1) # only take the rows where all of these columns are complete
 
-    print("#rows of complete columns:", sum(data_complete_cols))
-    print(grouping_keys)
-    print("#groups:", state_data.loc[data_complete_cols].groupby(grouping_key_list).ngroups)
+    log("#rows of complete columns:", sum(data_complete_cols))
+    log(grouping_keys)
+    log("#groups:", state_data.loc[data_complete_cols].groupby(grouping_key_list).ngroups)
+
+# values considered null in the data (same as null_str in make_descriptive_stats_table.R)
+NULL_STRINGS = ["", "NaN", "NA", "N/A", "nan", "#N/A", "-NaN", "-n/a", "NULL"]
+
+def outcome_as_float(outcome):
+    """
+    Given a series of a boolean outcome (ex. search_conducted) that may have been read
+    as bools, 0/1s or 'True'/'False' strings, return it as floats with NaN for missing values
+    """
+    if pd.api.types.is_bool_dtype(outcome) or pd.api.types.is_numeric_dtype(outcome):
+        return outcome.astype(float)
+    return outcome.map({True: 1., False: 0., 'True': 1., 'False': 0., 'TRUE': 1., 'FALSE': 0., 1: 1., 0: 0.}).astype(float)
+
+def stream_complete_counts(chunks, grouping_key_list, driver_race_col='driver_race'):
+    """
+    Single-pass version of calc_complete_cols over an iterable of dataframe chunks:
+    return the number of rows where all the columns in grouping_key_list, driver_race_col
+    and search_conducted are non-null, and the number of drivers (unique grouping_key_list values) among them
+    """
+    complete_cols = grouping_key_list + [driver_race_col, 'search_conducted']
+    num_complete = 0
+    driver_hashes = []
+    for chunk in chunks:
+        complete = chunk.loc[chunk[complete_cols].notnull().all(axis=1), grouping_key_list]
+        num_complete += len(complete)
+        # hash the driver keys so only 8 bytes per driver are kept across chunks
+        driver_hashes.append(np.unique(pd.util.hash_pandas_object(complete, index=False).to_numpy()))
+    num_drivers = len(np.unique(np.concatenate(driver_hashes))) if driver_hashes else 0
+    return {'stops': num_complete, 'drivers': num_drivers}
+
+def stream_multiply_stopped_counts(chunks, driver_race_col='driver_race'):
+    """
+    Single pass over an iterable of dataframe chunks of a multiply-stopped (grouped) table:
+    return the number of stops, drivers, and the stops and drivers of drivers with more than one
+    race recorded across their stops (the racially discordant drivers)
+    """
+    race_bits = {} # each race gets its own bit, so the sum of a driver's distinct bits is their race set
+    stop_counts = []
+    driver_race_pairs = []
+    for chunk in chunks:
+        for race in chunk[driver_race_col].dropna().unique():
+            if race not in race_bits:
+                race_bits[race] = 1 << len(race_bits)
+        pairs = pd.DataFrame({'driver_id': chunk['driver_id'], 'race_bit': chunk[driver_race_col].map(race_bits)})
+        stop_counts.append(chunk.groupby('driver_id').size())
+        driver_race_pairs.append(pairs.drop_duplicates())
+
+    if len(stop_counts) == 0:
+        return {'stops': 0, 'drivers': 0, 'racially_discordant_stops': 0, 'racially_discordant_drivers': 0}
+    # a driver can span chunks, so combine the per-chunk counts and race sets
+    stops_per_driver = pd.concat(stop_counts).groupby(level=0).sum()
+    races_per_driver = pd.concat(driver_race_pairs).drop_duplicates().groupby('driver_id').size()
+    discordant = races_per_driver.index[races_per_driver >= 2]
+    return {
+        'stops': int(stops_per_driver.sum()),
+        'drivers': len(stops_per_driver),
+        'racially_discordant_stops': int(stops_per_driver.loc[discordant].sum()),
+        'racially_discordant_drivers': len(discordant)
+    }
+
+def stream_hispanic_white_counts(chunks, outcome_col='search_conducted', driver_race_col='driver_race'):
+    """
+    Single pass over an iterable of dataframe chunks of a Hispanic-white table:
+    return the number of stops and drivers, and the number of non-null outcomes and their sum
+    for the stops where the driver was perceived as Hispanic and as white
+    """
+    counts = {'stops': 0, 'Hispanic_n': 0, 'Hispanic_sum': 0., 'White_n': 0, 'White_sum': 0.}
+    driver_ids = []
+    for chunk in chunks:
+        counts['stops'] += len(chunk)
+        driver_ids.append(pd.unique(chunk['driver_id']))
+        outcome = outcome_as_float(chunk[outcome_col])
+        for race in ['Hispanic', 'White']:
+            race_outcome = outcome.loc[(chunk[driver_race_col] == race).to_numpy()].dropna()
+            counts[f'{race}_n'] += len(race_outcome)
+            counts[f'{race}_sum'] += race_outcome.sum()
+    counts['drivers'] = len(pd.unique(np.concatenate(driver_ids))) if driver_ids else 0
+    return counts
 
 def verify_raw_and_clean_match(raw_df, clean_df, key_list_raw, key_list_clean):
     """
     Assert that the raw_df and clean_df have the same number of rows and that they match on all entries for the columns in key_list
     """
-    assert(len(raw_df) == len(clean_df))
-    # compare each column separately
-    assert(len(key_list_raw) == len(key_list_clean))
-    for i in range(len(key_list_raw)):
-        assert(raw_df[key_list_raw[i]].equals(clean_df[key_list_clean[i]]))
+    # compare all the column pairs at once
+    mismatches = unmatched_cols(raw_df, clean_df, key_list_raw, key_list_clean)
+    mismatched = mismatches.loc[(mismatches['null_mismatches'] > 0) | (mismatches['value_mismatches'] > 0)]
+    assert len(mismatched) == 0, f"raw and clean columns don't match: {mismatched.to_dict('records')}"
+
+def unmatched_cols(d1, d2, cols1, cols2):
+    """
+    Compare the columns cols1 of d1 with the columns cols2 of d2 (same number of rows, matched by position)
+    all at once, and return a dataframe with one row per column pair: the number of rows where one is null
+    and the other isn't, and the number of rows with different non-null values
+    """
+    assert(len(d1) == len(d2))
+    assert(len(cols1) == len(cols2))
+    raw = d1[cols1].reset_index(drop=True)
+    clean = d2[cols2].reset_index(drop=True).set_axis(raw.columns, axis=1)
+    null_mismatch = raw.isna() != clean.isna()
+    diff_vals = raw.notna() & clean.notna() & (raw != clean)
+    return pd.DataFrame({
+        'raw': cols1,
+        'clean': cols2,
+        'null_mismatches': null_mismatch.sum().to_numpy(),
+        'value_mismatches': diff_vals.sum().to_numpy()
+    })
 
 def print_unmatched_cols(d1, d2, cols1, cols2):
     """
     Given two dataframes d1 and d2 and their respective columns cols1 and cols2,
     check if the dataframes match on those columns and print out how many rows don't match"""
-    for i in range(len(cols1)):
-        try:
-            verify_raw_and_clean_match(d1, d2, [cols1[i]], [cols2[i]])
-            print(f'{i}: {cols1[i]}')
-        except:
-            print('ERROR: ', i, cols1[i])
-            d = pd.DataFrame([d1[cols1[i]], d2[cols2[i]]]).T
-            d.columns = ['raw', 'clean']
-            print((d['raw'].isnull() != d['clean'].isnull()).sum(), "rows where raw is null and website is not or vice-versa")
-
-            diff_vals = d['raw'].notna() & d['clean'].notna() & (d['raw'] != d['clean'])
-            print(f'{(diff_vals).sum()} rows have different non-null values')
+    for i, row in unmatched_cols(d1, d2, cols1, cols2).iterrows():
+        if row['null_mismatches'] == 0 and row['value_mismatches'] == 0:
+            log(f'{i}: {cols1[i]}')
+        else:
+            log('ERROR: ', i, cols1[i])
+            log(row['null_mismatches'], "rows where raw is null and website is not or vice-versa")
+            log(f"{row['value_mismatches']} rows have different non-null values")
 
 def get_state_data(state_name):
     """
@@ -85,19 +177,39 @@ def get_state_data(state_name):
         raise ValueError("Invalid state name")
     return state_data_dict
 
-def plot_stop_freq_histogram(state_grouped):
+def finish_figure(fig_path=None, show=True):
+    """
+    Save the current figure to fig_path (if it isn't None), show it if show is True,
+    and close it so figures don't pile up when many are drawn
+    """
+    if fig_path is not None:
+        plt.savefig(fig_path, bbox_inches='tight')
+    if show:
+        plt.show()
+    plt.close()
+
+STOP_FREQ_HISTOGRAM_SUFFIXES = ['all', '2_to_5', 'more_than_5']
+
+def plot_stop_freq_histogram(state_grouped, fig_prefix=None, show=True):
     """
     Given the state dataframe grouped by driver_id, plot the histogram of the number of stops per person
+    If fig_prefix is not None, the 3 histograms are saved to fig_prefix + _all/_2_to_5/_more_than_5.pdf
+    """
+    draw_stop_freq_histogram(state_grouped.size(), fig_prefix, show)
+
+def draw_stop_freq_histogram(num_stops_per_person, fig_prefix=None, show=True):
     """
-    num_stops_per_person = state_grouped.size()
+    Draw the histograms of plot_stop_freq_histogram from the series of the number of stops per person
+    """
+    fig_paths = [None] * 3 if fig_prefix is None else [f'{fig_prefix}_{suffix}.pdf' for suffix in STOP_FREQ_HISTOGRAM_SUFFIXES]
     num_stops_per_person.hist(bins=range(2, max(num_stops_per_person)))
-    plt.show()
+    finish_figure(fig_paths[0], show)
     num_stops_between_2_and_5 = num_stops_per_person[num_stops_per_person.between(2, 5)]
     num_stops_between_2_and_5.hist(bins=range(2, max(num_stops_per_person)))
-    plt.show()
+    finish_figure(fig_paths[1], show)
     num_stops_more_than_5 = num_stops_per_person[num_stops_per_person > 5]
     num_stops_more_than_5.hist(bins=range(5, max(num_stops_per_person)))
-    plt.show()
+    finish_figure(fig_paths[2], show)
 
 def plot_top_5_col_values(state_csv, stategrouped_csv, col_name, driver_race_col='driver_race'):
     """
@@ -108,9 +220,9 @@ def plot_top_5_col_values(state_csv, stategrouped_csv, col_name, driver_race_col
     for label, data in zip(['All Drivers', 'Multiply Stopped Drivers'], [state_csv, stategrouped_csv]):
         top_5_vals.extend([data[col_name].value_counts().head(5).index])
         index_list.extend([f'{label} - white and Hispanic', f'{label} - white only', f'{label} - Hispanic only'])
-    print(top_5_vals)
+    log(top_5_vals)
     display(pd.DataFrame({col_name: top_5_vals}, index=index_list))
-    print(state_csv.loc[(state_csv[driver_race_col] == 'White') | (state_csv[driver_race_col] == 'Hispanic'), col_name].value_counts().head(5).index.to_latex())
+    log(state_csv.loc[(state_csv[driver_race_col] == 'White') | (state_csv[driver_race_col] == 'Hispanic'), col_name].value_counts().head(5).index.to_latex())
 
 def plot_top_5_col_values_all_states(az_data_dict, co_data_dict, tx_data_dict, col_name):
     """
@@ -122,13 +234,14 @@ def plot_top_5_col_values_all_states(az_data_dict, co_data_dict, tx_data_dict, c
         for data_label, data in zip(['All Drivers', 'Multiply Stopped Drivers', 'Racially Ambiguous'], [data_dict['all_drivers'], data_dict['multiply_stopped'], data_dict['racially_ambig']]):
             top_5_vals.extend([data.loc[(data['driver_race'] == 'White') | (data['driver_race'] == 'Hispanic'), col_name].value_counts().head(5).index])
             index_list.extend([f'{data_label} - white and Hispanic'])
-        print(state)
+        log(state)
         display(pd.DataFrame({col_name: top_5_vals}, index=index_list))
-        print(pd.DataFrame({col_name: top_5_vals}, index=index_list).to_dict())
+        log(pd.DataFrame({col_name: top_5_vals}, index=index_list).to_dict())
 
-def plot_search_rates_comparison(state, col, state_csv, stategrouped_csv, stategrouped_with_race_str, driver_race_col='driver_race'):
+def plot_search_rates_comparison(state, col, state_csv, stategrouped_csv, stategrouped_with_race_str, driver_race_col='driver_race', fig_path=None, show=True):
     """
     Plot mean column rates for white and Hispanic drivers
+    (saved to fig_path if it isn't None, shown if show is True)
     """
     stat_list = []
     ci_width_list = []
@@ -146,7 +259,14 @@ def plot_search_rates_comparison(state, col, state_csv, stategrouped_csv, stateg
             196 * data.loc[data[driver_race_col] == 'Hispanic', col].sem()
         ])
         index_list.extend([f'{label} - white and Hispanic', f'{label} - white only', f'{label} - Hispanic only'])
-    display(pd.DataFrame({col: stat_list, 'CI Width': ci_width_list}, index=index_list))
+    draw_search_rates_comparison(state, col, stat_list, ci_width_list, index_list, fig_path, show)
+
+def draw_search_rates_comparison(state, col, stat_list, ci_width_list, index_list, fig_path=None, show=True):
+    """
+    Draw the plot for plot_search_rates_comparison from the already computed rates (%) and 95% CI widths
+    """
+    if show:
+        display(pd.DataFrame({col: stat_list, 'CI Width': ci_width_list}, index=index_list))
     _, ax = plt.subplots(figsize=(7, 3))
     for (stat, ci_width, index) in zip(stat_list, ci_width_list, range(1, len(stat_list) + 1)):
         ax.errorbar(stat, index, xerr=ci_width, fmt='ko')
@@ -156,16 +276,14 @@ def plot_search_rates_comparison(state, col, state_csv, stategrouped_csv, stateg
     plt.yticks(range(1,len(stat_list)+1), index_list)
     plt.tick_params(left = False) # remove y-axis ticks
     ax.yaxis.grid(True, linestyle='--') # but add horizontal gridlines
-    plt.show()
+    finish_figure(fig_path, show)
 
-def plot_search_rates_comparison_all_states(az_data_dict, co_data_dict, tx_data_dict, col):
+def plot_search_rates_comparison_all_states(az_data_dict, co_data_dict, tx_data_dict, col, fig_path=None, show=True):
     """
     Plot column rates for white and Hispanic drivers, across subsets of the population, pooled across all states
+    (saved to fig_path if it isn't None, shown if show is True)
     """
-    fig, ax = plt.subplots(figsize=(7, 2))
-    data_label_list = ['All Drivers', 'Multiply Stopped Drivers', 'Racially Ambiguous Drivers']
     dict_keys = ['all_drivers', 'multiply_stopped', 'racially_ambig']
-    index_list = [f'{data_label} - white and Hispanic drivers' for data_label in data_label_list]
     # create a dictionary of combined state datasets with col and driver_race only
     combined_datasets = {}
     cols = [col, 'driver_race']
@@ -177,17 +295,31 @@ def plot_search_rates_comparison_all_states(az_data_dict, co_data_dict, tx_data_
             combined_data = pd.concat([az_data_dict[data_key][cols], co_data_dict[data_key][cols], tx_data_dict[data_key][cols]])
         combined_datasets[data_key] = combined_data.loc[combined_data[col].notnull() & combined_data[col].notna() & combined_data['driver_race'].notnull() & combined_data['driver_race'].notna()]
 
-    for idx, data in enumerate([combined_datasets['all_drivers'], combined_datasets['multiply_stopped'], combined_datasets['racially_ambig']]):
+    stat_lists = []
+    ci_width_lists = []
+    for data in [combined_datasets['all_drivers'], combined_datasets['multiply_stopped'], combined_datasets['racially_ambig']]:
         display(data)
-        stat_list = [
+        stat_lists.append([
             100 * data.loc[(data['driver_race'] == 'White'), col].mean(),
             100 * data.loc[(data['driver_race'] == 'Hispanic'), col].mean()
-        ]
-        ci_width_list = [
+        ])
+        ci_width_lists.append([
             196 * data.loc[(data['driver_race'] == 'White'), col].sem(),
             196 * data.loc[(data['driver_race'] == 'Hispanic'), col].sem()
-        ]
-        display(pd.DataFrame({col: stat_list, 'CI Width': ci_width_list}, index=['White', 'Hispanic']))
+        ])
+    draw_search_rates_comparison_all_states(col, stat_lists, ci_width_lists, fig_path, show)
+
+def draw_search_rates_comparison_all_states(col, stat_lists, ci_width_lists, fig_path=None, show=True):
+    """
+    Draw the plot for plot_search_rates_comparison_all_states from the already computed rates (%) and 95% CI widths:
+    stat_lists and ci_width_lists have one [white, Hispanic] list per subset (all, multiply stopped, racially ambiguous drivers)
+    """
+    fig, ax = plt.subplots(figsize=(7, 2))
+    data_label_list = ['All Drivers', 'Multiply Stopped Drivers', 'Racially Ambiguous Drivers']
+    index_list = [f'{data_label} - white and Hispanic drivers' for data_label in data_label_list]
+    for idx, (stat_list, ci_width_list) in enumerate(zip(stat_lists, ci_width_lists)):
+        if show:
+            display(pd.DataFrame({col: stat_list, 'CI Width': ci_width_list}, index=['White', 'Hispanic']))
         for (stat, ci_width, race_cond) in zip(stat_list, ci_width_list, ['White', 'Hispanic']):
             # label points with the state (only the first one to avoid repeats)
             ax.errorbar(stat, idx, label=race_cond if idx == 0 else None, xerr=ci_width, fmt='o', color='green' if race_cond == 'White' else 'blue')
@@ -198,7 +330,7 @@ def plot_search_rates_comparison_all_states(az_data_dict, co_data_dict, tx_data_
     plt.yticks(range(len(index_list)), index_list)
     plt.tick_params(left = False) # remove y-axis ticks
     ax.yaxis.grid(True, linestyle='--') # but add horizontal gridlines
-    plt.show()
+    finish_figure(fig_path, show)
 
 def calc_mean_med_max_stops(state_grouped):
     """
@@ -206,10 +338,10 @@ def calc_mean_med_max_stops(state_grouped):
     """
     stops_per_person = state_grouped.size()
 
-    print("Min # of Stops:", min(stops_per_person))
-    print("Max # of Stops:", max(stops_per_person))
-    print("Mean # of Stops:", statistics.mean(stops_per_person))
-    print("Median # of Stops:", statistics.median(stops_per_person))
+    log("Min # of Stops:", min(stops_per_person))
+    log("Max # of Stops:", max(stops_per_person))
+    log("Mean # of Stops:", statistics.mean(stops_per_person))
+    log("Median # of Stops:", statistics.median(stops_per_person))
 
 def int_or_none(x):
     """
@@ -233,9 +365,94 @@ def set_to_none_if_not_valid_date_or_is_jan_1(x):
     except:
         return None
 
-def standardize_cols(state, d):
+def in_year_window(dates, year_window):
+    """
+    Given a series of dates formatted as strings starting with the year (ex. 2016-10-12),
+    return a boolean mask of the dates whose year falls in year_window, an inclusive (first_year, last_year) tuple
+    Unparseable dates are outside of every window
+    """
+    first_year, last_year = year_window
+    years = pd.to_numeric(dates.astype(str).str[:4], errors='coerce')
+    return (years >= first_year) & (years <= last_year)
+
+def read_csv_in_year_window(filepath, date_col, year_window, chunksize=1000000, **read_csv_kwargs):
+    """
+    Read the csv at filepath chunksize rows at a time, keeping only the rows whose date_col falls in year_window,
+    so the rows outside of the window are never all in memory at once.
+    The remaining keyword arguments are passed to pd.read_csv. A csv with no rows gives an empty dataframe
+    with the header's columns
+    """
+    chunks = []
+    num_rows_read = 0
+    for chunk in pd.read_csv(filepath, chunksize=chunksize, **read_csv_kwargs):
+        num_rows_read += len(chunk)
+        chunks.append(chunk.loc[in_year_window(chunk[date_col], year_window)])
+    if len(chunks) > 0:
+        in_window = pd.concat(chunks)
+    else:
+        # the chunked reader yields no chunks at all for a header-only csv
+        in_window = pd.read_csv(filepath, nrows=0, **read_csv_kwargs)
+    log(f"Rows read: {num_rows_read}, rows in {year_window[0]}-{year_window[1]}: {len(in_window)}")
+    return in_window
+
+def hour_of_day_from_time(times):
+    """
+    Given a series of times formatted as strings (ex. 14:15 or 14:15:00),
+    return the hour of day as a decimal, like 14:15 will be hour of day 14.25 (nan if the time can't be parsed)
+    """
+    hours_and_minutes = times.astype(str).str.extract(r'^\s*(\d{1,2}):(\d{2})')
+    return pd.to_numeric(hours_and_minutes[0], errors='coerce') + pd.to_numeric(hours_and_minutes[1], errors='coerce') / 60.
+
+def parse_stop_dates(d, stop_date_col='stop_date'):
+    """
+    The stop dates of d as datetimes (NaT if missing or unparseable), parsed once so they can be passed
+    to add_time_features and add_stop_seq
+    """
+    return pd.to_datetime(d[stop_date_col], errors='coerce')
+
+def add_time_features(d, stop_date_col='stop_date', stop_time_col='stop_time', dates=None):
+    """
+    Return d with the time features used by the regressions and plots, computed once for all the rows:
+    hour_of_day (as in regress), stop_year, stop_month, stop_quarter (Q1-Q4), weekday (ex. Monday)
+    and stop_hour_categorical (3-hour bins, as in add_time_variables in plot_regression_res.R)
+    Features of missing or unparseable dates and times are null. dates are the dates of parse_stop_dates
+    (indexed like d), or None to parse stop_date_col here
+    """
+    dates = parse_stop_dates(d, stop_date_col) if dates is None else dates.reindex(d.index)
+    hour_of_day = hour_of_day_from_time(d[stop_time_col])
+    return d.assign(
+        hour_of_day=hour_of_day,
+        stop_year=dates.dt.year.astype('Int64'),
+        stop_month=dates.dt.month.astype('Int64'),
+        stop_quarter=('Q' + dates.dt.quarter.astype('Int64').astype(str)).where(dates.notnull()),
+        weekday=dates.dt.day_name(),
+        stop_hour_categorical=('hour_category_' + (hour_of_day // 3 * 3).astype('Int64').astype(str)).where(hour_of_day.notnull())
+    )
+
+def add_stop_seq(d, driver_col='driver_id', stop_date_col='stop_date', stop_time_col='stop_time', dates=None):
+    """
+    Return d with stop_seq, the number (1, 2, ...) of each stop among its driver's stops in date and time order
+    (stops at the same date and time keep their order in d). dates are the dates of parse_stop_dates
+    (indexed like d, or with more rows, like the dates of the data before group_df_by), or None to parse stop_date_col here
+    """
+    hour_of_day = d['hour_of_day'] if 'hour_of_day' in d.columns else hour_of_day_from_time(d[stop_time_col])
+    dates = parse_stop_dates(d, stop_date_col) if dates is None else dates.reindex(d.index)
+    keys = pd.DataFrame({
+        'driver': d[driver_col].to_numpy(),
+        'date': dates.to_numpy(),
+        'hour': hour_of_day.to_numpy()
+    })
+    # sorting on several columns is stable
+    keys = keys.sort_values(['driver', 'date', 'hour'])
+    stop_seq = np.empty(len(keys), dtype=np.int64)
+    stop_seq[keys.index.to_numpy()] = keys.groupby('driver', sort=False).cumcount().to_numpy() + 1
+    return d.assign(stop_seq=stop_seq)
+
+def standardize_cols(state, d, year_window=None):
     """
     Standardize columns for each of the three states
+    For texas, only keep the stops in year_window, an inclusive (first_year, last_year) tuple, if it isn't None
+    (tx.py already filters on its config's year_window while reading the csv)
     """
     if state == 'AZ':
         d['VehicleYear'] = d['VehicleYear'].map(lambda x:int_or_none(x)).astype('Int64')
@@ -251,7 +468,9 @@ def standardize_cols(state, d):
         d['driver_last_name'] = d['driver_last_name'].str.upper()
         d = d.loc[(d['driver_last_name'] != "NOT OBTAINED") & (d['driver_last_name'] != "--") & (d['driver_first_name'].map(lambda x:len(str(x).strip()) > 1)) & (d['driver_last_name'].map(lambda x:len(str(x).strip()) > 1))]
     elif state == 'TX':
-        d = d.loc[d['date'].map(lambda x: int(x[:4]) >= 2016)].copy()
+        if year_window is not None:
+            d = d.loc[in_year_window(d['date'], year_window)]
+        d = d.copy()
         d['HA_N_FIRST_DRVR'] = d['HA_N_FIRST_DRVR'].str.upper()
         d['HA_N_LAST_DRVR'] = d['HA_N_LAST_DRVR'].str.upper()
         d['HA_A_ADDRESS_DRVR'] = d['HA_A_ADDRESS_DRVR'].str.upper()
@@ -290,20 +509,29 @@ def group_df_by(df, key_list, driver_race_col='driver_race', csv_filename=None):
     notnull_df = df
     for key in key_list:
         notnull_df = notnull_df.loc[notnull_df[key].notnull() & notnull_df[key].notna()]
-        print(f"Rows remaining after taking only non-null key {key}:", len(notnull_df))
+        log(f"Rows remaining after taking only non-null key {key}:", len(notnull_df))
     # don't group by the driver_race col or search_conducted, so do this outside the loop
     notnull_df = notnull_df.loc[notnull_df[driver_race_col].notnull() & notnull_df[driver_race_col].notna()]
     notnull_df = notnull_df.loc[notnull_df['search_conducted'].notnull() & notnull_df['search_conducted'].notna()]
-    print(f"Rows remaining after taking only non-null key {driver_race_col}:", len(notnull_df))
+    log(f"Rows remaining after taking only non-null key {driver_race_col}:", len(notnull_df))
 
     driver_id = notnull_df.groupby(key_list).ngroup().to_list()
     notnull_df.insert(0, 'driver_id', driver_id)
     notnull_df_with_driver_id = notnull_df
-    print(f"Number of unique driver groups: {len(notnull_df['driver_id'].value_counts())}")
+    log(f"Number of unique driver groups: {len(notnull_df['driver_id'].value_counts())}")
     if csv_filename is not None:
         notnull_df_with_driver_id.to_csv(csv_filename, index=False)
     return notnull_df_with_driver_id.groupby(key_list)
 
+def driver_id_violations(d, grouping_keys):
+    """
+    Return the number of stops with a null driver_id and the number of individuals
+    (non-null grouping_keys values) with more than one driver_id, in one pass over d
+    """
+    num_null_ids = int(d['driver_id'].isna().sum())
+    ids_per_individual = d.groupby(grouping_keys)['driver_id'].nunique()
+    return num_null_ids, int((ids_per_individual > 1).sum())
+
 def check_cond(dfgroup, cond, csv_filename):
     """
     Check each group g in dfgroup against the condition cond
@@ -312,20 +540,22 @@ def check_cond(dfgroup, cond, csv_filename):
     Don't write anything to the csv otherwise
     """
     if os.path.isfile(csv_filename):
-        print(f"{csv_filename} already exists, NO CHANGE")
+        log(f"{csv_filename} already exists, NO CHANGE")
     else:
+        # assert first all entries have a non-null/non-nan driver id
+        # and that there's only one driver_id per individual, for all the groups at once
+        # (the disk-backed SortedDriverGroups has no rows in obj, so its groups are checked as they stream)
+        streamed = len(dfgroup.obj) == 0
+        if not streamed:
+            assert(driver_id_violations(dfgroup.obj, dfgroup.keys) == (0, 0))
         num_groups = 0
         for name, entries in dfgroup:
             if cond(name, entries):
-                # assert first all entries have a non-null/non-nan driver id
-                # and that there's only one driver_id per individual
-                assert(entries['driver_id'].notnull().all())
-                assert(entries['driver_id'].notna().all())
-                assert(entries['driver_id'].nunique() == 1)
-                assert(len(entries['driver_id'].value_counts()) == 1)
+                if streamed:
+                    assert(entries['driver_id'].notna().all() and entries['driver_id'].nunique() == 1)
                 num_groups += 1
                 write_to_csv(entries, csv_filename)
-        print(f"Number of groups written to csv: {num_groups}")
+        log(f"Number of groups written to csv: {num_groups}")
 
 def calc_racial_ambig(state_grouped, driver_race_col='driver_race'):
     """"
@@ -343,9 +573,9 @@ def calc_racial_ambig(state_grouped, driver_race_col='driver_race'):
         if len(set(entries[driver_race_col])) == 2 and 'Hispanic' in set(entries[driver_race_col]) and 'White' in set(entries[driver_race_col]):
             num_hispanic_white_entries += len(entries)
 
-    print("# Racially Ambiguous - Entries:", num_racial_ambig_entries)
-    print("# Racially Ambiguous - Individuals:", num_racial_ambig_ind)
-    print("# Hispanic-white - Entries:", num_hispanic_white_entries)
+    log("# Racially Ambiguous - Entries:", num_racial_ambig_entries)
+    log("# Racially Ambiguous - Individuals:", num_racial_ambig_ind)
+    log("# Hispanic-white - Entries:", num_hispanic_white_entries)
 
 def enumerate_racial_ambig(state_grouped, driver_race_col='driver_race'):
     """
@@ -361,7 +591,7 @@ def enumerate_racial_ambig(state_grouped, driver_race_col='driver_race'):
             # sort them and join with '_'
             race_set_list.append('_'.join(race_set))
 
-    print("#Individuals -", len(race_set_list))
+    log("#Individuals -", len(race_set_list))
 
     return Counter(race_set_list)
 
@@ -383,7 +613,7 @@ def generate_person_race_dict(state_grouped, driver_race_col='driver_race'):
             race_set.sort()
             person_race_dict[name] = ('_'.join(race_set))
 
-    print("#Individuals -", len(person_race_dict))
+    log("#Individuals -", len(person_race_dict))
     return person_race_dict
 
 def generate_state_stats(stategrouped_with_race_str, grouping_cols, driver_race_col='driver_race'):
@@ -409,7 +639,7 @@ def generate_state_stats(stategrouped_with_race_str, grouping_cols, driver_race_
         col_lst += ['is_arrested']
     if 'search_conducted' in stategrouped_with_race_str.columns:
         col_lst += ['search_conducted']
-    print(col_lst)
+    log(col_lst)
 
     for col in col_lst:
         race_frac_dict = {'Name': [], 'Rate': [], 'Std Err': [], '# Entries': [], '# Groups': []}
@@ -436,13 +666,25 @@ def generate_state_stats(stategrouped_with_race_str, grouping_cols, driver_race_
 
     return stats_dict_lst
 
-def ttest_unpaired(stategrouped_with_race_str, driver_race_col='driver_race'):
+def race_pair_races(race_pair):
+    """
+    Return the two races of a race pair (ex. 'Hispanic_White' -> ['Hispanic', 'White']),
+    in the alphabetical order they're joined in race_str
+    """
+    races = race_pair.split('_')
+    if len(races) != 2:
+        raise ValueError(f'Invalid race pair {race_pair}, should be two races joined with _ (ex. Hispanic_White)')
+    return races
+
+def ttest_unpaired(stategrouped_with_race_str, driver_race_col='driver_race', race_pair='Hispanic_White'):
     """
     Return a t-test on the search and arrest rates of white-Hispanic drivers
     identified as white versus Hispanic at stops
+    (or of the drivers of another race_pair, ex. 'Black_White', identified as each of its two races)
     """
-    # Only take the stops where the driver was identified as either white or
-    # Hispanic
+    # Only take the stops where the driver was identified as either of the pair's races
+    # (white or Hispanic for the default Hispanic_White)
+    first_race, second_race = race_pair_races(race_pair)
     stat_dict = {}
 
     stat_lst = []
@@ -450,33 +692,33 @@ def ttest_unpaired(stategrouped_with_race_str, driver_race_col='driver_race'):
         stat_lst += ['is_arrested']
     if 'search_conducted' in stategrouped_with_race_str.columns:
         stat_lst += ['search_conducted']
-    print(stat_lst)
+    log(stat_lst)
 
     for stat_name in stat_lst:
         non_null = stategrouped_with_race_str[stat_name].notnull()
 
-        race_str_cond = stategrouped_with_race_str['race_str'].map(lambda x:x in {"Hispanic_White"})
-        print(len(stategrouped_with_race_str.loc[race_str_cond]))
+        race_str_cond = stategrouped_with_race_str['race_str'] == race_pair
+        log(len(stategrouped_with_race_str.loc[race_str_cond]))
 
-        white_race_cond = race_str_cond & stategrouped_with_race_str[driver_race_col].map(lambda x:x in {"White"})
-        hispanic_race_cond = race_str_cond & stategrouped_with_race_str[driver_race_col].map(lambda x:x in {"Hispanic"})
+        second_race_cond = race_str_cond & (stategrouped_with_race_str[driver_race_col] == second_race)
+        first_race_cond = race_str_cond & (stategrouped_with_race_str[driver_race_col] == first_race)
 
-        # taking the rows where drivers were identified as white versus when they were Hispanic
-        # (the length of white stops may not necessarily equal the number of Hispanic stops)
-        white_search_cond = stategrouped_with_race_str.loc[non_null & white_race_cond, stat_name]
-        print("white stops:", len(white_search_cond))
+        # taking the rows where drivers were identified as the second race versus when they were the first
+        # (the number of second race stops may not necessarily equal the number of first race stops)
+        second_race_stops = stategrouped_with_race_str.loc[non_null & second_race_cond, stat_name]
+        log(f"{second_race} stops:", len(second_race_stops))
         # take means to automatically exclude nan values
-        print(f"white {stat_name}:", white_search_cond.mean())
+        log(f"{second_race} {stat_name}:", second_race_stops.mean())
 
-        hispanic_search_cond = stategrouped_with_race_str.loc[non_null & hispanic_race_cond, stat_name]
-        print("Hispanic stops:", len(hispanic_search_cond))
-        print(f"Hispanic {stat_name}:", hispanic_search_cond.mean())
+        first_race_stops = stategrouped_with_race_str.loc[non_null & first_race_cond, stat_name]
+        log(f"{first_race} stops:", len(first_race_stops))
+        log(f"{first_race} {stat_name}:", first_race_stops.mean())
 
-        print("white vec:\n", white_search_cond)
-        print("Hispanic vec:\n", hispanic_search_cond)
-        print(f"Var (white, hispanic): ({np.var(white_race_cond)}, {np.var(hispanic_race_cond)})")
+        log(f"{second_race} vec:\n", second_race_stops)
+        log(f"{first_race} vec:\n", first_race_stops)
+        log(f"Var ({second_race}, {first_race}): ({np.var(second_race_cond)}, {np.var(first_race_cond)})")
         
-        stat_dict[stat_name] = ttest_ind(white_search_cond.astype('bool'), hispanic_search_cond.astype('bool'))
+        stat_dict[stat_name] = ttest_ind(second_race_stops.astype('bool'), first_race_stops.astype('bool'))
     return stat_dict
 
 def ttest_paired(state_grouped, driver_race_col='driver_race'):
@@ -489,12 +731,12 @@ def ttest_paired(state_grouped, driver_race_col='driver_race'):
     # only add the columns that are actually present as columns
     stat_lst = []
     columns = state_grouped.obj.columns
-    print(columns)
+    log(columns)
     if 'is_arrested' in columns:
         stat_lst += ['is_arrested']
     if 'search_conducted' in columns:
         stat_lst += ['search_conducted']
-    print(stat_lst)
+    log(stat_lst)
 
     for stat_name in stat_lst:
         white_search_rate = []
@@ -514,23 +756,24 @@ def ttest_paired(state_grouped, driver_race_col='driver_race'):
                 hispanic_search_rate.append(hispanic_searched_stops)
         # white_search_rate and hispanic_search_rate have the same length (the number of Hispanic-white individuals)
         # they are the average number of searches for when the individual was identified as white versus when they were identified as Hispanic
-        print(len(white_search_rate), len(hispanic_search_rate))
-        print(white_search_rate, '\n', hispanic_search_rate)
+        log(len(white_search_rate), len(hispanic_search_rate))
+        log(white_search_rate, '\n', hispanic_search_rate)
         # nans will occur if there are no entries for white_search or hispanic_search
         # so omit them in the paired t-test
         stat_dict[stat_name] = ttest_rel(white_search_rate, hispanic_search_rate, nan_policy='omit')
     return stat_dict
 
-def display_driver_race_stats(stategrouped_csv, driver_race_col='driver_race'):
+def display_driver_race_stats(stategrouped_csv, driver_race_col='driver_race', fig_path=None, show=True):
     """
     Plot distribution of race for the traffic stops of the state
+    (saved to fig_path if it isn't None, shown if show is True)
     Return the driver_race_stats
     """
     norm_race_stats = stategrouped_csv[driver_race_col].value_counts(normalize=True) * 100
-    print(norm_race_stats)
+    log(norm_race_stats)
 
     stategrouped_csv[driver_race_col].value_counts(normalize=True).plot(kind='bar')
-    plt.show()
+    finish_figure(fig_path, show)
     return norm_race_stats
 
 def get_state_stats(state_csv, race_col, grouping_cols, driver_race_col='driver_race'):
@@ -545,30 +788,45 @@ def get_state_stats(state_csv, race_col, grouping_cols, driver_race_col='driver_
 
     return generate_state_stats(stategrouped_with_race_str, grouping_cols, driver_race_col)
 
-def plot_state_stats(state_stats_dict_lst, state, save_fig=False, use_rate=False):
+STATS_TO_TITLE_DICT = {
+    'is_arrested': 'Arrest Rates',
+    'search_conducted': 'Search Rates'
+}
+
+def state_stats_titles(state, stat_name):
+    """
+    Titles of the general and Hispanic+white plots of plot_state_stats for the stat
+    """
+    return (f'{state} {STATS_TO_TITLE_DICT[stat_name]} (%) across Groups', f'{state} {STATS_TO_TITLE_DICT[stat_name]} (%) for Hispanic+white Drivers')
+
+def state_stats_fig_names(state, stat_name):
+    """
+    File names (without .pdf) that plot_state_stats saves the general and Hispanic+white plots of the stat to:
+    the first 5 characters of the titles
+    """
+    gen_title, hw_title = state_stats_titles(state, stat_name)
+    return gen_title[:5] + '_gen', hw_title[:5]
+
+def plot_state_stats(state_stats_dict_lst, state, save_fig=False, use_rate=False, fig_dir='lab_diagrams/', show=True):
     """
     Plot state statistics of is_arrested and search_conducted
     use_rate=False if plotting percents, True otherwise
-    save_fig=True if saving the figure, False otherwise
+    save_fig=True if saving the figures (to fig_dir), False otherwise
+    show=False to only save the figures, without displaying them or their tables
     """
     # determine which stats are in this list
     stats_lst = []
     for stat_name, _ in state_stats_dict_lst:
         stats_lst.append(stat_name)
-    print(stats_lst)
+    log(stats_lst)
 
     # Get the ambiguous stat names
     ambig_stat_name_lst = [name for _, state_stats_dict in state_stats_dict_lst for name in state_stats_dict['Name'] if name.startswith('Ambiguous')]
 
     # lots of label substitutions for the graphs
-    stats_to_title_dict = {
-        'is_arrested': 'Arrest Rates',
-        'search_conducted': 'Search Rates'
-    }
-
     plt_title_lst = []
     for stat_name in stats_lst:
-        plt_title_lst.append((f'{state} {stats_to_title_dict[stat_name]} (%) across Groups', f'{state} {stats_to_title_dict[stat_name]} (%) for Hispanic+white Drivers'))
+        plt_title_lst.append(state_stats_titles(state, stat_name))
 
     general_dict_lst = []
     for i, stat in enumerate(stats_lst):
@@ -592,7 +850,7 @@ def plot_state_stats(state_stats_dict_lst, state, save_fig=False, use_rate=False
 
     # plot the stats
     for i, (stat_name, stats_dict) in enumerate(state_stats_dict_lst):
-        print(stat_name) # make stat_name into the dataframe
+        log(stat_name) # make stat_name into the dataframe
         df = pd.DataFrame(stats_dict)
         if use_rate:
             sort_by_col = 'Rate'
@@ -601,9 +859,11 @@ def plot_state_stats(state_stats_dict_lst, state, save_fig=False, use_rate=False
             df['Std Err'] *= 100
             df.rename(columns={'Rate': 'Percent (%)'}, inplace=True)
             sort_by_col = 'Percent (%)'
-        display(df.sort_values(sort_by_col))
+        if show:
+            display(df.sort_values(sort_by_col))
 
         gen_title, hw_title = plt_title_lst[i]
+        gen_fig_name, hw_fig_name = state_stats_fig_names(state, stat_name)
 
         # Plot the general stats
         _, ax = plt.subplots(figsize=(7, 4))
@@ -619,14 +879,13 @@ def plot_state_stats(state_stats_dict_lst, state, save_fig=False, use_rate=False
         plt.tick_params(left = False) # remove y-axis ticks
         plt.title(gen_title)
         ax.yaxis.grid(True, linestyle='--')
-        if save_fig: # take the first 5 characters of the title for the figure
-            fig_name = gen_title[:5] + '_gen'
-            plt.savefig(f'lab_diagrams/{fig_name}.pdf', bbox_inches='tight')
-        plt.show()
+        # take the first 5 characters of the title for the figure
+        finish_figure(f'{fig_dir}{gen_fig_name}.pdf' if save_fig else None, show)
 
         # Plot the white/Hispanic stats as a separate plot
         white_hispanic_only = df.loc[df['Name'].str.contains('White_Hispanic')]
-        display(white_hispanic_only)
+        if show:
+            display(white_hispanic_only)
         num_range = np.arange(len(white_hispanic_only))
         _, ax = plt.subplots(figsize=(7, 2))
         ax.errorbar(white_hispanic_only[sort_by_col], num_range, xerr=white_hispanic_only['Std Err'], fmt='o', color='blue')
@@ -635,66 +894,107 @@ def plot_state_stats(state_stats_dict_lst, state, save_fig=False, use_rate=False
         ax.yaxis.grid(True, linestyle='--')
         plt.tick_params(left = False) # remove y-axis ticks
         plt.title(hw_title)
-        if save_fig:
-            fig_name = hw_title[:5]
-            plt.savefig(f'lab_diagrams/{fig_name}.pdf', bbox_inches='tight')
-        plt.show()
+        finish_figure(f'{fig_dir}{hw_fig_name}.pdf' if save_fig else None, show)
 
-def regress(stategrouped_with_race_str, dep_var, cols, controls, model_name, useFixedEffects=True, stop_date_col='stop_date', driver_race_col='driver_race', stop_time_col='stop_time', drop_absorbed=False):
+def regress_model_str(dep_var, controls, useFixedEffects=True, race='Hispanic'):
+    """
+    Construct the model string for regress from the controls, and the EntityEffects if useFixedEffects is True for dep_var
+    race is the indicator whose coefficient is estimated (the first race of the race pair)
+    """
+    controls_str = "+".join(controls)
+    return f"{dep_var} ~ 1 + {race}{' + %s' % controls_str if len(controls_str) > 0 else ''}{' + EntityEffects' if useFixedEffects else ''}"
+
+def panel_time_col(d, stop_date_col='stop_date'):
+    """
+    The column regress uses as the time index of the panel: the precomputed stop_seq if d has it
+    (the estimates only need a time index within each driver, so the dates don't have to be parsed), else stop_date_col
+    """
+    return 'stop_seq' if 'stop_seq' in d.columns else stop_date_col
+
+def regress(stategrouped_with_race_str, dep_var, cols, controls, model_name, useFixedEffects=True, stop_date_col='stop_date', driver_race_col='driver_race', stop_time_col='stop_time', drop_absorbed=False, race_pair='Hispanic_White'):
     """
     Return a fixed effects model of the dependent var, fit on state data that
     is controlling for the variables in the controls, plus fixed effects
+    The model is fit on the drivers of race_pair (ex. 'Black_White'), and the coefficient
+    is on the pair's first race (Hispanic for the default Hispanic_White)
     """
-    print(f'drop_absorbed: {drop_absorbed}')
-    # only take stops of Hispanic-white drivers and non-null dep_var
-    race_str_cond = stategrouped_with_race_str['race_str'].map(lambda x:x in {"Hispanic_White"})
-    hispanic_white_drivers = stategrouped_with_race_str.loc[race_str_cond & stategrouped_with_race_str[dep_var].notnull() & stategrouped_with_race_str[dep_var].notna()]
-    print('number rows', len(hispanic_white_drivers))
-    print(f'number {dep_var}', len(hispanic_white_drivers[dep_var].loc[hispanic_white_drivers[dep_var] == True]))
-
-    # construct binary_race_and_id with columns "Hispanic", "White", "driver_id", "search_conducted"
-    # and all of the cols
-    # set stop_date_col to be a datetime object, and set the index to be driver_id and stop_date_col
-    binary_race_and_id = pd.get_dummies(hispanic_white_drivers[driver_race_col])
-    binary_race_and_id.insert(0, 'driver_id', hispanic_white_drivers['driver_id'])
-    binary_race_and_id.insert(0, dep_var, hispanic_white_drivers[dep_var])
-    binary_race_and_id.insert(4, stop_date_col, hispanic_white_drivers[stop_date_col])
+    log(f'drop_absorbed: {drop_absorbed}')
+    # only take stops of the race pair's drivers and non-null dep_var
+    race_str_cond = stategrouped_with_race_str['race_str'] == race_pair
+    race_pair_drivers = stategrouped_with_race_str.loc[race_str_cond & stategrouped_with_race_str[dep_var].notnull() & stategrouped_with_race_str[dep_var].notna()]
+    log('number rows', len(race_pair_drivers))
+    log(f'number {dep_var}', len(race_pair_drivers[dep_var].loc[race_pair_drivers[dep_var] == True]))
+
+    # construct binary_race_and_id with the pair's race indicators (ex. "Hispanic", "White"), "driver_id",
+    # the dep_var (ex. "search_conducted") and all of the cols
+    # the time index is the stop_seq precomputed by the pipeline (add_stop_seq), or else stop_date_col as a datetime,
+    # and the index is driver_id and the time index
+    time_col = panel_time_col(race_pair_drivers, stop_date_col)
+    binary_race_and_id = pd.get_dummies(race_pair_drivers[driver_race_col])
+    binary_race_and_id.insert(0, 'driver_id', race_pair_drivers['driver_id'])
+    binary_race_and_id.insert(0, dep_var, race_pair_drivers[dep_var])
+    binary_race_and_id.insert(4, time_col, race_pair_drivers[time_col])
 
     for col in cols:
         if col == 'hour_of_day':
-            # construct hour_of_day from stop_time as a decimal
+            # use the hour_of_day precomputed by add_time_features, or construct it from stop_time as a decimal
             # like 14:15 will be hour of day 14.25
-            binary_race_and_id['hour_of_day'] = hispanic_white_drivers[stop_time_col].apply(lambda x: int(x.split(':')[0]) * 60 + int(x.split(':')[1])) / 60.
+            if 'hour_of_day' in race_pair_drivers.columns:
+                binary_race_and_id['hour_of_day'] = race_pair_drivers['hour_of_day']
+            else:
+                binary_race_and_id['hour_of_day'] = hour_of_day_from_time(race_pair_drivers[stop_time_col])
             assert (min(binary_race_and_id['hour_of_day']) >= 0) and (max(binary_race_and_id['hour_of_day']) <= 24)
         else:
-            binary_race_and_id.insert(0, col, hispanic_white_drivers[col])
-    print(binary_race_and_id.columns)
+            binary_race_and_id.insert(0, col, race_pair_drivers[col])
+    log(binary_race_and_id.columns)
 
-    binary_race_and_id[stop_date_col] = pd.to_datetime(binary_race_and_id[stop_date_col])
+    if time_col == stop_date_col:
+        # data without stop_seq (ex. the processed data) has the dates parsed on every call
+        binary_race_and_id[stop_date_col] = pd.to_datetime(binary_race_and_id[stop_date_col])
 
-    binary_race_and_id = binary_race_and_id.set_index(['driver_id', stop_date_col])
+    binary_race_and_id = binary_race_and_id.set_index(['driver_id', time_col])
     # (Optional) set the binary_race_and_id columns all to be bools
 
     # set search_conducted to be bool type in case it's in int64
     binary_race_and_id[dep_var] = binary_race_and_id[dep_var].astype(bool)
 
     # binary_race_and_id = binary_race_and_id.astype(bool)
-    print(binary_race_and_id.shape)
+    log(binary_race_and_id.shape)
 
-    # construct the model string from the controls, and the EntityEffects if useFixedEffects is True for dep_var
-    controls_str = "+".join(controls)
-    model_str = f"{dep_var} ~ 1 + Hispanic{' + %s' % controls_str if len(controls_str) > 0 else ''}{' + EntityEffects' if useFixedEffects else ''}"
-    
-    print(model_str)
+    model_str = regress_model_str(dep_var, controls, useFixedEffects, race_pair_races(race_pair)[0])
+    log(model_str)
 
     model = PanelOLS.from_formula(f"{model_str}", data=binary_race_and_id, drop_absorbed=drop_absorbed)
     res = model.fit()
     res.model_name = model_name
-    display(res.summary)
+    log(res.summary)
     return res
 
-def make_sensitivity_dot_plot(list_of_models, coef_to_plot, title):
-    # make plot
+def within_driver_difference(driver_codes, hispanic, outcome):
+    """
+    Vectorized version of the regress fit with no controls: given integer driver codes (0 to #drivers - 1),
+    the Hispanic indicator and the outcome of each stop, return the driver fixed effects estimate of the
+    Hispanic coefficient and its (unadjusted, like PanelOLS) standard error
+    """
+    driver_codes = np.asarray(driver_codes)
+    hispanic = np.asarray(hispanic, dtype=float)
+    outcome = np.asarray(outcome, dtype=float)
+    num_drivers = np.count_nonzero(np.bincount(driver_codes))
+    stops_per_driver = np.maximum(np.bincount(driver_codes), 1)
+    # demean within driver
+    hispanic_demeaned = hispanic - (np.bincount(driver_codes, weights=hispanic) / stops_per_driver)[driver_codes]
+    outcome_demeaned = outcome - (np.bincount(driver_codes, weights=outcome) / stops_per_driver)[driver_codes]
+    ss_hispanic = np.dot(hispanic_demeaned, hispanic_demeaned)
+    if ss_hispanic == 0:
+        return np.nan, np.nan
+    coef = np.dot(hispanic_demeaned, outcome_demeaned) / ss_hispanic
+    resid = outcome_demeaned - coef * hispanic_demeaned
+    df_resid = len(outcome) - num_drivers - 1
+    std_err = np.sqrt(np.dot(resid, resid) / df_resid / ss_hispanic) if df_resid > 0 else np.nan
+    return coef, std_err
+
+def make_sensitivity_dot_plot(list_of_models, coef_to_plot, title, fig_path=None, show=True):
+    # make plot (saved to fig_path if it isn't None, shown if show is True)
     plt.figure(figsize=(6, 0.5*len(list_of_models)))
     yticks = []
     for i, res in enumerate(list_of_models):
@@ -711,34 +1011,36 @@ def make_sensitivity_dot_plot(list_of_models, coef_to_plot, title):
     else:
         raise ValueError('Unknown coef_to_plot')
     plt.title(title)
-    plt.show()
+    finish_figure(fig_path, show)
 
-def regress_statsmodel(stategrouped_with_race_str, dep_var):
+def regress_statsmodel(stategrouped_with_race_str, dep_var, race_pair='Hispanic_White'):
     """
     Use the statsmodels package to confirm the linearmodels package results
     Modeling fixed effects as binary variables for each of the driver_ids
+    (on the drivers of race_pair, with the coefficient on its first race)
     """
-    race_str_cond = stategrouped_with_race_str['race_str'].map(lambda x:x in {"Hispanic_White"})
-    hispanic_white_drivers = stategrouped_with_race_str.loc[race_str_cond & stategrouped_with_race_str[dep_var].notnull()]
-    display(hispanic_white_drivers)
-    print('number rows', len(hispanic_white_drivers))
-    print('number searched', len(hispanic_white_drivers['search_conducted'].loc[hispanic_white_drivers['search_conducted'] == True]))
+    race = race_pair_races(race_pair)[0]
+    race_str_cond = stategrouped_with_race_str['race_str'] == race_pair
+    race_pair_drivers = stategrouped_with_race_str.loc[race_str_cond & stategrouped_with_race_str[dep_var].notnull()]
+    display(race_pair_drivers)
+    log('number rows', len(race_pair_drivers))
+    log('number searched', len(race_pair_drivers['search_conducted'].loc[race_pair_drivers['search_conducted'] == True]))
 
     # make the driver_id columns not just numbers
-    id_num = hispanic_white_drivers['driver_id'].apply(lambda n: f"id{str(n)}")
-    hispanic_white_drivers.insert(0, 'id_num', id_num)
-    binary_id_and_race = pd.get_dummies(hispanic_white_drivers['id_num'])
+    id_num = race_pair_drivers['driver_id'].apply(lambda n: f"id{str(n)}")
+    race_pair_drivers.insert(0, 'id_num', id_num)
+    binary_id_and_race = pd.get_dummies(race_pair_drivers['id_num'])
     id_cols = binary_id_and_race.columns.to_list()
     id_cols = id_cols[:-1] # remove one of the ids since we have the intercept term
     
-    binary_id_and_race['Hispanic'] = pd.get_dummies(hispanic_white_drivers['driver_race'])['Hispanic']
-    binary_id_and_race[dep_var] = hispanic_white_drivers[dep_var]
+    binary_id_and_race[race] = pd.get_dummies(race_pair_drivers['driver_race'])[race]
+    binary_id_and_race[dep_var] = race_pair_drivers[dep_var]
     binary_id_and_race[dep_var] = binary_id_and_race[dep_var].astype('int64')
 
     display(binary_id_and_race)
 
     # add all the binary columns in the ids_string
     ids_string = "+".join(id_cols)
-    mod = smf.ols(formula=f"{dep_var} ~ 1 + Hispanic + {ids_string}", data=binary_id_and_race)
+    mod = smf.ols(formula=f"{dep_var} ~ 1 + {race} + {ids_string}", data=binary_id_and_race)
     res = mod.fit()
     return res.summary()
\ No newline at end of file
@@ -0,0 +1,300 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import stats
+from processed_data import MANIFEST, read_manifest, read_processed_table
+from run_report import log
+
+# Pooled multi-state panel: each state's processed data is converted once to an uncompressed Arrow IPC (feather)
+# file and memory-mapped, and the states are pooled with pa.concat_tables, so the pooled columns are views over
+# the per-state files instead of copies. Categorical columns (pyarrow dictionaries) keep each state's dictionary,
+# and their codes are only matched across states when they're used (column_codes), driver and officer ids are
+# namespaced by state (only their dictionaries are rewritten), and columns a state doesn't have
+# (ex. texas' is_arrested) are typed nulls. pooled_within_regression fits driver fixed effects
+# regressions on the pooled panel, with any number of (optionally state-interacted) fixed effects.
+#
+# Example:
+#     panel = load_pooled_panel(columns=['driver_id', 'officer_id', 'driver_race', 'search_conducted', 'stop_date'])
+#     pooled_within_regression(panel, 'search_conducted', ['Hispanic'], ['driver_id', 'officer_id'])
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+ARROW_DIR = 'csv/processed_data/arrow/'
+ID_COLS = ['driver_id', 'officer_id']
+DICTIONARY_TYPE = None if pa is None else pa.dictionary(pa.int32(), pa.string())
+STATE_TYPE = None if pa is None else pa.dictionary(pa.int8(), pa.string())
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('The pooled panel needs pyarrow (pip install pyarrow)')
+
+def state_arrow_path(state, subset='hispanic-white', arrow_dir=ARROW_DIR):
+    return os.path.join(arrow_dir, f"{state.lower()}_{subset}.arrow")
+
+def write_state_arrow(state, subset='hispanic-white', manifest=MANIFEST, arrow_dir=ARROW_DIR):
+    """
+    Convert the state's processed .csv.gz file (from the manifest) to an uncompressed Arrow IPC file
+    that can be memory-mapped, unless it already exists. The id columns are dictionary-encoded once here,
+    so pooling only has to rewrite their dictionaries. Return its path
+    """
+    require_pyarrow()
+    path = state_arrow_path(state, subset, arrow_dir)
+    if os.path.isfile(path):
+        schema = pa.ipc.open_file(pa.memory_map(path, 'r')).schema
+        if all(pa.types.is_dictionary(schema.field(col).type) for col in ID_COLS if col in schema.names):
+            log(f"{path} already exists, NO CHANGE")
+            return path
+        # written before the ids were dictionary-encoded (and empty fields were read as nulls)
+        log(f"Rewriting {path}, it has plain string ids")
+    os.makedirs(arrow_dir, exist_ok=True)
+    table = read_processed_table(read_manifest(manifest)[state][subset])
+    for col in ID_COLS:
+        if col in table.column_names:
+            table = table.set_column(table.column_names.index(col), col, pc.dictionary_encode(pc.cast(table.column(col), pa.string())))
+    feather.write_feather(table, path + '.tmp', compression='uncompressed')
+    os.replace(path + '.tmp', path)
+    log(f'Wrote {table.num_rows} rows of {state} {subset} to {path}')
+    return path
+
+def open_state_table(path, columns=None):
+    """
+    Memory-map an Arrow IPC file: the table's columns are views over the file, and
+    the pages of a column are only read from disk when the column is used
+    """
+    require_pyarrow()
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return table if columns is None else table.select([col for col in columns if col in table.column_names])
+
+def namespace_ids(column, state):
+    """
+    Prefix the distinct values of a dictionary-encoded id column with the state (ex. AZ_1234), so ids are
+    unique across states: only the dictionary of each chunk is rewritten, the per-stop indices are reused
+    (and nulls stay null). Id columns that aren't dictionary-encoded (not written by write_state_arrow)
+    are encoded first, which does copy the per-stop values
+    """
+    if not pa.types.is_dictionary(column.type):
+        column = pc.cast(column, pa.string()) if not pa.types.is_string(column.type) else column
+        column = pc.dictionary_encode(column)
+    chunks = []
+    for chunk in column.chunks:
+        dictionary = pc.binary_join_element_wise(pa.scalar(state), pc.cast(chunk.dictionary, pa.string()), '_')
+        chunks.append(pa.DictionaryArray.from_arrays(pc.cast(chunk.indices, pa.int32()), dictionary))
+    return pa.chunked_array(chunks, type=DICTIONARY_TYPE)
+
+def pooled_column_types(state_tables):
+    """
+    The type of each column of the pooled panel: ids, the state and columns that are categorical in any state
+    are dictionaries, other columns keep the type of the first state that has them
+    """
+    column_types = {}
+    for table in state_tables.values():
+        for field in table.schema:
+            if field.name in ID_COLS or pa.types.is_dictionary(field.type) or pa.types.is_dictionary(column_types.get(field.name, pa.null())):
+                column_types[field.name] = DICTIONARY_TYPE
+            elif field.name not in column_types or pa.types.is_null(column_types[field.name]):
+                column_types[field.name] = field.type
+    column_types['state'] = STATE_TYPE
+    return column_types
+
+def conform_state_table(table, state, column_types):
+    """
+    Return the state's table with the pooled columns and types: ids namespaced, missing columns as typed nulls,
+    and the state column. Columns that already have the pooled type are passed through without copying
+    """
+    columns = []
+    for col, col_type in column_types.items():
+        if col == 'state':
+            indices = pa.array(np.zeros(table.num_rows, dtype=np.int8))
+            columns.append(pa.chunked_array([pa.DictionaryArray.from_arrays(indices, pa.array([state]))], type=STATE_TYPE))
+        elif col not in table.column_names:
+            columns.append(pa.chunked_array([pa.nulls(table.num_rows, col_type)], type=col_type))
+        elif col in ID_COLS:
+            columns.append(namespace_ids(table.column(col), state))
+        elif table.column(col).type == col_type:
+            columns.append(table.column(col))
+        elif col_type == DICTIONARY_TYPE:
+            columns.append(pc.dictionary_encode(pc.cast(table.column(col), pa.string())))
+        else:
+            columns.append(pc.cast(table.column(col), col_type))
+    return pa.table(columns, names=list(column_types.keys()))
+
+def build_pooled_panel(state_tables):
+    """
+    Pool a dictionary of state -> arrow table into one table (see the top of the file)
+    """
+    require_pyarrow()
+    column_types = pooled_column_types(state_tables)
+    tables = [conform_state_table(table, state, column_types) for state, table in state_tables.items()]
+    # concat_tables only collects the chunks of each state, and each chunk keeps its state's dictionary
+    # (unifying the dictionaries here would rewrite the indices of every state after the first)
+    pooled = pa.concat_tables(tables)
+    log(f"Pooled panel: {pooled.num_rows} rows from {', '.join(state_tables.keys())}")
+    return pooled
+
+def load_pooled_panel(states=('AZ', 'CO', 'TX'), subset='hispanic-white', columns=None, manifest=MANIFEST, arrow_dir=ARROW_DIR):
+    """
+    Return the pooled panel of the states' processed data (only the columns in columns if it isn't None),
+    memory-mapped from their Arrow files (written from the .csv.gz files the first time).
+    Like read_processed_data, texas' date and time columns are also used as stop_date and stop_time
+    """
+    state_tables = {}
+    for state in states:
+        table = open_state_table(write_state_arrow(state, subset, manifest, arrow_dir))
+        if state == 'TX':
+            for col, stop_col in [('date', 'stop_date'), ('time', 'stop_time')]:
+                if col in table.column_names and stop_col not in table.column_names:
+                    table = table.append_column(stop_col, table.column(col)) # the same buffers, not a copy
+        if columns is not None:
+            table = table.select([col for col in columns if col in table.column_names])
+        state_tables[state] = table
+    return build_pooled_panel(state_tables)
+
+def pooled_panel_to_pandas(panel, columns=None):
+    """
+    Convert (the columns of) the pooled panel to a dataframe: dictionaries become categoricals
+    and booleans nullable booleans, so there are no object columns from mismatched states
+    """
+    if columns is not None:
+        panel = panel.select(columns)
+    return panel.to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get)
+
+def dictionary_codes(column):
+    """
+    Integer codes (-1 for nulls) of a dictionary column whose chunks have their own dictionaries, against one
+    dictionary of the values of all the chunks (in order of first appearance). Only the dictionaries are matched,
+    then each chunk's indices are remapped with a lookup. Return the codes and the dictionary
+    """
+    chunk_dictionaries = [chunk.dictionary.to_pandas() for chunk in column.chunks]
+    dictionary_codes, dictionary = pd.factorize(pd.concat(chunk_dictionaries, ignore_index=True))
+    codes = []
+    start = 0
+    for chunk, chunk_dictionary in zip(column.chunks, chunk_dictionaries):
+        # the chunk's index -> pooled code, with -1 (a null index) mapped to -1
+        remap = np.append(dictionary_codes[start:start + len(chunk_dictionary)], -1).astype(np.int64)
+        codes.append(remap[pc.fill_null(chunk.indices, -1).to_numpy()])
+        start += len(chunk_dictionary)
+    return np.concatenate(codes), list(dictionary)
+
+def column_codes(panel, col):
+    """
+    Integer codes of a column (-1 for nulls); for dictionary columns these are the codes of dictionary_codes
+    """
+    column = panel.column(col)
+    if pa.types.is_dictionary(column.type) and column.num_chunks > 0:
+        return dictionary_codes(column)[0]
+    return pd.factorize(column.to_pandas())[0].astype(np.int64)
+
+def fixed_effect_codes(panel, fixed_effect):
+    """
+    Codes of a fixed effect: a column name, or a tuple of column names for their interaction
+    (ex. ('state', 'stop_year') for state-specific year effects). -1 if any of the columns is null
+    """
+    cols = [fixed_effect] if isinstance(fixed_effect, str) else list(fixed_effect)
+    codes = column_codes(panel, cols[0])
+    for col in cols[1:]:
+        col_codes = column_codes(panel, col)
+        valid = (codes >= 0) & (col_codes >= 0)
+        combined = np.full(len(codes), -1, dtype=np.int64)
+        combined[valid] = pd.factorize(codes[valid] * (col_codes.max() + 1) + col_codes[valid])[0]
+        codes = combined
+    return codes
+
+def regressor_values(panel, regressor, driver_race_col='driver_race'):
+    """
+    Values of a regressor: a numeric or boolean column, or a race (ex. Hispanic) for the indicator of driver_race_col
+    """
+    if regressor in panel.column_names:
+        return pc.cast(panel.column(regressor), pa.float64()).to_numpy()
+    race_column = panel.column(driver_race_col)
+    race_codes, races = dictionary_codes(race_column) if race_column.num_chunks > 0 else (np.empty(0, dtype=np.int64), [])
+    if regressor not in races:
+        raise ValueError(f'{regressor} is neither a column nor a {driver_race_col} value')
+    return np.where(race_codes >= 0, (race_codes == races.index(regressor)).astype(float), np.nan)
+
+def demean_alternating_projections(matrix, fe_codes, max_iter=1000, tol=1e-10):
+    """
+    Remove the fixed effects from each column of matrix by alternating projections: subtract each fixed effect's
+    group means in turn until the largest mean removed in a pass is below tol (one pass for a single fixed effect).
+    Return the demeaned matrix and the number of passes
+    """
+    demeaned = np.array(matrix, dtype=float, order='F')
+    counts = [np.maximum(np.bincount(codes), 1) for codes in fe_codes]
+    for iteration in range(1, max_iter + 1):
+        max_change = 0.
+        for codes, n in zip(fe_codes, counts):
+            for j in range(demeaned.shape[1]):
+                means = np.bincount(codes, weights=demeaned[:, j], minlength=len(n)) / n
+                demeaned[:, j] -= means[codes]
+                max_change = max(max_change, np.abs(means).max())
+        if len(fe_codes) == 1 or max_change < tol:
+            break
+    else:
+        log(f'Alternating projections did not converge in {max_iter} passes (last change {max_change:.2e})')
+    return demeaned, iteration
+
+def pooled_within_regression(panel, dep_var='search_conducted', regressors=('Hispanic',), fixed_effects=('driver_id',),
+                             cluster=None, driver_race_col='driver_race', max_iter=1000, tol=1e-10):
+    """
+    Fit dep_var ~ regressors + fixed effects by OLS on the pooled panel, removing the fixed effects by alternating
+    projections. fixed_effects are column names or tuples of columns for interactions (ex. ('state', 'weekday')).
+    Rows with a null outcome, regressor, fixed effect or cluster are dropped. Standard errors are unadjusted (like regress),
+    or clustered by the column cluster (ex. 'driver_id'). With driver_id as the only fixed effect, the estimate
+    and unadjusted standard error are those of regress. Return a dataframe of the coefficients
+    """
+    y = pc.cast(panel.column(dep_var), pa.float64()).to_numpy()
+    x = np.column_stack([regressor_values(panel, regressor, driver_race_col) for regressor in regressors])
+    fe_codes = [fixed_effect_codes(panel, fixed_effect) for fixed_effect in fixed_effects]
+    cluster_codes = fixed_effect_codes(panel, cluster) if cluster is not None else None
+    return within_regression(y, x, fe_codes, regressors, fixed_effects, cluster_codes, max_iter, tol)
+
+def within_regression(y, x, fe_codes, regressors, fixed_effects, cluster_codes=None, max_iter=1000, tol=1e-10):
+    """
+    Fit y ~ x + fixed effects by OLS, given the outcome, the matrix of regressors (named regressors) and the codes
+    of each fixed effect (-1 if null, named fixed_effects), removing the fixed effects by alternating projections.
+    Rows with a null outcome, regressor or fixed effect are dropped. Standard errors are unadjusted, or clustered
+    by cluster_codes (-1 if null); rows with a null cluster are then dropped too, instead of being pooled into
+    one cluster. Return a dataframe of the coefficients, with their covariance matrix in attrs['cov']
+    """
+    keep = ~np.isnan(y) & ~np.isnan(x).any(axis=1)
+    for codes in fe_codes:
+        keep &= codes >= 0
+    if cluster_codes is not None:
+        keep &= cluster_codes >= 0
+        cluster_codes = cluster_codes[keep]
+    # renumber the fixed effect levels of the remaining rows
+    fe_codes = [np.unique(codes[keep], return_inverse=True)[1].ravel() for codes in fe_codes]
+    num_levels = [codes.max() + 1 if len(codes) > 0 else 0 for codes in fe_codes]
+
+    demeaned, passes = demean_alternating_projections(np.column_stack([y[keep], x[keep]]), fe_codes, max_iter, tol)
+    y_demeaned, x_demeaned = demeaned[:, 0], demeaned[:, 1:]
+    xtx_inv = np.linalg.pinv(x_demeaned.T @ x_demeaned)
+    coef = xtx_inv @ (x_demeaned.T @ y_demeaned)
+    resid = y_demeaned - x_demeaned @ coef
+    n, k = x_demeaned.shape
+    # one degree of freedom per fixed effect level, less one per additional fixed effect (assumes they're connected)
+    df_resid = n - k - sum(num_levels) + max(len(fe_codes) - 1, 0)
+    if cluster_codes is None:
+        cov = xtx_inv * (resid @ resid) / df_resid
+    else:
+        cluster_codes = np.unique(cluster_codes, return_inverse=True)[1].ravel()
+        num_clusters = cluster_codes.max() + 1
+        scores = np.column_stack([np.bincount(cluster_codes, weights=x_demeaned[:, j] * resid, minlength=num_clusters) for j in range(k)])
+        cov = xtx_inv @ (scores.T @ scores) @ xtx_inv * num_clusters / (num_clusters - 1) * (n - 1) / (n - k)
+        df_resid = num_clusters - 1
+    std_err = np.sqrt(np.diag(cov))
+    t_stat = coef / std_err
+    results = pd.DataFrame({
+        'coef': coef,
+        'std_err': std_err,
+        't_stat': t_stat,
+        'p_value': 2 * stats.t.sf(np.abs(t_stat), df_resid)
+    }, index=pd.Index(list(regressors), name='regressor'))
+    results.attrs.update({'nobs': n, 'df_resid': df_resid, 'fixed_effect_levels': dict(zip(map(str, fixed_effects), map(int, num_levels))), 'passes': passes,
+                          'cov': pd.DataFrame(cov, index=results.index, columns=results.index)})
+    log(f'Within regression on {n} rows, fixed effects {list(fixed_effects)} ({passes} passes)')
+    return results
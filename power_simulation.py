@@ -0,0 +1,151 @@
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy import stats
+from run_report import log
+
+# Monte Carlo power and bias simulations for the driver fixed effects estimate of the Hispanic coefficient
+# (regress with no controls) on simulated panels with the structure of the multiply-stopped Hispanic and white drivers:
+# each driver has 2-10 stops and a true race, each stop's perceived race flips with the flip probability, and
+# perceived Hispanic stops are searched with a planted additive effect. Replicates are simulated in batches
+# as flat numpy arrays (each replicate's drivers get their own codes), and the grid points run in a process pool.
+#
+# Example:
+#     results = run_power_grid({'num_drivers': [20000, 50000], 'flip_prob': [0.05, 0.1], 'effect': [0, 0.005, 0.01]})
+
+MIN_STOPS = 2
+MAX_STOPS = 10
+DEFAULT_PARAMS = {
+    'num_drivers': 20000, # multiply-stopped Hispanic and white drivers per panel
+    'hispanic_share': 0.5, # share of drivers who are (truly) Hispanic
+    'flip_prob': 0.05, # probability that a stop's perceived race differs from the driver's race
+    'effect': 0.005, # planted Hispanic - white difference in search probability
+    'base_rate': 0.03, # mean search probability of white stops
+    'base_rate_concentration': 20, # concentration of the beta distribution of driver search probabilities (lower = more heterogeneous)
+    'stop_count_probs': None # probabilities of 2, 3, ..., 10 stops per driver (None = proportional to 2^-stops)
+}
+
+def observed_stop_count_probs(stops_per_driver, min_stops=MIN_STOPS, max_stops=MAX_STOPS):
+    """
+    Given the number of stops of each driver (ex. grouped['driver_id'].value_counts()), return the
+    observed probabilities of min_stops, ..., max_stops stops to use as the stop_count_probs of a simulation
+    """
+    counts = np.bincount(np.asarray(stops_per_driver), minlength=max_stops + 1)[min_stops:max_stops + 1]
+    return counts / counts.sum()
+
+def simulate_batch(rng, num_replicates, num_drivers, hispanic_share, flip_prob, effect, base_rate,
+                   base_rate_concentration, stop_count_probs):
+    """
+    Simulate num_replicates panels at once. Return the stops' replicate, driver code
+    (unique across replicates), perceived Hispanic indicator and outcome as flat arrays
+    """
+    if stop_count_probs is None:
+        stop_count_probs = 0.5 ** np.arange(MIN_STOPS, MAX_STOPS + 1)
+    stop_count_probs = np.asarray(stop_count_probs, dtype=float) / np.sum(stop_count_probs)
+    num_stops = rng.choice(np.arange(MIN_STOPS, MAX_STOPS + 1), size=num_replicates * num_drivers, p=stop_count_probs)
+    driver_codes = np.repeat(np.arange(num_replicates * num_drivers), num_stops)
+    replicates = driver_codes // num_drivers
+
+    is_hispanic = rng.random(num_replicates * num_drivers) < hispanic_share
+    driver_base_rate = rng.beta(base_rate * base_rate_concentration, (1 - base_rate) * base_rate_concentration, size=num_replicates * num_drivers)
+    hispanic = is_hispanic[driver_codes] ^ (rng.random(len(driver_codes)) < flip_prob)
+    search_prob = np.clip(driver_base_rate[driver_codes] + effect * hispanic, 0, 1)
+    outcome = (rng.random(len(driver_codes)) < search_prob).astype(float)
+    return replicates, driver_codes, hispanic.astype(float), outcome
+
+def batch_within_driver_difference(replicates, driver_codes, hispanic, outcome, num_replicates):
+    """
+    within_driver_difference for every replicate of a batch at once: return the arrays of
+    estimates and standard errors (nan for replicates with no within-driver variation in perceived race),
+    the number of inconsistently perceived drivers and the residual degrees of freedom of each replicate
+    """
+    num_stops = np.bincount(driver_codes)
+    num_hispanic = np.bincount(driver_codes, weights=hispanic)
+    hispanic_demeaned = hispanic - (num_hispanic / num_stops)[driver_codes]
+    outcome_demeaned = outcome - (np.bincount(driver_codes, weights=outcome) / num_stops)[driver_codes]
+    ss_hispanic = np.bincount(replicates, weights=hispanic_demeaned ** 2, minlength=num_replicates)
+    ss_cross = np.bincount(replicates, weights=hispanic_demeaned * outcome_demeaned, minlength=num_replicates)
+    ss_outcome = np.bincount(replicates, weights=outcome_demeaned ** 2, minlength=num_replicates)
+
+    identified = ss_hispanic > 1e-12
+    coef = np.full(num_replicates, np.nan)
+    coef[identified] = ss_cross[identified] / ss_hispanic[identified]
+    ssr = ss_outcome - coef * ss_cross
+    driver_replicate = np.arange(len(num_stops)) // (len(num_stops) // num_replicates) # every replicate has the same number of drivers
+    df_resid = np.bincount(replicates, minlength=num_replicates) - np.bincount(driver_replicate, minlength=num_replicates) - 1
+    std_err = np.full(num_replicates, np.nan)
+    std_err[identified] = np.sqrt(ssr[identified] / df_resid[identified] / ss_hispanic[identified])
+
+    inconsistent = (num_hispanic > 0) & (num_hispanic < num_stops)
+    num_inconsistent = np.bincount(driver_replicate, weights=inconsistent, minlength=num_replicates)
+    return coef, std_err, num_inconsistent, df_resid
+
+def simulate_grid_point(params, seed, num_replicates=1000, batch_size=100, alpha=0.05):
+    """
+    Run num_replicates simulations (batch_size at a time) for one set of parameters
+    and return the power (at level alpha), bias, rmse and confidence interval coverage of the estimate
+    """
+    params = {**DEFAULT_PARAMS, **params}
+    rng = np.random.default_rng(seed)
+    coefs, std_errs, inconsistent, dfs = [], [], [], []
+    for start in range(0, num_replicates, batch_size):
+        n = min(batch_size, num_replicates - start)
+        batch = simulate_batch(rng, n, **params)
+        coef, std_err, num_inconsistent, df_resid = batch_within_driver_difference(*batch, num_replicates=n)
+        coefs.append(coef)
+        std_errs.append(std_err)
+        inconsistent.append(num_inconsistent)
+        dfs.append(df_resid)
+    coef = np.concatenate(coefs)
+    std_err = np.concatenate(std_errs)
+    critical_value = stats.t.ppf(1 - alpha / 2, np.concatenate(dfs))
+    identified = ~np.isnan(coef)
+
+    result = {k: v for k, v in params.items() if k != 'stop_count_probs'}
+    result.update({
+        'replicates': num_replicates,
+        'identified_rate': identified.mean(),
+        'mean_inconsistent_drivers': np.concatenate(inconsistent).mean(),
+        'power': np.mean(identified & (np.abs(coef) > critical_value * std_err)), # unidentified replicates count as not rejecting
+        'mean_estimate': np.nanmean(coef),
+        'bias': np.nanmean(coef) - params['effect'],
+        'rmse': np.sqrt(np.nanmean((coef - params['effect']) ** 2)),
+        'mean_std_err': np.nanmean(std_err),
+        'coverage': np.mean(np.abs(coef - params['effect'])[identified] <= (critical_value * std_err)[identified])
+    })
+    return result
+
+def power_grid(grid):
+    """
+    Expand a dictionary of parameter -> list of values into the list of every combination
+    """
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+def run_power_grid(grid, num_replicates=1000, batch_size=100, alpha=0.05, seed=0, max_workers=None, output_csv=None):
+    """
+    Simulate every combination of the parameters in grid (a dictionary of parameter -> list of values,
+    unlisted parameters take their DEFAULT_PARAMS value) in a process pool, and return a dataframe with a row
+    per combination. Each grid point gets its own independent random stream spawned from seed, so the results
+    don't depend on the number of workers
+    """
+    grid_points = power_grid(grid)
+    seeds = np.random.SeedSequence(seed).spawn(len(grid_points))
+    log(f'Simulating {len(grid_points)} grid points x {num_replicates} replicates')
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(simulate_grid_point, params, child_seed, num_replicates, batch_size, alpha)
+                   for params, child_seed in zip(grid_points, seeds)]
+        results = pd.DataFrame([future.result() for future in futures])
+    if output_csv is not None:
+        results.to_csv(output_csv, index=False)
+        log(f'Wrote {output_csv}')
+    return results
+
+if __name__ == "__main__":
+    results = run_power_grid({
+        'num_drivers': [5000, 20000, 50000],
+        'flip_prob': [0.02, 0.05, 0.1],
+        'effect': [0, 0.0025, 0.005, 0.01]
+    }, output_csv='csv/power_simulation.csv')
+    log(results[['num_drivers', 'flip_prob', 'effect', 'mean_inconsistent_drivers', 'power', 'bias', 'coverage']].to_string())
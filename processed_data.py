@@ -0,0 +1,167 @@
+import os
+import io
+import json
+import gzip
+import queue
+import threading
+import pandas as pd
+from pandas._libs.parsers import STR_NA_VALUES # pandas' default na_values
+from run_report import log, new_run_report, stage, write_run_report
+
+# Reader for the anonymized, processed data in csv/processed_data: the .csv.gz files are read directly
+# (no manual unzipping), decompressed in a background thread that feeds a multithreaded csv parser,
+# and csv/processed_data/manifest.json maps each state and subset to its file (no hard-coded paths)
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError: # fall back to the pandas csv parser
+    pa = None
+
+PROCESSED_DATA_DIR = 'csv/processed_data/'
+MANIFEST = os.path.join(PROCESSED_DATA_DIR, 'manifest.json')
+SUBSETS = ['all', 'multiply-stopped', 'hispanic-white']
+DECOMPRESS_BLOCK_BYTES = 4 * 1024 * 1024
+
+# fixed schema of the columns kept by filter_processed_csv_columns (plus the hash columns it adds); the numeric time features are inferred
+STRING_COLS = ['driver_id', 'officer_id', 'driver_id_hash', 'officer_id_hash', 'county_fips',
+               'stop_date', 'stop_time', 'date', 'time', 'violation']
+CATEGORY_COLS = ['state', 'driver_race', 'county_name', 'stop_duration', 'stop_quarter', 'weekday', 'stop_hour_categorical']
+BOOL_COLS = ['search_conducted', 'contraband_found', 'is_arrested']
+
+def read_manifest(manifest=MANIFEST):
+    """
+    Return the dictionary of state -> subset -> path of the processed .csv.gz file
+    """
+    with open(manifest) as f:
+        files = json.load(f)
+    manifest_dir = os.path.dirname(manifest)
+    return {state: {subset: os.path.join(manifest_dir, filename) for subset, filename in subsets.items()}
+            for state, subsets in files.items()}
+
+class ThreadedGzipReader(io.RawIOBase):
+    """
+    Read-only file object over a .gz file that is decompressed in a background thread,
+    block by block, so decompression runs at the same time as the csv parsing
+    """
+    def __init__(self, filepath, block_bytes=DECOMPRESS_BLOCK_BYTES, max_blocks_ahead=8):
+        super().__init__()
+        self.blocks = queue.Queue(maxsize=max_blocks_ahead)
+        self.buffer = b''
+        self.eof = False
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.decompress, args=(filepath, block_bytes), daemon=True)
+        self.thread.start()
+
+    def decompress(self, filepath, block_bytes):
+        try:
+            with gzip.open(filepath, 'rb') as f:
+                while not self.stop_event.is_set():
+                    block = f.read(block_bytes) # zlib releases the GIL while decompressing
+                    self.put(block)
+                    if len(block) == 0:
+                        break
+        except Exception as e:
+            self.error = e
+            self.put(b'')
+
+    def put(self, block):
+        # don't block forever if the reader was closed early
+        while not self.stop_event.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self.buffer) == 0 and not self.eof:
+            self.buffer = self.blocks.get()
+            if self.error is not None:
+                raise self.error
+            self.eof = len(self.buffer) == 0 # an empty block marks the end of the file
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.stop_event.set()
+        super().close()
+
+def arrow_column_types():
+    """
+    The pyarrow types of the fixed schema
+    """
+    column_types = {col: pa.string() for col in STRING_COLS}
+    column_types.update({col: pa.dictionary(pa.int32(), pa.string()) for col in CATEGORY_COLS})
+    column_types.update({col: pa.bool_() for col in BOOL_COLS})
+    return column_types
+
+def read_processed_table(filepath):
+    """
+    Read a processed .csv.gz file into a pyarrow table with the fixed schema (requires pyarrow).
+    Empty fields and pandas' other default na_values are nulls (also in the string columns), like pd.read_csv
+    """
+    with io.BufferedReader(ThreadedGzipReader(filepath), buffer_size=DECOMPRESS_BLOCK_BYTES) as stream:
+        return pacsv.read_csv(stream,
+                              read_options=pacsv.ReadOptions(use_threads=True, block_size=16 * 1024 * 1024),
+                              convert_options=pacsv.ConvertOptions(column_types=arrow_column_types(), strings_can_be_null=True,
+                                                                   null_values=sorted(STR_NA_VALUES)))
+
+def read_processed_csv_gz(filepath):
+    """
+    Read a processed .csv.gz file into a dataframe with the fixed schema: ids and dates as strings,
+    low-cardinality columns as categories and outcomes as nullable booleans
+    """
+    if pa is not None:
+        return read_processed_table(filepath).to_pandas(types_mapper={pa.bool_(): pd.BooleanDtype()}.get)
+    with io.BufferedReader(ThreadedGzipReader(filepath), buffer_size=DECOMPRESS_BLOCK_BYTES) as stream:
+        dtype = {col: str for col in STRING_COLS}
+        dtype.update({col: 'category' for col in CATEGORY_COLS})
+        dtype.update({col: 'boolean' for col in BOOL_COLS})
+        return pd.read_csv(stream, dtype=dtype)
+
+def read_processed_data(state, subset='hispanic-white', manifest=MANIFEST):
+    """
+    Return the processed data of the state ('AZ', 'CO' or 'TX') for the subset ('all', 'multiply-stopped' or 'hispanic-white'),
+    read straight from its .csv.gz file in the manifest. Like read_processed_csv in plot_regression_res.R,
+    texas' date and time columns are also copied to stop_date and stop_time
+    """
+    if subset not in SUBSETS:
+        raise ValueError(f'Invalid subset {subset}, should be one of {SUBSETS}')
+    files = read_manifest(manifest)
+    if state not in files:
+        raise ValueError("Invalid state name")
+    filepath = files[state][subset]
+    if not os.path.isfile(filepath):
+        raise FileNotFoundError(f'{filepath} ({state} {subset}) is not in {os.path.dirname(manifest)}')
+    d = read_processed_csv_gz(filepath)
+    if state == 'TX':
+        d['stop_date'] = d['date']
+        d['stop_time'] = d['time']
+    log(f'{state} {subset}: {len(d)} rows from {filepath}')
+    return d
+
+def load_processed_panels(subset='hispanic-white', states=('AZ', 'CO', 'TX'), manifest=MANIFEST, run_report_prefix=None):
+    """
+    Read the subset of every state, timing each read, and return the dictionary of state -> dataframe
+    along with the run report (written to run_report_prefix + .json/.csv if it's not None)
+    """
+    run_report = new_run_report('processed_data')
+    panels = {}
+    for state in states:
+        with stage(run_report, f'read_{state.lower()}_{subset}') as s:
+            panels[state] = read_processed_data(state, subset, manifest)
+            s['rows_out'] = len(panels[state])
+    if run_report_prefix is not None:
+        write_run_report(run_report, run_report_prefix)
+    return panels, run_report
+
+if __name__ == "__main__":
+    panels, run_report = load_processed_panels(run_report_prefix='csv/processed_data_run_report')
+    log(f"Cold start to analysis panels: {sum(record['wall_time_s'] for record in run_report['stages']):.2f}s")
@@ -0,0 +1,92 @@
+import json
+import numpy as np
+import pandas as pd
+from run_report import log
+
+# Race-pair index: the multiply-stopped drivers with their race_str, stored once sorted by race_str,
+# with a json index of each race_str value's row range and byte offset in the csv. Any race_str's stops
+# (Hispanic_White, Black_White, Asian_White, Black_Hispanic, ...) are read by seeking straight to their rows,
+# so the analysis of every pair is a loop over small reads instead of full scans of the multiply-stopped data.
+#
+# Example (arizona):
+#     write_race_pair_index(azgrouped_with_race_str, 'csv/az_race_pairs_Style_Year')
+#     for_each_race_pair('csv/az_race_pairs_Style_Year', ttest_unpaired)
+
+def build_race_pair_index(stategrouped_with_race_str):
+    """
+    Return the data sorted by race_str (stops keep their order within each race_str, so each driver's stops
+    stay together) and the dictionary of race_str -> [start, stop) row range in the sorted data
+    """
+    sorted_df = stategrouped_with_race_str.sort_values('race_str', kind='stable').reset_index(drop=True)
+    race_strs = sorted_df['race_str'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, race_strs[1:] != race_strs[:-1]]) if len(race_strs) > 0 else np.zeros(0, dtype=int)
+    stops = np.r_[starts[1:], len(race_strs)]
+    return sorted_df, {race_strs[start]: [int(start), int(stop)] for start, stop in zip(starts, stops)}
+
+def race_pair_slice(sorted_df, index, race_str):
+    """
+    Return the stops of the drivers with this race_str from the sorted data (an empty dataframe if there are none)
+    """
+    start, stop = index.get(race_str, [0, 0])
+    return sorted_df.iloc[start:stop]
+
+def write_race_pair_index(stategrouped_with_race_str, path_prefix):
+    """
+    Write the data sorted by race_str to path_prefix + .csv, and its index of race_str -> row range
+    and byte offset of the range's first row to path_prefix + .json. Return the sorted data and row range index
+    """
+    sorted_df, index = build_race_pair_index(stategrouped_with_race_str)
+    ranges = {}
+    with open(path_prefix + '.csv', 'wb') as f:
+        sorted_df.iloc[:0].to_csv(f, index=False)
+        for race_str, (start, stop) in index.items():
+            ranges[race_str] = {'start': start, 'stop': stop, 'byte_offset': f.tell()}
+            sorted_df.iloc[start:stop].to_csv(f, index=False, header=False)
+    with open(path_prefix + '.json', 'w') as f:
+        json.dump({'columns': sorted_df.columns.to_list(), 'rows': len(sorted_df), 'ranges': ranges}, f, indent=2)
+    log(f'Wrote {len(sorted_df)} rows and the index of {len(ranges)} race_str values to {path_prefix}.csv/.json')
+    return sorted_df, index
+
+def read_race_pair_index(path_prefix):
+    """
+    Return the json index written by write_race_pair_index
+    """
+    with open(path_prefix + '.json') as f:
+        return json.load(f)
+
+def race_pairs(index):
+    """
+    Return the race_str values of the drivers recorded as exactly two races (ex. Black_White), largest first
+    """
+    ranges = index['ranges']
+    pairs = [race_str for race_str in ranges if len(race_str.split('_')) == 2]
+    return sorted(pairs, key=lambda race_str: ranges[race_str]['start'] - ranges[race_str]['stop'])
+
+def read_race_pair(path_prefix, race_str, index=None, **read_csv_kwargs):
+    """
+    Read only the stops of the drivers with this race_str from the csv written by write_race_pair_index,
+    seeking to the first of its rows. read_csv_kwargs are passed to pd.read_csv (ex. dtype)
+    """
+    if index is None:
+        index = read_race_pair_index(path_prefix)
+    if race_str not in index['ranges']:
+        return pd.DataFrame(columns=index['columns'])
+    rows = index['ranges'][race_str]
+    with open(path_prefix + '.csv', 'rb') as f:
+        f.seek(rows['byte_offset'])
+        return pd.read_csv(f, header=None, names=index['columns'], nrows=rows['stop'] - rows['start'], **read_csv_kwargs)
+
+def for_each_race_pair(path_prefix, func, pairs=None, read_csv_kwargs=None, **kwargs):
+    """
+    Call func(stops, race_pair=pair, **kwargs) on the stops of each race pair (all pairs in the index if pairs is None),
+    ex. ttest_unpaired or regress, and return the dictionary of pair -> result
+    """
+    index = read_race_pair_index(path_prefix)
+    if pairs is None:
+        pairs = race_pairs(index)
+    results = {}
+    for pair in pairs:
+        stops = read_race_pair(path_prefix, pair, index, **(read_csv_kwargs or {}))
+        log(f'{pair}: {len(stops)} stops')
+        results[pair] = func(stops, race_pair=pair, **kwargs)
+    return results
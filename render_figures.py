@@ -0,0 +1,246 @@
+import os
+import json
+import hashlib
+import matplotlib
+matplotlib.use('Agg') # render to files only, before pyplot is imported (also in the worker processes, which import this module)
+import matplotlib.pyplot as plt
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from policing_data_expl import (draw_search_rates_comparison, draw_search_rates_comparison_all_states, draw_stop_freq_histogram,
+                                plot_state_stats, make_sensitivity_dot_plot, generate_state_stats, state_stats_fig_names,
+                                STOP_FREQ_HISTOGRAM_SUFFIXES)
+from aggregate_cube import CUBE_SOURCES, refresh_cube, search_rates_comparison_stats, search_rates_comparison_all_states_stats
+from driver_store import build_driver_store, race_str_column_from_store
+from fit_cache import cached_sensitivity_fits, sensitivity_fit_keys
+from run_report import log
+
+# Headless batch rendering of the figures: a manifest of figures (plot type x state x outcome) is rendered
+# to pdfs on the non-interactive Agg backend by a pool of worker processes. The statistics behind each figure
+# are computed once in the main process (from the aggregate cube and the driver store), and the sha256 of those
+# statistics, the plot type and the style is kept in a json sidecar next to the figure's pdfs, so figures whose
+# inputs and style haven't changed since they were last rendered are skipped. The sensitivity plots' regressions
+# are the exception: the main process only computes their fit cache keys (a hash of the data and specs), and the
+# regressions of the plots to render are fit (or loaded from the fit cache) in the workers.
+#
+# Example:
+#     python render_figures.py
+#     render_figures(figure_manifest(states=['AZ'], outcomes=['search_conducted']), max_workers=2)
+
+FIGURE_DIR = 'plots/figures/'
+PLOTS = ['search_rates_comparison', 'search_rates_comparison_all_states', 'state_stats', 'stop_freq_histogram', 'sensitivity']
+STATES = ['AZ', 'CO', 'TX']
+OUTCOMES = ['search_conducted', 'is_arrested']
+# rcParams every figure is drawn with (part of the hash, so changing them rerenders everything)
+STYLE = {'font.size': 10, 'pdf.fonttype': 42}
+RENDERER_VERSION = 1 # bump when a draw function changes, to rerender every figure
+
+# regressions of the sensitivity dot plot (make_sensitivity_dot_plot only labels the search rate difference)
+SENSITIVITY_SPECS = [
+    {'cols': [], 'controls': [], 'model_name': 'No controls'},
+    {'cols': ['hour_of_day'], 'controls': ['hour_of_day'], 'model_name': 'Hour of day'}
+]
+# texas keeps its raw date and time column names
+STATE_REGRESS_KWARGS = {'TX': {'stop_date_col': 'date', 'stop_time_col': 'time'}}
+
+def figure_manifest(plots=PLOTS, states=STATES, outcomes=OUTCOMES):
+    """
+    Return the manifest of figures (dictionaries of plot, state and outcome) for every plot type x state x outcome.
+    The all states plot has state 'ALL', the stop frequency histogram has no outcome,
+    and the sensitivity plot is only drawn for search_conducted
+    """
+    manifest = []
+    for plot in plots:
+        for state in (['ALL'] if plot == 'search_rates_comparison_all_states' else states):
+            if plot == 'stop_freq_histogram':
+                plot_outcomes = [None]
+            elif plot == 'sensitivity':
+                plot_outcomes = [outcome for outcome in outcomes if outcome == 'search_conducted']
+            else:
+                plot_outcomes = outcomes
+            for outcome in plot_outcomes:
+                manifest.append({'plot': plot, 'state': state, 'outcome': outcome})
+    return manifest
+
+def figure_name(entry):
+    """
+    Name of the figure's json sidecar (and pdf, for the plots that draw a single pdf)
+    """
+    parts = [entry['state'].lower(), entry['outcome'], entry['plot']]
+    return '_'.join(part for part in parts if part is not None)
+
+def figure_outputs(entry, fig_dir=FIGURE_DIR):
+    """
+    The pdfs the figure is rendered to
+    """
+    name = figure_name(entry)
+    if entry['plot'] == 'state_stats': # plot_state_stats names its general and Hispanic+white plots itself
+        return [f'{fig_dir}{fig_name}.pdf' for fig_name in state_stats_fig_names(entry['state'], entry['outcome'])]
+    if entry['plot'] == 'stop_freq_histogram':
+        return [f'{fig_dir}{name}_{suffix}.pdf' for suffix in STOP_FREQ_HISTOGRAM_SUFFIXES]
+    return [f'{fig_dir}{name}.pdf']
+
+class FigureInputs:
+    """
+    The data the statistics of the figures are computed from, each loaded at most once:
+    the aggregate cube and each state's multiply-stopped drivers (with race_str) and Hispanic-white drivers
+    """
+    def __init__(self, sources=CUBE_SOURCES):
+        self.sources = sources
+        self._cube = None
+        self._multiply_stopped = {}
+        self._hispanic_white = {}
+
+    def cube(self):
+        if self._cube is None:
+            self._cube, _ = refresh_cube(self.sources)
+        return self._cube
+
+    def multiply_stopped(self, state):
+        if state not in self._multiply_stopped:
+            d = read_source(self.sources[state]['multiply_stopped'])
+            if 'race_str' not in d.columns:
+                d.insert(2, 'race_str', race_str_column_from_store(build_driver_store(d, ['driver_id'])))
+            self._multiply_stopped[state] = d
+        return self._multiply_stopped[state]
+
+    def hispanic_white(self, state):
+        if state not in self._hispanic_white:
+            self._hispanic_white[state] = read_source(self.sources[state]['racially_ambig'])
+        return self._hispanic_white[state]
+
+def read_source(filepath):
+    """
+    Read a pipeline output, with driver_race from texas' driver_race_raw if needed (like refresh_cube)
+    """
+    d = pd.read_csv(filepath)
+    if 'driver_race' not in d.columns and 'driver_race_raw' in d.columns:
+        d['driver_race'] = d['driver_race_raw'].str.capitalize()
+    return d
+
+def figure_stats(entry, inputs):
+    """
+    Compute the statistics the figure is drawn from, or None if the state doesn't have the outcome
+    """
+    plot, state, outcome = entry['plot'], entry['state'], entry['outcome']
+    if plot == 'search_rates_comparison':
+        if outcome not in set(inputs.cube().loc[inputs.cube()['state'] == state, 'outcome']):
+            return None
+        return search_rates_comparison_stats(inputs.cube(), state, outcome)
+    if plot == 'search_rates_comparison_all_states':
+        if outcome not in set(inputs.cube()['outcome']):
+            return None
+        return search_rates_comparison_all_states_stats(inputs.cube(), outcome)
+    if plot == 'state_stats':
+        stats = [(col, stats_dict) for col, stats_dict in generate_state_stats(inputs.multiply_stopped(state), ['driver_id']) if col == outcome]
+        return stats if len(stats) > 0 else None
+    if plot == 'stop_freq_histogram':
+        # the number of drivers with each number of stops
+        num_stops_per_person = inputs.multiply_stopped(state).groupby('driver_id').size()
+        return num_stops_per_person.value_counts().sort_index().to_dict()
+    if plot == 'sensitivity':
+        hispanic_white_drivers = inputs.hispanic_white(state)
+        if outcome not in hispanic_white_drivers.columns:
+            return None
+        specs = [{'dep_var': outcome, **spec, **STATE_REGRESS_KWARGS.get(state, {})} for spec in SENSITIVITY_SPECS]
+        # the fits are left to the worker that renders the plot, which reads the source itself
+        return {'source': inputs.sources[state]['racially_ambig'], 'specs': specs,
+                'fit_keys': sensitivity_fit_keys(hispanic_white_drivers, specs)}
+    raise ValueError(f'Unknown plot {plot}')
+
+def to_jsonable(obj):
+    """
+    json.dumps default for the numpy and pandas values in the statistics
+    """
+    if isinstance(obj, (pd.Series, pd.DataFrame)):
+        return obj.to_dict()
+    if hasattr(obj, 'tolist'): # numpy scalars and arrays
+        return obj.tolist()
+    raise TypeError(f'Cannot hash {type(obj)}')
+
+def figure_hash(entry, stats, style):
+    """
+    sha256 of the figure's plot type, state, outcome, statistics and style (and the renderer version)
+    """
+    content = {'entry': entry, 'stats': stats, 'style': style, 'version': RENDERER_VERSION}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=to_jsonable).encode()).hexdigest()
+
+def is_up_to_date(sidecar, digest, outputs):
+    """
+    True if the figure was rendered from the same inputs (the sidecar has the hash) and all its pdfs exist
+    """
+    if not os.path.isfile(sidecar) or not all(os.path.isfile(output) for output in outputs):
+        return False
+    with open(sidecar) as f:
+        return json.load(f).get('hash') == digest
+
+def render_figure(entry, stats, outputs, fig_dir, style):
+    """
+    Draw the figure from its statistics to its pdfs (runs in a worker process).
+    The sensitivity plot's regressions are fit here (unless they are in the fit cache)
+    """
+    plot, state, outcome = entry['plot'], entry['state'], entry['outcome']
+    with plt.rc_context(style):
+        if plot == 'search_rates_comparison':
+            stat_list, ci_width_list, index_list = stats
+            draw_search_rates_comparison(state, outcome, stat_list, ci_width_list, index_list, fig_path=outputs[0], show=False)
+        elif plot == 'search_rates_comparison_all_states':
+            stat_lists, ci_width_lists = stats
+            draw_search_rates_comparison_all_states(outcome, stat_lists, ci_width_lists, fig_path=outputs[0], show=False)
+        elif plot == 'state_stats':
+            plot_state_stats(stats, state, save_fig=True, fig_dir=fig_dir, show=False)
+        elif plot == 'stop_freq_histogram':
+            num_stops_per_person = pd.Series([num_stops for num_stops, num_drivers in stats.items() for _ in range(num_drivers)])
+            draw_stop_freq_histogram(num_stops_per_person, fig_prefix=outputs[0][:-len('_all.pdf')], show=False)
+        elif plot == 'sensitivity':
+            fits = cached_sensitivity_fits(read_source(stats['source']), stats['specs'])
+            make_sensitivity_dot_plot(fits, 'Hispanic', f'{state} {outcome} sensitivity to controls', fig_path=outputs[0], show=False)
+    return outputs
+
+def render_figures(manifest=None, fig_dir=FIGURE_DIR, style=STYLE, max_workers=None, sources=CUBE_SOURCES, force=False):
+    """
+    Render the figures of the manifest (a list of dictionaries of plot, state and outcome, or the path to a json file
+    of that list; every figure if None) to fig_dir, skipping the ones whose statistics and style haven't changed
+    since they were last rendered (unless force=True). Return the dictionary of figure name -> 'rendered',
+    'up to date' or 'skipped' (the state doesn't have the outcome)
+    """
+    if manifest is None:
+        manifest = figure_manifest()
+    elif isinstance(manifest, str):
+        with open(manifest) as f:
+            manifest = json.load(f)
+    os.makedirs(fig_dir, exist_ok=True)
+
+    inputs = FigureInputs(sources)
+    status = {}
+    to_render = []
+    for entry in manifest:
+        name = figure_name(entry)
+        stats = figure_stats(entry, inputs)
+        if stats is None:
+            log(f'Skipping {name} - {entry["state"]} has no {entry["outcome"]}')
+            status[name] = 'skipped'
+            continue
+        outputs = figure_outputs(entry, fig_dir)
+        digest = figure_hash(entry, stats, style)
+        sidecar = f'{fig_dir}{name}.json'
+        if not force and is_up_to_date(sidecar, digest, outputs):
+            status[name] = 'up to date'
+            continue
+        to_render.append((name, entry, stats, outputs, digest, sidecar))
+
+    log(f'Rendering {len(to_render)} of {len(manifest)} figures')
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(name, digest, sidecar, executor.submit(render_figure, entry, stats, outputs, fig_dir, style))
+                   for name, entry, stats, outputs, digest, sidecar in to_render]
+        for name, digest, sidecar, future in futures:
+            outputs = future.result()
+            # the sidecar is only written once the pdfs are, so a failed render is retried next time
+            with open(sidecar, 'w') as f:
+                json.dump({'hash': digest, 'outputs': outputs}, f, indent=2)
+            status[name] = 'rendered'
+    return status
+
+if __name__ == '__main__':
+    status = render_figures()
+    for name, figure_status in status.items():
+        log(f'{name}: {figure_status}')
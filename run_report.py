@@ -0,0 +1,121 @@
+import os
+import sys
+import csv
+import json
+import time
+import resource
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+# Stage-level instrumentation for the preprocessing pipeline (az.py, co.py, tx.py)
+
+# progress prints in the pipeline go through log() so they can be switched off
+VERBOSE = True
+
+def set_verbose(verbose):
+    """
+    Turn the pipeline's progress prints on (verbose=True) or off (verbose=False)
+    """
+    global VERBOSE
+    VERBOSE = verbose
+
+def log(*args, **kwargs):
+    """
+    Drop-in replacement for print that respects set_verbose
+    """
+    if VERBOSE:
+        print(*args, **kwargs)
+
+def process_peak_rss_mb():
+    """
+    Return the peak resident set size of this process so far, in MB
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return max_rss / (1024 * 1024)
+    return max_rss / 1024
+
+def new_run_report(state, profile_stage=None, profiler='cprofile', profile_dir='csv/'):
+    """
+    Return an empty run report for the state
+    profile_stage is the name of the stage to profile (None to not profile anything),
+    and profiler is either 'cprofile' or 'tracemalloc'
+    """
+    if profiler not in {'cprofile', 'tracemalloc'}:
+        raise ValueError("profiler must be 'cprofile' or 'tracemalloc'")
+    return {
+        'state': state,
+        'profile_stage': profile_stage,
+        'profiler': profiler,
+        'profile_dir': profile_dir,
+        'stages': []
+    }
+
+@contextmanager
+def stage(run_report, name, rows_in=None):
+    """
+    Time the body of the with-statement as the stage name and append its record to run_report.
+    The record (a dict) is yielded so the body can fill in rows_out:
+
+        with stage(run_report, 'group_df_by', rows_in=len(df)) as s:
+            grouped = group_df_by(df, keys)
+            s['rows_out'] = len(grouped.obj)
+    """
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+    profile_this_stage = run_report['profile_stage'] == name
+    profile_path_prefix = os.path.join(run_report['profile_dir'], f"{run_report['state'].lower()}_{name}")
+    profiler = None
+    if profile_this_stage:
+        if run_report['profiler'] == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            tracemalloc.start()
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    peak_rss_start = process_peak_rss_mb()
+    try:
+        yield record
+    finally:
+        record['wall_time_s'] = time.perf_counter() - wall_start
+        record['cpu_time_s'] = time.process_time() - cpu_start
+        # ru_maxrss is the high-water mark of the whole process so far, not of this stage alone
+        record['process_peak_rss_mb'] = process_peak_rss_mb()
+        # how much this stage raised it (0 if the stage stayed under an earlier stage's peak)
+        record['peak_rss_increase_mb'] = record['process_peak_rss_mb'] - peak_rss_start
+
+        if profile_this_stage:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(profile_path_prefix + '.prof')
+                record['profile'] = profile_path_prefix + '.prof'
+            else:
+                snapshot = tracemalloc.take_snapshot()
+                _, traced_peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                record['tracemalloc_peak_mb'] = traced_peak / (1024 * 1024)
+                with open(profile_path_prefix + '_tracemalloc.txt', 'w') as f:
+                    for stat in snapshot.statistics('lineno')[:25]:
+                        f.write(f'{stat}\n')
+                record['profile'] = profile_path_prefix + '_tracemalloc.txt'
+
+        run_report['stages'].append(record)
+        log(f"[{run_report['state']}] {name}: {record['wall_time_s']:.1f}s wall, {record['cpu_time_s']:.1f}s cpu, "
+            f"{record['process_peak_rss_mb']:.0f} MB process peak RSS (+{record['peak_rss_increase_mb']:.0f} MB), rows {rows_in} -> {record['rows_out']}")
+
+def write_run_report(run_report, path_prefix):
+    """
+    Write the run report to path_prefix + '.json' (whole report) and path_prefix + '.csv' (one row per stage)
+    """
+    with open(path_prefix + '.json', 'w') as f:
+        json.dump(run_report, f, indent=2)
+
+    fieldnames = ['stage', 'rows_in', 'rows_out', 'wall_time_s', 'cpu_time_s', 'process_peak_rss_mb', 'peak_rss_increase_mb', 'tracemalloc_peak_mb', 'profile']
+    with open(path_prefix + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        for record in run_report['stages']:
+            writer.writerow(record)
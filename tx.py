@@ -1,6 +1,10 @@
 import pandas as pd
 import os
 from policing_data_expl import *
+from run_report import set_verbose, new_run_report, stage, write_run_report
+from external_sort import sort_and_group_csv
+from race_pair_index import write_race_pair_index
+from validate_pipeline import validate_outputs, write_validation_report, written_rows_and_raw_rows
 
 config = { # 2016-2017 data only
     "grouping_keys": ['HA_N_FIRST_DRVR', 'HA_N_LAST_DRVR', 'HA_A_ADDRESS_DRVR', 'HA_A_CITY_DRVR', 'HA_A_STATE_DRVR', 'HA_A_ZIP_DRVR'],
@@ -8,31 +12,59 @@ config = { # 2016-2017 data only
     "raw_data_csv": 'path-to-raw-csv', # replace with path to raw csv
     "grouped_csv_name": 'csv/tx_processed_grouped_driver_race_raw.csv',
     "hispanic_white_drivers_only_csv_name": 'csv/tx_processed_hispanic_white_drivers_driver_race.csv',
-    "only_after_2016": True
+    "year_window": (2016, 2017), # only read stops from these years (inclusive); None to read every year
+    "read_chunksize": 1000000, # rows per chunk when filtering on year_window while reading
+    "verbose": True, # set to False to silence the progress prints
+    "profile_stage": None, # set to a stage name (ex. 'group_df_by') to profile that stage
+    "profiler": 'cprofile', # 'cprofile' or 'tracemalloc'
+    "external_sort": False, # set to True to check each driver one at a time from a copy of the raw csv sorted on disk by grouping_keys (the state is already in memory, so this doesn't lower peak memory)
+    "sort_run_rows": 1000000, # rows per sorted run spilled to disk by the external sort
+    "race_pair_index_prefix": None, # set to a path prefix (ex. 'csv/tx_race_pairs_driver_race') to also write the multiply-stopped drivers indexed by race_str
+    "validation_report_name": 'csv/tx_validation_report_driver_race.json', # checks of the outputs (one driver_id per driver, 2-10 stops, race_str, ...); None to skip
+    "validate_raw_and_clean": True, # also check that the grouped csv matches the raw rows of its drivers on all their columns
+    "run_report_prefix": 'csv/tx_run_report_driver_race' # run report is written to this prefix + .json/.csv
 }
 
+set_verbose(config['verbose'])
+run_report = new_run_report('TX', config['profile_stage'], config['profiler'])
+
 # Create the folder for the csv files if it doesn't exist
 if not os.path.exists('csv/'):
     os.makedirs('csv/')
-    print('Folder for csv files created successfully.')
+    log('Folder for csv files created successfully.')
 else:
-    print('Folder for csv files already exists.')
+    log('Folder for csv files already exists.')
 
 # Load data
 filepath = config['raw_data_csv']
 dtypes_dict = {k:str for k in config['grouping_keys']}
-tx_data = standardize_cols('TX', pd.read_csv(filepath, dtype=dtypes_dict))
-
-if config['only_after_2016']:
-    # only take rows that happened in the year 2016 and 2017
-    before2016_mask = tx_data['date'].apply(lambda x: str(x)[:4] != '2016' and str(x)[:4] != '2017')
-    only_2016_2017 = tx_data['date'].apply(lambda x: str(x)[:4] == '2016' or str(x)[:4] == '2017')
-    b2016 = tx_data[before2016_mask]
-    a2016 = tx_data[only_2016_2017]
-    tx_data = a2016
+with stage(run_report, 'read_csv') as s:
+    if config['year_window'] is not None:
+        # only take rows that happened in the years of year_window (2016 and 2017), filtering each chunk as it is read
+        dtypes_dict['date'] = str
+        tx_data = read_csv_in_year_window(filepath, 'date', config['year_window'], chunksize=config['read_chunksize'], dtype=dtypes_dict)
+    else:
+        tx_data = pd.read_csv(filepath, dtype=dtypes_dict)
+    s['rows_out'] = len(tx_data)
+with stage(run_report, 'standardize_cols', rows_in=len(tx_data)) as s:
+    tx_data = standardize_cols('TX', tx_data)
+    s['rows_out'] = len(tx_data)
+# Add the time features (hour_of_day, stop_year, weekday, ...) once, so they're stored in every csv written below
+with stage(run_report, 'time_features', rows_in=len(tx_data)) as s:
+    # parse the dates once, for the time features here and the stop_seq of the group_df_by stage
+    stop_dates = parse_stop_dates(tx_data, 'date')
+    tx_data = add_time_features(tx_data, stop_date_col='date', stop_time_col='time', dates=stop_dates)
+    s['rows_out'] = len(tx_data)
 
 # Construct filtered multiply-stopped dataset, and write the complete data to csv along with the filtered dataset
-grouped_tx = group_df_by(tx_data, config['grouping_keys'], csv_filename='csv/tx_raw_with_driver_id_' + config['descript'] + '.csv')
+with stage(run_report, 'group_df_by', rows_in=len(tx_data)) as s:
+    raw_with_driver_id_csv_name = 'csv/tx_raw_with_driver_id_' + config['descript'] + '.csv'
+    grouped_tx = group_df_by(tx_data, config['grouping_keys'])
+    # number each driver's stops in date and time order, so stop_seq is in the csv and in the grouped csv written from it
+    raw_with_driver_id = add_stop_seq(grouped_tx.obj, stop_date_col='date', stop_time_col='time', dates=stop_dates) # also kept for the raw and clean check of the validate stage
+    raw_with_driver_id.to_csv(raw_with_driver_id_csv_name, index=False)
+    grouped_tx = raw_with_driver_id.groupby(config['grouping_keys'])
+    s['rows_out'] = len(grouped_tx.obj)
 
 def tx_cond(name, entries):
     """
@@ -44,23 +76,50 @@ def tx_cond(name, entries):
     return len(entries) >= 2 and len(entries) <= 10
         
 grouped_csv_name = config['grouped_csv_name']
-check_cond(grouped_tx, tx_cond, grouped_csv_name)
+with stage(run_report, 'check_cond', rows_in=len(grouped_tx.obj)) as s:
+    if config['external_sort']:
+        # stream the drivers one at a time from disk instead of iterating over the in-memory groupby
+        sorted_csv_name = raw_with_driver_id_csv_name.replace('_raw_with_driver_id', '_raw_sorted')
+        grouped_tx = sort_and_group_csv(raw_with_driver_id_csv_name, config['grouping_keys'], sorted_csv_name, config['sort_run_rows'])
+    check_cond(grouped_tx, tx_cond, grouped_csv_name)
 
-txgrouped_csv = pd.read_csv(grouped_csv_name)
-tx_grouped = txgrouped_csv.groupby(config['grouping_keys'])
+    txgrouped_csv = pd.read_csv(grouped_csv_name)
+    tx_grouped = txgrouped_csv.groupby(config['grouping_keys'])
+    s['rows_out'] = len(txgrouped_csv)
 
 # Generate the race_str column
-person_race_dict = generate_person_race_dict(tx_grouped)
-# make the grouping_keys into a tuple so it can be used as a key per person in person_race_dict
-tuple_lst = [tuple(keys) for keys in txgrouped_csv[config['grouping_keys']].values.tolist()]
-race_str_col = [person_race_dict[(keys)] for keys in tuple_lst]
+with stage(run_report, 'race_str', rows_in=len(txgrouped_csv)) as s:
+    person_race_dict = generate_person_race_dict(tx_grouped)
+    # make the grouping_keys into a tuple so it can be used as a key per person in person_race_dict
+    tuple_lst = [tuple(keys) for keys in txgrouped_csv[config['grouping_keys']].values.tolist()]
+    race_str_col = [person_race_dict[(keys)] for keys in tuple_lst]
 
-# call this new column race_str
-txgrouped_with_race_str = txgrouped_csv.copy()
-if ('race_str' not in txgrouped_with_race_str.columns):
-    txgrouped_with_race_str.insert(2, "race_str", race_str_col, False)
+    # call this new column race_str
+    txgrouped_with_race_str = txgrouped_csv.copy()
+    if ('race_str' not in txgrouped_with_race_str.columns):
+        txgrouped_with_race_str.insert(2, "race_str", race_str_col, False)
+    s['rows_out'] = len(txgrouped_with_race_str)
 
 # Filter down to inconsistently-perceived drivers, and write to csv
-race_str_cond = txgrouped_with_race_str['race_str'].map(lambda x:x in {"Hispanic_White"})
-hispanic_white_drivers = txgrouped_with_race_str.loc[txgrouped_with_race_str['search_conducted'].notnull() & race_str_cond]
-write_to_csv(hispanic_white_drivers, config['hispanic_white_drivers_only_csv_name'])
\ No newline at end of file
+with stage(run_report, 'hispanic_white', rows_in=len(txgrouped_with_race_str)) as s:
+    race_str_cond = txgrouped_with_race_str['race_str'] == "Hispanic_White"
+    hispanic_white_drivers = txgrouped_with_race_str.loc[txgrouped_with_race_str['search_conducted'].notnull() & race_str_cond]
+    write_to_csv(hispanic_white_drivers, config['hispanic_white_drivers_only_csv_name'])
+    s['rows_out'] = len(hispanic_white_drivers)
+
+# Optionally write the multiply-stopped drivers sorted and indexed by race_str, so the other race pairs (ex. Black_White) can be read without a full scan
+if config['race_pair_index_prefix'] is not None:
+    with stage(run_report, 'race_pair_index', rows_in=len(txgrouped_with_race_str)) as s:
+        write_race_pair_index(txgrouped_with_race_str, config['race_pair_index_prefix'])
+        s['rows_out'] = len(txgrouped_with_race_str)
+
+# Check the outputs in a few vectorized passes, and stop if any check fails
+if config['validation_report_name'] is not None:
+    with stage(run_report, 'validate', rows_in=len(txgrouped_with_race_str)) as s:
+        raw_and_clean = written_rows_and_raw_rows(raw_with_driver_id, txgrouped_csv) if config['validate_raw_and_clean'] else None
+        validation_report = validate_outputs('TX', txgrouped_with_race_str, hispanic_white_drivers, config['grouping_keys'],
+                                             raw_and_clean=raw_and_clean)
+        write_validation_report(validation_report, config['validation_report_name'])
+        s['rows_out'] = len(txgrouped_with_race_str)
+
+write_run_report(run_report, config['run_report_prefix'])
\ No newline at end of file
@@ -0,0 +1,149 @@
+import json
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+from policing_data_expl import unmatched_cols
+from driver_store import build_driver_store, race_str_column_from_store
+from run_report import log
+
+# Validation of a state's pipeline outputs in a few vectorized passes over the whole state (instead of
+# asserts per driver group): every driver_id maps to exactly one grouping key tuple and back, no key column
+# is null, every multiply-stopped driver has 2-10 stops, race_str matches the races of the driver's stops,
+# the Hispanic-white output only has Hispanic_White drivers, and optionally the raw and clean data match
+# on all their column pairs (ex. the grouped csv and the raw rows it was written from, see written_rows_and_raw_rows).
+# The checks are collected into a json report so they can run on every refresh.
+#
+# Example (arizona, after the hispanic_white stage):
+#     report = validate_outputs('AZ', azgrouped_with_race_str, hispanic_white_drivers, config['grouping_keys'],
+#                               raw_and_clean=written_rows_and_raw_rows(raw_with_driver_id, azgrouped_csv))
+#     write_validation_report(report, 'csv/az_validation_report_Style_Year.json')
+
+NUM_EXAMPLES = 5 # offending values kept in the report per check
+FLOAT_RTOL = 1e-12 # relative difference up to which the floats of written_rows_and_raw_rows are equal
+
+def check_result(name, num_failures, examples=(), **details):
+    """
+    Return the report entry of a check: passed if there are no failures, with up to NUM_EXAMPLES offending values
+    """
+    examples = [value.item() if hasattr(value, 'item') else value for value in list(examples)[:NUM_EXAMPLES]]
+    return {'check': name, 'passed': bool(num_failures == 0), 'failures': int(num_failures), 'examples': examples, **details}
+
+def check_no_null_keys(d, key_cols):
+    """
+    No stop has a null value in any of the key columns (null counts of all the columns in one pass)
+    """
+    null_counts = d[key_cols].isna().sum()
+    null_counts = null_counts[null_counts > 0]
+    return check_result('no_null_keys', null_counts.sum(), null_counts.index, null_counts={col: int(count) for col, count in null_counts.items()})
+
+def check_driver_id_keys_one_to_one(d, grouping_keys):
+    """
+    Each driver_id has exactly one grouping key tuple and each grouping key tuple has exactly one driver_id
+    """
+    pairs = d[['driver_id'] + grouping_keys].drop_duplicates()
+    ids_with_many_keys = pairs.loc[pairs['driver_id'].duplicated(keep=False), 'driver_id'].unique()
+    keys_with_many_ids = pairs.loc[pairs.duplicated(grouping_keys, keep=False), 'driver_id'].unique()
+    return check_result('driver_id_keys_one_to_one', len(ids_with_many_keys) + len(keys_with_many_ids),
+                        pd.unique(np.concatenate([ids_with_many_keys, keys_with_many_ids])),
+                        ids_with_many_keys=len(ids_with_many_keys), ids_sharing_keys=len(keys_with_many_ids))
+
+def check_stops_per_driver(d, min_stops=2, max_stops=10):
+    """
+    Every driver has between min_stops and max_stops stops (inclusive)
+    """
+    stops_per_driver = d['driver_id'].value_counts()
+    out_of_range = stops_per_driver[(stops_per_driver < min_stops) | (stops_per_driver > max_stops)]
+    return check_result('stops_per_driver', len(out_of_range), out_of_range.index, min_stops=min_stops, max_stops=max_stops,
+                        min_found=int(stops_per_driver.min()) if len(stops_per_driver) > 0 else None,
+                        max_found=int(stops_per_driver.max()) if len(stops_per_driver) > 0 else None)
+
+def check_race_str(d, driver_race_col='driver_race'):
+    """
+    Each stop's race_str is the race string of its driver's stops (recomputed from the driver store's race bitmasks)
+    """
+    expected = race_str_column_from_store(build_driver_store(d, ['driver_id'], driver_race_col=driver_race_col))
+    mismatched = d['race_str'].to_numpy(dtype=object) != expected
+    return check_result('race_str_consistent', d.loc[mismatched, 'driver_id'].nunique(), d.loc[mismatched, 'driver_id'].unique(),
+                        mismatched_stops=int(mismatched.sum()))
+
+def check_race_pair_subset(d, race_pair='Hispanic_White', driver_race_col='driver_race'):
+    """
+    The race pair output (ex. the Hispanic-white drivers) only has drivers with that race_str, stopped as one of its races
+    """
+    races = race_pair.split('_')
+    wrong = (d['race_str'] != race_pair) | ~d[driver_race_col].isin(races)
+    return check_result('race_pair_subset', d.loc[wrong, 'driver_id'].nunique(), d.loc[wrong, 'driver_id'].unique(), race_pair=race_pair)
+
+def check_raw_and_clean_match(raw_df, clean_df, cols_raw, cols_clean):
+    """
+    The raw and clean data have the same number of rows and match on all the column pairs (compared all at once)
+    """
+    if len(raw_df) != len(clean_df):
+        return check_result('raw_and_clean_match', abs(len(raw_df) - len(clean_df)), raw_rows=len(raw_df), clean_rows=len(clean_df))
+    mismatches = unmatched_cols(raw_df, clean_df, cols_raw, cols_clean)
+    mismatched = mismatches.loc[(mismatches['null_mismatches'] > 0) | (mismatches['value_mismatches'] > 0)]
+    return check_result('raw_and_clean_match', len(mismatched), mismatched['raw'],
+                        mismatched_cols=mismatched.astype({'null_mismatches': int, 'value_mismatches': int}).to_dict('records'))
+
+def written_rows_and_raw_rows(raw_with_driver_id, stategrouped_csv):
+    """
+    Return the raw_and_clean tuple of validate_outputs that compares the grouped csv as read back from disk (clean)
+    with the raw rows (with driver_id) of its drivers it was written from: both sorted by driver_id keeping each
+    driver's stops in order, on all their shared columns. Column pairs that are numeric on both sides are compared
+    as floats (equal up to FLOAT_RTOL) and the others as the strings written to the csv (nulls kept as nulls), so the
+    types read_csv infers back (ex. float years with nulls, an int zip code from a string) aren't counted as mismatches
+    """
+    cols = [col for col in stategrouped_csv.columns if col in raw_with_driver_id.columns]
+    raw = raw_with_driver_id.loc[raw_with_driver_id['driver_id'].isin(stategrouped_csv['driver_id']), cols]
+    raw = raw.sort_values('driver_id', kind='stable')
+    clean = stategrouped_csv[cols].sort_values('driver_id', kind='stable')
+    def as_written(col):
+        if is_numeric_dtype(raw[col]) and is_numeric_dtype(clean[col]):
+            raw_values, clean_values = raw[col].to_numpy(dtype=float), clean[col].to_numpy(dtype=float)
+            # read_csv's default float parser can be off by an ulp (ex. fractional hours of day), so take those as equal
+            close = np.isclose(raw_values, clean_values, rtol=FLOAT_RTOL, atol=0)
+            return pd.Series(raw_values), pd.Series(np.where(close, raw_values, clean_values))
+        raw_values, clean_values = raw[col].astype(str).where(raw[col].notna()), clean[col].astype(str).where(clean[col].notna())
+        return raw_values.reset_index(drop=True), clean_values.reset_index(drop=True)
+    pairs = {col: as_written(col) for col in cols}
+    return (pd.DataFrame({col: raw_values for col, (raw_values, _) in pairs.items()}),
+            pd.DataFrame({col: clean_values for col, (_, clean_values) in pairs.items()}), cols, cols)
+
+def validate_outputs(state, stategrouped_with_race_str, hispanic_white_drivers, grouping_keys, min_stops=2, max_stops=10,
+                     driver_race_col='driver_race', raw_and_clean=None):
+    """
+    Run all the checks on the state's multiply-stopped drivers (with race_str) and Hispanic-white drivers, and
+    return the report: state, rows, drivers, passed, and the list of checks. raw_and_clean is an optional tuple
+    (raw_df, clean_df, cols_raw, cols_clean) of data to also compare column by column
+    """
+    d = stategrouped_with_race_str
+    checks = [
+        check_no_null_keys(d, ['driver_id'] + grouping_keys + [driver_race_col, 'race_str']),
+        check_driver_id_keys_one_to_one(d, grouping_keys),
+        check_stops_per_driver(d, min_stops, max_stops),
+        check_race_str(d, driver_race_col),
+        check_race_pair_subset(hispanic_white_drivers, 'Hispanic_White', driver_race_col)
+    ]
+    if raw_and_clean is not None:
+        checks.append(check_raw_and_clean_match(*raw_and_clean))
+    return {
+        'state': state,
+        'rows': len(d),
+        'drivers': int(d['driver_id'].nunique()),
+        'passed': all(check['passed'] for check in checks),
+        'checks': checks
+    }
+
+def write_validation_report(report, json_filename):
+    """
+    Write the report to json_filename and log the failed checks.
+    Raise a ValueError after writing it if any check failed, so the pipeline stops on bad outputs
+    """
+    with open(json_filename, 'w') as f:
+        json.dump(report, f, indent=2)
+    failed = [check for check in report['checks'] if not check['passed']]
+    for check in failed:
+        log(f"Validation check {check['check']} failed: {check['failures']} failures (ex. {check['examples']})")
+    log(f"Validated {report['rows']} rows of {report['drivers']} drivers: {len(report['checks']) - len(failed)} of {len(report['checks'])} checks passed, report written to {json_filename}")
+    if len(failed) > 0:
+        raise ValueError(f"{report['state']} failed the validation checks {[check['check'] for check in failed]}, see {json_filename}")